@@ -1,19 +1,44 @@
+import asyncio
 import json
 import joblib
 import os
+import shutil
 
+from fsspec.asyn import sync
 import pandas as pd
 import s3fs
 
 import constants
+from mopy.utils.datetime import Timer
+from mopy.utils.pandas import (
+    get_dtype_schema,
+    get_dtype_schema_filepath,
+    get_part_filepath,
+    get_read_csv_kwargs,
+    infer_df_format,
+    iter_df_chunks_from_buffer,
+    read_df_from_buffer,
+    write_df_chunks_to_buffer,
+    write_df_to_buffer,
+)
+from mopy.utils.serialization import dump_object, is_serialized_object, load_object
+from mopy.utils.timing import timed_methods
 
+MULTIPART_THRESHOLD = 64 * 1024**2
+MULTIPART_PART_SIZE = 16 * 1024**2
+CHECKPOINT_SUFFIX = ".s3upload.json"
 
+
+@timed_methods("s3")
 class S3FSClient:
     """
-    AWS S3 filesystem with ready-made methods for dumping, loading and deleting data
+    AWS S3 filesystem with ready-made methods for dumping, loading and deleting data.
+    Pass a `utils.cache.DiskCache` as `cache` to serve repeated loads from local disk, revalidated by ETag.
+    Set the AWS_ENDPOINT_URL environment variable to point it at a local S3 stand-in such as moto.
     """
 
-    def __init__(self):
+    def __init__(self, cache=None):
+        self.cache = cache
         self.fs = s3fs.S3FileSystem(
             key=os.getenv("AWS_ACCESS_KEY_ID"),
             secret=os.getenv("AWS_SECRET_ACCESS_KEY"),
@@ -23,34 +48,171 @@ class S3FSClient:
     def ls(self, path):
         return self.fs.ls(path)
 
+    def find(self, path, detail=False):
+        """
+        List all files under path; with detail=True, as a dict of path to info, e.g. with 'ETag' and 'size'.
+        """
+        return self.fs.find(path, detail=detail)
+
     def rm(self, path):
-        if path.endswith("prod"):
-            raise PermissionError(
-                f"Permission denied, this filesystem does not allow for removing files "
-                f"from production buckets (with suffix 'prod')"
-            )
-        if not path.startswith(constants.S3_BUCKET):
-            raise PermissionError(
-                f"Permission denied, this filesystem only allows for removing files "
-                f"from the following bucket: '{constants.S3_BUCKET}'"
-            )
-        else:
-            self.fs.rm(path)
+        self._check_permission(path, "removing")
+        self.fs.rm(path)
+
+    def get_many(self, rpaths, lpaths, max_concurrency=32):
+        """
+        Download many files at once, up to max_concurrency concurrently, through s3fs's async layer.
+        Local parent directories are created as needed.
+        :param rpaths: list of S3 paths, e.g. ['bucket/a.json', 'bucket/b.json']
+        :param lpaths: list of local destination paths, one per rpath
+        """
+        rpaths, lpaths = list(rpaths), list(lpaths)
+        if len(rpaths) != len(lpaths):
+            raise ValueError(f"Got {len(rpaths)} S3 paths but {len(lpaths)} local paths")
+        if rpaths:
+            self.fs.get(rpaths, lpaths, batch_size=max_concurrency)
+
+    def put_many(
+        self,
+        lpaths,
+        rpaths,
+        max_concurrency=32,
+        multipart_threshold=MULTIPART_THRESHOLD,
+        part_size=MULTIPART_PART_SIZE,
+    ):
+        """
+        Upload many files at once, up to max_concurrency requests in flight, through s3fs's async layer.
+        Files of at least multipart_threshold bytes are uploaded in parts of part_size bytes, recording progress
+        in a checkpoint file next to the local file ('{lpath}.s3upload.json'); if the upload is interrupted,
+        calling put_many again resumes it and only sends the missing parts. The checkpoint is removed on success.
+        Interrupted uploads keep their parts in S3 until resumed, so the bucket should have a lifecycle rule
+        aborting incomplete multipart uploads.
+        Destinations are subject to the same checks as `rm`.
+        :param lpaths: list of local file paths
+        :param rpaths: list of S3 destination paths, one per lpath
+        :param part_size: bytes per part; S3 requires at least 5MB for all parts but the last
+        """
+        lpaths, rpaths = list(lpaths), list(rpaths)
+        if len(lpaths) != len(rpaths):
+            raise ValueError(f"Got {len(lpaths)} local paths but {len(rpaths)} S3 paths")
+        if part_size < 5 * 1024**2:
+            raise ValueError("S3 multipart uploads require a part_size of at least 5MB")
+        for rpath in rpaths:
+            self._check_permission(rpath, "writing")
+        if lpaths:
+            sync(self.fs.loop, self._put_many, lpaths, rpaths, max_concurrency, multipart_threshold, part_size)
+
+    def rm_many(self, paths):
+        """
+        Remove many files at once, with S3 batch deletes of up to 1000 keys per request.
+        Every path is checked as in `rm` before anything is removed.
+        """
+        paths = list(paths)
+        for path in paths:
+            self._check_permission(path, "removing")
+        paths_by_bucket = {}
+        for path in paths:
+            paths_by_bucket.setdefault(self.fs.split_path(path)[0], []).append(path)
+        for bucket_paths in paths_by_bucket.values():
+            self.fs.rm(bucket_paths)
 
     def dump_df_to_zipped_csv(self, df, filepath):
         with self.fs.open(filepath, "wb") as f:
             df.to_csv(f, index=False, compression="gzip")
 
-    def load_zipped_csv_to_df(self, filepath):
-        with self.fs.open(filepath, "rb") as f:
-            return pd.read_csv(f, compression="gzip")
+    def load_zipped_csv_to_df(self, filepath, use_dtype_schema=False):
+        """
+        With use_dtype_schema=True, parse with the dtypes saved by `dump_dtype_schema`, if there are any.
+        """
+        dtype_schema = self._load_dtype_schema(filepath) if use_dtype_schema else None
+        with self._open_for_read(filepath) as f:
+            return pd.read_csv(f, compression="gzip", **get_read_csv_kwargs(dtype_schema))
 
-    def dump_object_to_pickle(self, obj, filepath):
+    def dump_dtype_schema(self, df, filepath):
+        """
+        Dump the dtypes of a DataFrame, e.g. one optimised with `utils.pandas.optimize_df_memory_usage`,
+        as a small JSON sidecar next to filepath, so that later loads with `use_dtype_schema=True` come out compact.
+        """
+        self.dump_dict_to_json(get_dtype_schema(df), get_dtype_schema_filepath(filepath))
+
+    def dump_df(self, df, filepath, file_format=None, compression=None):
+        """
+        Dump a DataFrame in the format given by the filepath extension, e.g. 'bucket/df.parquet',
+        or by file_format: 'parquet', 'feather', 'excel', 'csv', 'csv.gz'. Defaults to gzipped CSV.
+        :param compression: codec for columnar formats, e.g. 'snappy' or 'zstd'
+        """
+        file_format = infer_df_format(filepath, file_format, default="csv.gz")
         with self.fs.open(filepath, "wb") as f:
-            joblib.dump(obj, f)
+            write_df_to_buffer(df, f, file_format, compression)
+
+    def load_df(self, filepath, file_format=None, columns=None, filters=None):
+        """
+        Load a DataFrame dumped with `dump_df`.
+        Parquet files are read through a seekable S3 file, so with `columns` and `filters`
+        only the needed column chunks and row groups are downloaded.
+        :param columns: optional list of columns to read
+        :param filters: optional parquet row group filters, e.g. [('date', '>=', '2022-01-01')]
+        """
+        file_format = infer_df_format(filepath, file_format, default="csv.gz")
+        with self._open_for_read(filepath) as f:
+            return read_df_from_buffer(f, file_format, columns=columns, filters=filters)
+
+    def iter_df(
+        self, filepath, chunksize=None, chunk_bytes=None, file_format=None, columns=None, use_dtype_schema=False
+    ):
+        """
+        Load a DataFrame in chunks of `chunksize` rows or about `chunk_bytes` bytes of memory each,
+        streaming from S3 instead of downloading the file first. Defaults to gzipped CSV.
+        With use_dtype_schema=True, CSV is parsed with the dtypes saved by `dump_dtype_schema`, if there are any.
+        """
+        file_format = infer_df_format(filepath, file_format, default="csv.gz")
+        dtype_schema = self._load_dtype_schema(filepath) if use_dtype_schema else None
+        with self._open_for_read(filepath) as f:
+            yield from iter_df_chunks_from_buffer(
+                f, file_format, chunksize, chunk_bytes, columns, dtype_schema=dtype_schema
+            )
+
+    def dump_df_chunks(self, chunks, filepath, file_format=None, compression=None, as_parts=False):
+        """
+        Dump an iterable of DataFrames with the same columns, one chunk in memory at a time; appended into
+        a single file, or with as_parts=True, as part files, e.g. 'bucket/df.parquet/part-00000.parquet'.
+        Returns the list of written filepaths.
+        """
+        file_format = infer_df_format(filepath, file_format, default="csv.gz")
+        if not as_parts:
+            with self.fs.open(filepath, "wb") as f:
+                write_df_chunks_to_buffer(chunks, f, file_format, compression)
+            return [filepath]
+        part_filepaths = []
+        for part_number, chunk in enumerate(chunks):
+            part_filepath = get_part_filepath(filepath, part_number, file_format)
+            self.dump_df(chunk, part_filepath, file_format, compression)
+            part_filepaths.append(part_filepath)
+        return part_filepaths
 
-    def load_object_from_pickle(self, filepath):
-        with self.fs.open(filepath, "rb") as f:
+    def dump_object_to_pickle(self, obj, filepath, codec=None, level=None, max_workers=None):
+        """
+        Pickle obj with `utils.serialization.dump_object`: NumPy arrays are kept out-of-band and,
+        with codec='lz4' or 'zstd', compressed in parallel blocks at the given level.
+        Returns the serialisation stats, with write_seconds including the upload, to help choose settings per artefact.
+        """
+        timer = Timer()
+        with self.fs.open(filepath, "wb") as f:
+            stats = dump_object(obj, f, codec=codec, level=level, max_workers=max_workers)
+        stats["write_seconds"] = timer.get_duration_ns() / 1e9 - stats["pickle_seconds"] - stats["compress_seconds"]
+        return stats
+
+    def load_object_from_pickle(self, filepath, use_mmap=False, max_workers=None):
+        """
+        Load an object dumped with `dump_object_to_pickle`, or with joblib by earlier versions of this client.
+        With use_mmap=True the cached local copy is memory-mapped, so uncompressed arrays are not read into memory.
+        """
+        if use_mmap and self.cache is None:
+            raise ValueError("use_mmap=True needs a cache, whose local copy gets memory-mapped")
+        with self._open_for_read(filepath) as f:
+            if is_serialized_object(f):
+                return load_object(f, use_mmap=use_mmap, max_workers=max_workers)
+            if use_mmap:
+                return joblib.load(f.name, mmap_mode="c")
             return joblib.load(f)
 
     def dump_dict_to_json(self, d, filepath):
@@ -60,3 +222,141 @@ class S3FSClient:
     def load_json_to_dict(self, filepath):
         with self.fs.open(filepath, "r") as f:
             return json.load(f)
+
+    @staticmethod
+    def _check_permission(path, operation):
+        """
+        :param operation: what is done to the files, for the error message, e.g. 'removing' or 'writing'
+        """
+        if path.endswith("prod"):
+            raise PermissionError(
+                f"Permission denied, this filesystem does not allow for {operation} files "
+                f"in production buckets (with suffix 'prod')"
+            )
+        if not path.startswith(constants.S3_BUCKET):
+            raise PermissionError(
+                f"Permission denied, this filesystem only allows for {operation} files "
+                f"in the following bucket: '{constants.S3_BUCKET}'"
+            )
+
+    async def _put_many(self, lpaths, rpaths, max_concurrency, multipart_threshold, part_size):
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def put(lpath, rpath):
+            if os.path.getsize(lpath) >= multipart_threshold:
+                await self._put_multipart(lpath, rpath, part_size, semaphore)
+            else:
+                async with semaphore:
+                    await self.fs._put_file(lpath, rpath)
+
+        await asyncio.gather(*(put(lpath, rpath) for lpath, rpath in zip(lpaths, rpaths)))
+
+    async def _put_multipart(self, lpath, rpath, part_size, semaphore):
+        """
+        Resumable multipart upload. The checkpoint only records the upload ID and what it was started for;
+        which parts are already done is read back from S3 with ListParts, so S3 stays the source of truth.
+        """
+        bucket, key, _ = self.fs.split_path(rpath)
+        stat = os.stat(lpath)
+        checkpoint_path = lpath + CHECKPOINT_SUFFIX
+        identity = {
+            "bucket": bucket,
+            "key": key,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "part_size": part_size,
+        }
+        checkpoint = _read_json_if_exists(checkpoint_path)
+        upload_id, done_parts = None, None
+        if checkpoint is not None and all(checkpoint.get(name) == value for name, value in identity.items()):
+            upload_id = checkpoint["upload_id"]
+            done_parts = await self._list_done_parts(bucket, key, upload_id, part_size, stat.st_size)
+        if done_parts is None:
+            # No usable checkpoint: the file changed, the destination differs or the upload was aborted
+            done_parts = {}
+            response = await self.fs._call_s3("create_multipart_upload", Bucket=bucket, Key=key)
+            upload_id = response["UploadId"]
+            _write_json_atomically({**identity, "upload_id": upload_id}, checkpoint_path)
+
+        num_parts = max(-(-stat.st_size // part_size), 1)
+        fd = os.open(lpath, os.O_RDONLY)
+        try:
+
+            async def upload_part(part_number):
+                async with semaphore:
+                    body = os.pread(fd, part_size, (part_number - 1) * part_size)
+                    response = await self.fs._call_s3(
+                        "upload_part", Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body
+                    )
+                return part_number, response["ETag"]
+
+            missing = [n for n in range(1, num_parts + 1) if n not in done_parts]
+            done_parts.update(await asyncio.gather(*(upload_part(n) for n in missing)))
+        finally:
+            os.close(fd)
+
+        parts = [{"PartNumber": n, "ETag": done_parts[n]} for n in sorted(done_parts)]
+        await self.fs._call_s3(
+            "complete_multipart_upload",
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        self.fs.invalidate_cache(rpath)
+        os.remove(checkpoint_path)
+
+    async def _list_done_parts(self, bucket, key, upload_id, part_size, size):
+        """
+        Return {part number: ETag} of the parts of upload_id that are complete, or None if the upload is gone.
+        """
+        done_parts = {}
+        kwargs = {"Bucket": bucket, "Key": key, "UploadId": upload_id}
+        while True:
+            try:
+                response = await self.fs._call_s3("list_parts", **kwargs)
+            except FileNotFoundError:
+                return None
+            for part in response.get("Parts", []):
+                expected_size = min(part_size, size - (part["PartNumber"] - 1) * part_size)
+                if part["Size"] == expected_size:
+                    done_parts[part["PartNumber"]] = part["ETag"]
+            if not response.get("IsTruncated"):
+                return done_parts
+            kwargs["PartNumberMarker"] = response["NextPartNumberMarker"]
+
+    def _open_for_read(self, filepath):
+        """
+        Open filepath for binary reading, through the cache if one is configured.
+        """
+        if self.cache is None:
+            return self.fs.open(filepath, "rb")
+        # Bypass s3fs's listings cache, which may hold an outdated ETag and would serve a stale cache entry
+        info = self.fs.info(filepath, refresh=True)
+
+        def download(fp):
+            with self.fs.open(filepath, "rb") as f:
+                shutil.copyfileobj(f, fp)
+
+        return self.cache.open(f"s3://{filepath}", info["ETag"], info["size"], download)
+
+    def _load_dtype_schema(self, filepath):
+        try:
+            return self.load_json_to_dict(get_dtype_schema_filepath(filepath))
+        except FileNotFoundError:
+            return None
+
+
+def _read_json_if_exists(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_json_atomically(d, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(d, f)
+    os.replace(tmp_path, path)
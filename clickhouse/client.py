@@ -1,30 +1,149 @@
 from bs4 import BeautifulSoup
 from clickhouse_driver import Client
+from clickhouse_driver.protocol import ServerPacketTypes
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
+import numpy as np
+import os
 import pandas as pd
+import queue
 import re
+import threading
+import time
 from tqdm import tqdm
 
 import constants
+from mopy.utils.pandas import write_df_chunks_to_buffer
+from mopy.utils.timing import timed
 
 
-def get_ch_client():
-    with open(constants.CLICKHOUSE_CONFIG_FILEPATH, "r") as f:
+def get_ch_client(**client_kwargs):
+    """
+    Create a client from the config file; client_kwargs override or extend it, e.g. compression="lz4".
+    """
+    return Client(**{**_read_ch_config(constants.CLICKHOUSE_CONFIG_FILEPATH), **client_kwargs})
+
+
+@lru_cache(maxsize=None)
+def _read_ch_config(config_filepath):
+    with open(config_filepath, "r") as f:
         ch_config = f.read()
     ch_config = BeautifulSoup(ch_config, "xml")
-    ch_client = Client(
-        host=ch_config.find("host").text,
-        port=ch_config.find("port").text,
-        user=ch_config.find("user").text,
-        password=ch_config.find("password").text,
-        secure=ch_config.find("secure").text,
-    )
-    return ch_client
+    return {
+        "host": ch_config.find("host").text,
+        "port": ch_config.find("port").text,
+        "user": ch_config.find("user").text,
+        "password": ch_config.find("password").text,
+        "secure": ch_config.find("secure").text,
+    }
+
+
+class ClientPool:
+    """
+    Thread-safe pool of ClickHouse clients. Idle clients are health-checked with a ping before being handed out.
+
+    Usage example:
+        pool = get_ch_pool()
+        with pool.connection() as client:
+            df = query_dataframe_pb(client, "select 1")
+    """
+
+    def __init__(self, max_size=8, client_factory=get_ch_client):
+        """
+        :param max_size: maximum number of idle clients kept open
+        :param client_factory: callable returning a new clickhouse_driver.Client
+        """
+        self.max_size = max_size
+        self.client_factory = client_factory
+        self._idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        try:
+            client = self._idle.get_nowait()
+            if client.connection.connected and not client.connection.ping():
+                client.disconnect()
+        except queue.Empty:
+            client = self.client_factory()
+        try:
+            yield client
+        except Exception:
+            client.disconnect()
+            raise
+        finally:
+            if self._idle.qsize() < self.max_size:
+                self._idle.put(client)
+            else:
+                client.disconnect()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().disconnect()
+            except queue.Empty:
+                return
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_ch_pool(max_size=None):
+    """
+    Return the process-wide ClientPool, creating it on first use and again in forked child processes.
+    :param max_size: size of the pool when it is created, 8 by default; raises if the existing pool has another size
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ClientPool(max_size=max_size or 8)
+            _pool_pid = os.getpid()
+        elif max_size is not None and max_size != _pool.max_size:
+            raise ValueError(f"The ClickHouse pool already exists with max_size={_pool.max_size}, not {max_size}")
+        return _pool
 
 
 def get_table_colnames(client, db, table):
     return [i[0] for i in client.execute(f"describe {db}.{table}")]
 
 
+_table_colnames_cache = {}
+
+
+def _get_table_colnames_cached(client, db, table):
+    key = (client.connection.host, db, table)
+    if key not in _table_colnames_cache:
+        _table_colnames_cache[key] = get_table_colnames(client, db, table)
+    return _table_colnames_cache[key]
+
+
+@timed("clickhouse.insert_dataframe")
+def insert_dataframe(client, df, db, table, block_size=100_000, progress=True):
+    """
+    Insert a pd.DataFrame into an existing table, sending it in columnar blocks of block_size rows over
+    the native protocol; create the client with compression="lz4" to compress them.
+    Column names are validated against the table's columns, which are looked up once per table.
+    :return: dict with the number of inserted rows, elapsed seconds and rows per second
+    """
+    table_colnames = _get_table_colnames_cached(client, db, table)
+    unknown_colnames = [col for col in df.columns if col not in table_colnames]
+    if unknown_colnames:
+        raise ValueError(f"Columns {unknown_colnames} do not exist in table {db}.{table}")
+    query = f"INSERT INTO {db}.{table} ({', '.join(f'`{col}`' for col in df.columns)}) VALUES"
+    start = time.monotonic()
+    with tqdm(total=len(df), desc=f"Inserting data into {db}.{table}", unit=" rows", disable=not progress) as pbar:
+        for offset in range(0, len(df), block_size):
+            block = df.iloc[offset : offset + block_size]
+            client.execute(query, [block[col].tolist() for col in df.columns], columnar=True)
+            pbar.update(len(block))
+    seconds = time.monotonic() - start
+    return {"rows": len(df), "seconds": seconds, "rows_per_sec": len(df) / seconds if seconds else float("inf")}
+
+
+@timed("clickhouse.query_dataframe_pb")
 def query_dataframe_pb(client, query):
     """
     Prints progress bar on query execution and parses query output to pd.DataFrame.
@@ -40,4 +159,144 @@ def query_dataframe_pb(client, query):
         pbar.update(num_rows - pbar.n)
     pbar.close()
     data, columns = progress.get_result()
-    return pd.DataFrame({re.sub(r"\W", "_", col[0]): d for d, col in zip(data, columns)})
+    return _columnar_to_dataframe(data, columns)
+
+
+@timed("clickhouse.query_dataframes_parallel")
+def query_dataframes_parallel(queries, pool=None, max_workers=8):
+    """
+    Run queries concurrently over pooled connections and concatenate their outputs, in the order of queries.
+    Useful for splitting one large query into e.g. date-partitioned slices.
+    :param queries: list of query strings returning the same columns
+    :param pool: ClientPool to take connections from; defaults to the process-wide pool
+    """
+    pool = pool or get_ch_pool()
+
+    def run_query(query):
+        with pool.connection() as client:
+            data, columns = client.execute(query, columnar=True, with_column_types=True)
+        return _columnar_to_dataframe(data, columns)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = list(tqdm(executor.map(run_query, queries), total=len(queries), desc="Querying data from ClickHouse"))
+    return pd.concat(dfs, ignore_index=True)
+
+
+def iter_query_chunks(client, query, chunk_size=100_000, as_numpy=False, settings=None, progress=True):
+    """
+    Stream query output in chunks of up to chunk_size rows, built column by column from the blocks the driver
+    receives from the server, instead of collecting the whole result first. Column names are sanitised as in
+    query_dataframe_pb. An empty result yields one empty chunk with the query's columns and their dtypes.
+    :param as_numpy: if True, yield dicts of column name to np.ndarray instead of pd.DataFrames
+    :param settings: extra ClickHouse settings; max_block_size defaults to chunk_size
+    """
+    settings = {"max_block_size": chunk_size, **(settings or {})}
+    blocks = _iter_column_blocks(client, query, settings)
+    columns_with_types, first_columns = next(blocks, (None, None))
+    if columns_with_types is None:
+        return
+    colnames = [_sanitize_colname(name) for name, _ in columns_with_types]
+    pbar = tqdm(desc="Streaming data from ClickHouse", unit=" rows", disable=not progress)
+    try:
+        num_rows = 0
+        for columns in _regroup_columns(chain([first_columns], (columns for _, columns in blocks)), chunk_size):
+            num_rows += len(columns[0])
+            pbar.update(len(columns[0]))
+            yield _columns_to_chunk(colnames, columns, as_numpy)
+        if num_rows == 0:
+            dtypes = [_get_clickhouse_dtype(ch_type) for _, ch_type in columns_with_types]
+            yield _columns_to_chunk(colnames, [np.empty(0, dtype=dtype) for dtype in dtypes], as_numpy)
+    finally:
+        pbar.close()
+
+
+@timed("clickhouse.query_to_parquet")
+def query_to_parquet(client, query, filepath, chunk_size=100_000, compression="snappy", settings=None):
+    """
+    Stream query output straight into a local Parquet file, one row group per chunk,
+    so that only one chunk is held in memory at a time.
+    :return: Number of rows written.
+    """
+    chunks = iter_query_chunks(client, query, chunk_size=chunk_size, settings=settings)
+    with open(filepath, "wb") as f:
+        return write_df_chunks_to_buffer(chunks, f, "parquet", compression)
+
+
+def _iter_column_blocks(client, query, settings):
+    """
+    Run a query and yield (columns with types, list of columns) for each data block received, as they arrive.
+    The server first sends an empty block, so the column types are known even when the result is empty. Totals and
+    extremes blocks are left out. Closing the generator early drops the connection, which still has unread packets.
+    """
+    with client.disconnect_on_error(query, settings):
+        client.connection.send_query(query)
+        client.connection.send_external_tables(None)
+        try:
+            for packet in client.packet_generator():
+                if packet.type == ServerPacketTypes.DATA and packet.block.columns_with_types:
+                    block = packet.block
+                    yield block.columns_with_types, list(block.get_columns()) if block.num_rows else None
+        except GeneratorExit:
+            client.disconnect()
+            raise
+
+
+def _regroup_columns(blocks, chunk_size):
+    """
+    Regroup blocks given as lists of columns into chunks of chunk_size rows, and a last one of the rest.
+    Columns are concatenated as they come, lists by chaining and NumPy arrays (with use_numpy) by np.concatenate.
+    """
+    buffered, num_buffered = [], 0
+    for columns in blocks:
+        if columns is None:
+            continue
+        buffered.append(columns)
+        num_buffered += len(columns[0])
+        while num_buffered >= chunk_size:
+            merged = _concat_columns(buffered)
+            yield [column[:chunk_size] for column in merged]
+            buffered, num_buffered = [[column[chunk_size:] for column in merged]], num_buffered - chunk_size
+    if num_buffered:
+        yield _concat_columns(buffered)
+
+
+def _concat_columns(blocks):
+    if len(blocks) == 1:
+        return blocks[0]
+    return [
+        np.concatenate(parts) if isinstance(parts[0], np.ndarray) else list(chain.from_iterable(parts))
+        for parts in zip(*blocks)
+    ]
+
+
+def _columns_to_chunk(colnames, columns, as_numpy):
+    if as_numpy:
+        return {colname: np.asarray(values) for colname, values in zip(colnames, columns)}
+    return pd.DataFrame(dict(zip(colnames, columns)))
+
+
+def _get_clickhouse_dtype(ch_type):
+    """
+    NumPy dtype that the driver's values of a ClickHouse type end up as in a DataFrame, for empty results.
+    """
+    ch_type = re.sub(r"^LowCardinality\((.*)\)$", r"\1", ch_type)
+    nullable = ch_type.startswith("Nullable(")
+    ch_type = re.sub(r"^Nullable\((.*)\)$", r"\1", ch_type)
+    if re.match(r"^U?Int(8|16|32|64)$", ch_type):
+        # Missing values turn integer columns into floats
+        return "float64" if nullable else ch_type.lower()
+    if ch_type in ("Float32", "Float64"):
+        return ch_type.lower()
+    if ch_type == "Bool" and not nullable:
+        return "bool"
+    if ch_type.startswith("DateTime"):
+        return "datetime64[ns]"
+    return "object"
+
+
+def _columnar_to_dataframe(data, columns):
+    return pd.DataFrame({_sanitize_colname(col[0]): d for d, col in zip(data, columns)})
+
+
+def _sanitize_colname(colname):
+    return re.sub(r"\W", "_", colname)
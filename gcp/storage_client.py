@@ -1,17 +1,46 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import glob
+from itertools import chain
 import json
 import os
 from pathlib import Path
 import tempfile
+import time
 
+import google_crc32c
 import pandas as pd
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 from PIL import Image
 import torch
 
+from mopy.torch.weights import (
+    build_on_meta,
+    get_state_dict,
+    materialize_buffers,
+    read_tensors,
+    split_into_shards,
+    write_tensors,
+)
 from mopy.utils.log import logger
+from mopy.utils.pandas import (
+    get_dtype_schema,
+    get_dtype_schema_filepath,
+    get_part_filepath,
+    get_read_csv_kwargs,
+    infer_df_format,
+    iter_df_chunks_from_buffer,
+    read_df_from_buffer,
+    write_df_chunks_to_buffer,
+    write_df_to_buffer,
+)
+from mopy.utils.timing import timed_methods
 
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
 
+
+@timed_methods("gcs")
 class StorageClient:
     """
     Google Cloud Storage client with ready-made methods for loading and saving data, plus other utils
@@ -28,12 +57,29 @@ class StorageClient:
 
         # save the image back to a different location
         storage_client.write_image(img, 'data/new_image.jpg')
+
+        # push a whole folder with 16 parallel workers, skipping files that are already up to date
+        storage_client.upload_folder('data/shards', max_workers=16, skip_unchanged=True)
+
+    To run against a local fake-GCS server, either set the STORAGE_EMULATOR_HOST environment variable
+    or pass a pre-configured `storage.Client` as `client`.
+
+    Pass a `utils.cache.DiskCache` as `cache` to serve repeated reads from local disk; each cached read
+    then costs a single metadata call to check the blob's generation.
     """
 
-    def __init__(self, bucket_name):
-        self.client = storage.Client()
+    def __init__(self, bucket_name, client=None, spool_max_size=SPOOL_MAX_SIZE, cache=None):
+        """
+        :param bucket_name: name of the bucket to operate on
+        :param client: optional pre-configured `storage.Client`; a default one is created if not given
+        :param spool_max_size: payloads up to this many bytes are buffered in memory, larger ones spill to disk
+        :param cache: optional `utils.cache.DiskCache` used as a read-through cache for downloads
+        """
+        self.client = client or storage.Client()
         self.bucket_name = bucket_name
         self.bucket = self.client.bucket(bucket_name)
+        self.spool_max_size = spool_max_size
+        self.cache = cache
 
     def ls_recursive(self, path=None):
         """
@@ -53,9 +99,7 @@ class StorageClient:
         Load an image file from Storage to a PIL Image.
         :param filepath: str, e.g. 'data/image.jpg'
         """
-        with tempfile.TemporaryFile() as fp:
-            gs_filepath = f"gs://{self.bucket_name}/{filepath}"
-            self.client.download_blob_to_file(gs_filepath, fp)
+        with self._download_to_spool(filepath) as fp:
             img = Image.open(fp)
             img.load()
         return img
@@ -67,19 +111,9 @@ class StorageClient:
         :param filepath: destination filepath including extension, e.g. 'data/image.jpg'
         :param force_overwrite: if True, existing file on Storage will be overwritten
         """
-        destination_exists = self.exists(filepath)
-        if destination_exists and not force_overwrite:
-            logger.error(f"Destination {filepath} exists on Storage. Set `force_overwrite=True` to overwrite it.")
-            raise Exception(f"destination {filepath} exists")
-        else:
-            if destination_exists and force_overwrite:
-                logger.info(f"Overwriting an existing file: {filepath}")
-            blob = self.bucket.blob(filepath)
-            extension = Path(filepath).suffix
-            with tempfile.TemporaryDirectory() as dp:
-                temp_filepath = os.path.join(dp, f"myfile{extension}")
-                img.save(temp_filepath)
-                blob.upload_from_filename(temp_filepath)
+        self._check_destination(filepath, force_overwrite)
+        image_format = Image.registered_extensions()[Path(filepath).suffix.lower()]
+        self._upload_from_spool(filepath, lambda fp: img.save(fp, format=image_format))
 
     def load_json_to_dict(self, filepath):
         """
@@ -96,20 +130,15 @@ class StorageClient:
         :param filepath: str, e.g. 'data/my_json.json'
         """
         blob = self.bucket.blob(filepath)
-        with tempfile.TemporaryDirectory() as dp:
-            temp_filepath = os.path.join(dp, "tempfile.json")
-            with open(temp_filepath, "w") as f:
-                json.dump(dic, f)
-            blob.upload_from_filename(temp_filepath)
+        blob.upload_from_string(json.dumps(dic), content_type="application/json")
 
     def load_torch_model(self, filepath, map_location=None):
         """
         Load a torch model from a .pt or .pth file to its proper model class, e.g. torchvision.models.resnet.ResNet
+        For faster cold starts, save the weights with `save_torch_state_dict` and load them with `load_torch_state_dict`.
         :param filepath: str, e.g. 'models/model.pt'
         """
-        with tempfile.NamedTemporaryFile() as fp:
-            blob = self.bucket.blob(filepath)
-            blob.download_to_filename(fp.name)
+        with self._download_to_spool(filepath) as fp:
             model = torch.load(fp, map_location=map_location)
         return model
 
@@ -118,23 +147,39 @@ class StorageClient:
         Load an excel file to the DataFrame.
         :param filepath: a path to the excel file
         """
-        with tempfile.NamedTemporaryFile() as fp:
-            blob = self.bucket.blob(filepath)
-            blob.download_to_filename(fp.name)
+        with self._download_to_spool(filepath) as fp:
             df = pd.read_excel(fp)
         return df
 
-    def load_csv(self, filepath):
+    def load_csv(self, filepath, use_dtype_schema=False):
         """
         Load an CSV file to a pd.DataFrame.
+        Without a cache, the blob is streamed in chunks straight into the parser.
         :param filepath: a path to the CSV file
+        :param use_dtype_schema: if True, parse with the dtypes saved by `save_dtype_schema`, if there are any
         """
-        with tempfile.NamedTemporaryFile() as fp:
-            blob = self.bucket.blob(filepath)
-            blob.download_to_filename(fp.name)
-            df = pd.read_csv(fp)
+        dtype_schema = self._load_dtype_schema(filepath) if use_dtype_schema else None
+        with self._open_cached(filepath) if self.cache else self.bucket.blob(filepath).open("rb") as fp:
+            df = pd.read_csv(fp, **get_read_csv_kwargs(dtype_schema))
         return df
 
+    def save_dtype_schema(self, df, filepath):
+        """
+        Save the dtypes of a DataFrame, e.g. one optimised with `utils.pandas.optimize_df_memory_usage`,
+        as a small JSON sidecar next to filepath, so that later loads with `use_dtype_schema=True` come out compact.
+        :param df: A pd.DataFrame loaded from filepath
+        :param filepath: a path to the data file, e.g. 'data/extract.csv'
+        """
+        self.save_dict_to_json(get_dtype_schema(df), get_dtype_schema_filepath(filepath))
+
+    def _load_dtype_schema(self, filepath):
+        blob = self.bucket.blob(get_dtype_schema_filepath(filepath))
+        try:
+            return json.loads(blob.download_as_bytes())
+        except NotFound:
+            logger.info(f"No dtype schema found for {filepath}, loading with inferred dtypes")
+            return None
+
     def save_torch_model(self, model, filepath, force_overwrite=False):
         """
         Save a torch model to a .pt or .pth file to its proper model class, e.g. torchvision.models.resnet.ResNet
@@ -142,51 +187,217 @@ class StorageClient:
         :param filepath: str, e.g. 'models/model.pt'
         :param force_overwrite: if True, existing file on Storage will be overwritten
         """
-        destination_exists = self.exists(filepath)
-        if destination_exists and not force_overwrite:
-            logger.error(f"Destination {filepath} exists on Storage. Set `force_overwrite=True` to overwrite it.")
-            raise Exception(f"destination {filepath} exists")
+        self._check_destination(filepath, force_overwrite)
+        self._upload_from_spool(filepath, lambda fp: torch.save(model, fp))
+
+    def save_torch_state_dict(self, model, filepath, force_overwrite=False, max_shard_size=None, max_workers=8):
+        """
+        Save the weights of a torch model in the memory-mappable safetensors format, for `load_torch_state_dict`.
+        Tensors sharing memory, e.g. tied embeddings, are stored once.
+        :param model: A PyTorch model or its state_dict
+        :param filepath: str, e.g. 'models/model.safetensors'
+        :param force_overwrite: if True, existing file on Storage will be overwritten
+        :param max_shard_size: if set, split the weights into shards of at most this many bytes, uploaded in parallel,
+            e.g. 'models/model-00001-of-00004.safetensors', listed in 'models/model.safetensors.index.json'
+        :return: filepath to load the weights from: filepath itself, or the index of the shards
+        """
+        tensors, aliases = get_state_dict(model)
+        metadata = {"format": "pt", "aliases": json.dumps(aliases)}
+        shards = split_into_shards(tensors, max_shard_size) if max_shard_size else [tensors]
+        if len(shards) == 1:
+            self._check_destination(filepath, force_overwrite)
+            self._upload_from_spool(filepath, lambda fp: write_tensors(tensors, fp, metadata))
+            return filepath
+
+        index_filepath = f"{filepath}.index.json"
+        self._check_destination(index_filepath, force_overwrite)
+        stem = filepath[: -len(".safetensors")] if filepath.endswith(".safetensors") else filepath
+        shard_filepaths = [f"{stem}-{i + 1:05d}-of-{len(shards):05d}.safetensors" for i in range(len(shards))]
+
+        def upload(shard, shard_filepath):
+            self._upload_from_spool(shard_filepath, lambda fp: write_tensors(shard, fp, metadata))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(upload, shards, shard_filepaths))
+        # The index goes last, so that it never points to shards that are not uploaded yet
+        weight_map = {name: os.path.basename(p) for shard, p in zip(shards, shard_filepaths) for name in shard}
+        total_size = sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+        self.save_dict_to_json({"metadata": {"total_size": total_size}, "weight_map": weight_map}, index_filepath)
+        return index_filepath
+
+    def load_torch_state_dict(self, filepath, model_cls=None, model_kwargs=None, device="cpu", max_workers=8):
+        """
+        Load weights saved with `save_torch_state_dict`. Files are memory-mapped from the cache or a temporary file
+        instead of unpickled, so on CPU the tensors are used in place and only read from disk when touched.
+        Shards are downloaded in parallel, and each one is mapped and moved to device as soon as it arrives.
+        With model_cls, the model is built on the meta device, so no memory or time goes into initial weights
+        that would be overwritten, and the loaded tensors are assigned to it as they are. Buffers not in the checkpoint,
+        e.g. non-persistent ones, are built on device as model_cls creates them.
+        :param filepath: str, e.g. 'models/model.safetensors', or 'models/model.safetensors.index.json' if sharded
+        :param model_cls: optional nn.Module class to load the weights into, e.g. torchvision.models.resnet.ResNet
+        :param model_kwargs: keyword arguments of model_cls
+        :param device: device to load the weights to, e.g. 'cuda'
+        :param max_workers: number of shards downloaded concurrently
+        :return: the model if model_cls is given, the state_dict otherwise
+        """
+        if filepath.endswith(".index.json"):
+            weight_map = self.load_json_to_dict(filepath)["weight_map"]
+            dirname = os.path.dirname(filepath)
+            shard_filepaths = sorted({os.path.join(dirname, name) for name in weight_map.values()})
         else:
-            if destination_exists and force_overwrite:
-                logger.info(f"Overwriting an existing file: {filepath}")
-            blob = self.bucket.blob(filepath)
-            extension = Path(filepath).suffix
-            with tempfile.TemporaryDirectory() as dp:
-                temp_filepath = os.path.join(dp, f"myfile{extension}")
-                torch.save(model, temp_filepath)
-                blob.upload_from_filename(temp_filepath)
+            shard_filepaths = [filepath]
+
+        state_dict, aliases = {}, {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._download_to_file, shard_filepath) for shard_filepath in shard_filepaths]
+            for future in as_completed(futures):
+                with future.result() as fp:
+                    tensors, metadata = read_tensors(fp)
+                state_dict.update((name, tensor.to(device)) for name, tensor in tensors.items())
+                aliases.update(json.loads(metadata.get("aliases", "{}")))
+        for name, target in aliases.items():
+            state_dict[name] = state_dict[target]
+        if model_cls is None:
+            return state_dict
 
-    def save_df(self, df, filepath, force_overwrite=False):
+        model = build_on_meta(model_cls, **(model_kwargs or {}))
+        model.load_state_dict(state_dict, assign=True)
+        materialize_buffers(model, model_cls, model_kwargs or {}, device=device)
+        on_meta = [name for name, tensor in chain(model.named_parameters(), model.named_buffers()) if tensor.is_meta]
+        if on_meta:
+            raise ValueError(f"Tensors missing from the checkpoint and not created by {model_cls.__name__}: {on_meta}")
+        return model
+
+    def save_df(self, df, filepath, force_overwrite=False, file_format=None, compression=None):
         """
         Save pandas DataFrame into Storage.
         :param df: A pd.DataFrame
-        :param filepath: str
+        :param filepath: str; the extension selects the format, e.g. 'data/df.parquet', defaulting to Excel
         :param force_overwrite: if True, existing file on Storage will be overwritten
+        :param file_format: overrides the format inferred from filepath: 'parquet', 'feather', 'excel', 'csv', 'csv.gz'
+        :param compression: codec for columnar formats, e.g. 'snappy' or 'zstd'
+        """
+        self._check_destination(filepath, force_overwrite)
+        file_format = infer_df_format(filepath, file_format)
+        self._upload_from_spool(filepath, lambda fp: write_df_to_buffer(df, fp, file_format, compression))
+
+    def read_df(self, filepath, file_format=None, columns=None, filters=None):
+        """
+        Read pandas DataFrame from Storage.
+        Parquet and Feather files are read through a seekable blob stream, so with `columns` and `filters`
+        only the needed column chunks and row groups are downloaded.
+        :param filepath: str; the extension selects the format, e.g. 'data/df.parquet', defaulting to Excel
+        :param file_format: overrides the format inferred from filepath: 'parquet', 'feather', 'excel', 'csv', 'csv.gz'
+        :param columns: optional list of columns to read
+        :param filters: optional parquet row group filters, e.g. [('date', '>=', '2022-01-01')]
+        """
+        file_format = infer_df_format(filepath, file_format)
+        if file_format in ("parquet", "feather") and not self.cache:
+            fp = self.bucket.blob(filepath).open("rb")
+        else:
+            fp = self._download_to_spool(filepath)
+        with fp:
+            df = read_df_from_buffer(fp, file_format, columns=columns, filters=filters)
+        return df
+
+    def iter_df(
+        self, filepath, chunksize=None, chunk_bytes=None, file_format=None, columns=None, use_dtype_schema=False
+    ):
+        """
+        Read pandas DataFrame from Storage in chunks, streaming the blob instead of downloading it first.
+        :param filepath: str; CSV (optionally gzipped), Parquet or Feather, by extension, defaulting to CSV
+        :param chunksize: number of rows per chunk
+        :param chunk_bytes: approximate in-memory size of a chunk in bytes, used if chunksize is not given
+        :param file_format: overrides the format inferred from filepath: 'parquet', 'feather', 'csv', 'csv.gz'
+        :param columns: optional list of columns to read
+        :param use_dtype_schema: if True, parse CSV with the dtypes saved by `save_dtype_schema`, if there are any
+        :return: generator of pd.DataFrames
+        """
+        file_format = infer_df_format(filepath, file_format, default="csv")
+        dtype_schema = self._load_dtype_schema(filepath) if use_dtype_schema else None
+        with self._open_cached(filepath) if self.cache else self.bucket.blob(filepath).open("rb") as fp:
+            yield from iter_df_chunks_from_buffer(
+                fp, file_format, chunksize, chunk_bytes, columns, dtype_schema=dtype_schema
+            )
+
+    def save_df_chunks(
+        self, chunks, filepath, force_overwrite=False, file_format=None, compression=None, as_parts=False
+    ):
+        """
+        Save an iterable of pandas DataFrames with the same columns into Storage, one chunk in memory at a time.
+        :param chunks: iterable of pd.DataFrames, e.g. a generator
+        :param filepath: str; CSV (optionally gzipped), Parquet or Feather, by extension, defaulting to CSV
+        :param force_overwrite: if True, existing file on Storage will be overwritten
+        :param file_format: overrides the format inferred from filepath: 'parquet', 'feather', 'csv', 'csv.gz'
+        :param compression: codec for columnar formats, e.g. 'snappy' or 'zstd'
+        :param as_parts: if False, chunks are appended into a single blob through a streaming upload;
+        if True, each chunk is saved as a separate part file, e.g. 'data/df.parquet/part-00000.parquet'
+        :return: list of saved filepaths
+        """
+        file_format = infer_df_format(filepath, file_format, default="csv")
+        if not as_parts:
+            self._check_destination(filepath, force_overwrite)
+            with self.bucket.blob(filepath).open("wb") as fp:
+                write_df_chunks_to_buffer(chunks, fp, file_format, compression)
+            return [filepath]
+        part_filepaths = []
+        for part_number, chunk in enumerate(chunks):
+            part_filepath = get_part_filepath(filepath, part_number, file_format)
+            self.save_df(chunk, part_filepath, force_overwrite, file_format, compression)
+            part_filepaths.append(part_filepath)
+        return part_filepaths
+
+    def _check_destination(self, filepath, force_overwrite):
+        """
+        Raise if filepath exists on Storage and force_overwrite is False.
         """
         destination_exists = self.exists(filepath)
         if destination_exists and not force_overwrite:
             logger.error(f"Destination {filepath} exists on Storage. Set `force_overwrite=True` to overwrite it.")
             raise Exception(f"destination {filepath} exists")
-        else:
-            if destination_exists and force_overwrite:
-                logger.info(f"Overwriting an existing file: {filepath}")
-            blob = self.bucket.blob(filepath)
-            extension = Path(filepath).suffix
-            with tempfile.TemporaryDirectory() as dp:
-                temp_filepath = os.path.join(dp, f"myfile{extension}")
-                df.to_excel(temp_filepath, index=False)
-                blob.upload_from_filename(temp_filepath)
+        if destination_exists and force_overwrite:
+            logger.info(f"Overwriting an existing file: {filepath}")
 
-    def read_df(self, filepath):
+    def _download_to_spool(self, filepath):
         """
-        Read pandas DataFrame from Storage.
-        :param filepath: str
+        Download a blob to a seekable buffer that is kept in memory up to `spool_max_size` bytes
+        and spilled to disk once, above it. If a cache is configured, the cached file is returned instead.
         """
-        with tempfile.NamedTemporaryFile() as fp:
-            blob = self.bucket.blob(filepath)
-            blob.download_to_filename(fp.name)
-            df = pd.read_excel(fp)
-        return df
+        if self.cache:
+            return self._open_cached(filepath)
+        fp = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+        self.bucket.blob(filepath).download_to_file(fp)
+        fp.seek(0)
+        return fp
+
+    def _download_to_file(self, filepath):
+        """
+        Download a blob to an anonymous temporary file on disk, which unlike a spool can be memory-mapped.
+        If a cache is configured, the cached file is returned instead.
+        """
+        if self.cache:
+            return self._open_cached(filepath)
+        fp = tempfile.TemporaryFile()
+        self.bucket.blob(filepath).download_to_file(fp)
+        fp.seek(0)
+        return fp
+
+    def _open_cached(self, filepath):
+        """
+        Open the blob through the cache, revalidating it with a single metadata call.
+        """
+        blob = self.bucket.get_blob(filepath)
+        if blob is None:
+            raise FileNotFoundError(f"gs://{self.bucket_name}/{filepath}")
+        return self.cache.open(f"gs://{self.bucket_name}/{filepath}", blob.generation, blob.size, blob.download_to_file)
+
+    def _upload_from_spool(self, filepath, write_fn):
+        """
+        Serialise with write_fn(fp) into a buffer that spills to disk above `spool_max_size` bytes, then upload it.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_max_size) as fp:
+            write_fn(fp)
+            self.bucket.blob(filepath).upload_from_file(fp, rewind=True)
 
     def upload_file(self, filepath, force_overwrite=False):
         """
@@ -194,24 +405,113 @@ class StorageClient:
         :param filepath: str, e.g. 'models/model.pt'
         :param force_overwrite: if True, existing file on Storage will be overwritten
         """
-        destination_exists = self.exists(filepath)
-        if destination_exists and not force_overwrite:
-            logger.error(f"Destination {filepath} exists on Storage. Set `force_overwrite=True` to overwrite it.")
-            raise Exception(f"destination {filepath} exists")
-        else:
-            if destination_exists and force_overwrite:
-                logger.info(f"Overwriting an existing file: {filepath}")
-            blob = self.bucket.blob(filepath)
-            blob.upload_from_filename(filepath)
+        self._check_destination(filepath, force_overwrite)
+        self.bucket.blob(filepath).upload_from_filename(filepath)
 
-    def upload_folder(self, folder_dir):
+    def upload_folder(self, folder_dir, max_workers=8, max_retries=3, skip_unchanged=False, force_overwrite=False):
         """
-        Upload a whole folder to the GCP.
+        Upload a whole folder to the GCP, using a pool of parallel workers.
+        Existing blobs are looked up with a single listing of the folder prefix instead of a HEAD request per file.
 
         :param folder_dir: Directory to the folder to upload.
-        :return:
+        :param max_workers: Number of files uploaded concurrently.
+        :param max_retries: Number of times a failed upload is retried, with exponential backoff.
+        :param skip_unchanged: if True, files whose size and CRC32C match the existing blob are not uploaded again
+        :param force_overwrite: if True, existing files on Storage will be overwritten
+        :return: list of uploaded filepaths
         """
         rel_paths = glob.glob(os.path.join(folder_dir, "**"), recursive=True)
-        for file_path in rel_paths:
-            if os.path.isfile(file_path):
-                self.upload_file(file_path)
+        file_paths = [file_path for file_path in rel_paths if os.path.isfile(file_path)]
+        prefix = folder_dir.rstrip("/") + "/"
+        remote_blobs = {blob.name: blob for blob in self.client.list_blobs(self.bucket_name, prefix=prefix)}
+
+        to_upload = []
+        for file_path in file_paths:
+            remote_blob = remote_blobs.get(file_path)
+            if remote_blob is None:
+                to_upload.append(file_path)
+            elif skip_unchanged and _is_same_file(file_path, remote_blob):
+                logger.debug(f"Skipping unchanged file: {file_path}")
+            elif not force_overwrite:
+                logger.error(f"Destination {file_path} exists on Storage. Set `force_overwrite=True` to overwrite it.")
+                raise Exception(f"destination {file_path} exists")
+            else:
+                logger.info(f"Overwriting an existing file: {file_path}")
+                to_upload.append(file_path)
+
+        def upload(file_path):
+            _call_with_retries(self.bucket.blob(file_path).upload_from_filename, file_path, max_retries=max_retries)
+
+        logger.info(f"Uploading {len(to_upload)} of {len(file_paths)} files from {folder_dir}")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(upload, to_upload))
+        return to_upload
+
+    def download_folder(self, folder_dir, local_dir, max_workers=8, max_retries=3, skip_unchanged=False):
+        """
+        Download all blobs under a Storage prefix to a local directory, using a pool of parallel workers.
+
+        :param folder_dir: Storage prefix to download, e.g. 'data/shards'
+        :param local_dir: Local directory to download to; the structure below `folder_dir` is preserved.
+        :param max_workers: Number of files downloaded concurrently.
+        :param max_retries: Number of times a failed download is retried, with exponential backoff.
+        :param skip_unchanged: if True, local files whose size and CRC32C match the blob are not downloaded again
+        :return: list of downloaded local filepaths
+        """
+        # List the folder's contents only, and not e.g. 'data/shards2' for 'data/shards'
+        prefix = folder_dir.rstrip("/") + "/"
+        to_download = []
+        for blob in self.client.list_blobs(self.bucket_name, prefix=prefix):
+            if blob.name.endswith("/"):
+                continue
+            local_path = os.path.join(local_dir, blob.name[len(prefix) :])
+            if skip_unchanged and os.path.isfile(local_path) and _is_same_file(local_path, blob):
+                logger.debug(f"Skipping unchanged file: {local_path}")
+                continue
+            to_download.append((blob, local_path))
+
+        def download(blob_and_path):
+            blob, local_path = blob_and_path
+            os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+            _call_with_retries(blob.download_to_filename, local_path, max_retries=max_retries)
+            return local_path
+
+        logger.info(f"Downloading {len(to_download)} files from {folder_dir}")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(download, to_download))
+
+
+def _call_with_retries(fn, *args, max_retries=3, backoff=1.0):
+    """
+    Call fn(*args), retrying up to max_retries times with exponential backoff.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * 2**attempt
+            logger.warning(f"Attempt {attempt + 1} of {fn.__name__}{args} failed with {e!r}, retrying in {delay}s")
+            time.sleep(delay)
+
+
+def _local_crc32c(filepath, chunk_size=1024 * 1024):
+    """
+    Compute the base64-encoded CRC32C of a local file, in the format used by `storage.Blob.crc32c`.
+    """
+    checksum = google_crc32c.Checksum()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+def _is_same_file(filepath, blob):
+    """
+    Return True if the local file has the same size and CRC32C as the blob's listing metadata.
+    Blobs without a CRC32C, e.g. from some emulators, are never considered the same.
+    """
+    if blob.crc32c is None or os.path.getsize(filepath) != blob.size:
+        return False
+    return _local_crc32c(filepath) == blob.crc32c
@@ -1,28 +1,39 @@
+import numpy as np
 import pandas as pd
 import math
 
 
-def get_parallelizing_rotation(near_table_path, angle_method="PLANAR"):
+def get_parallelizing_rotation(near_table_path, angle_method="PLANAR", by_feature_id=False, chunksize=1_000_000):
     """
     Compute rotation angle to be applied to each rectangle defined as a single row of near_table,
     so that the rotated polygon's longer side is parallel to the near feature line given in near_table.
-    :param near_table_path: String; path to the CSV file as returned by arcpy.GenerateNearTable_analysis()
+    :param near_table_path: String; path to the CSV file as returned by arcpy.GenerateNearTable_analysis(),
+    or a pd.DataFrame as returned by SegmentIndex.generate_near_table()
     :param angle_method: Method that was used by arcpy.GenerateNearTable_analysis() to generate near_table;
-    "PLANAR" or "GEODESIC"
-    :return: A list with required rotation angles.
-    """
-    # Read in near table data
-    near_table = pd.read_csv(near_table_path, sep=";")
-    # Extract & clean angles of the line connecting rectangle's centroid and nearest point on the near feature line
-    angles = near_table.loc[near_table["NEAR_RANK"] == 1].NEAR_ANGLE.tolist()
-    angles = [float(a) for a in [b.replace(",", ".") for b in angles]]
-    # Compute required rotation angles
-    if angle_method == "PLANAR":
-        req_rot = [a + 360 if a < 0 else a for a in angles]
-    elif angle_method == "GEODESIC":
-        raise Exception("Method GEODESIC is not supported yet. Recompute near_table using PLANAR method.")
-    else:
+    "PLANAR" (angles counterclockwise from east) or "GEODESIC" (angles clockwise from north)
+    :param by_feature_id: If True, return a pd.Series of angles indexed by the input feature ID (IN_FID).
+    :param chunksize: Number of near table rows parsed at a time.
+    :return: A NumPy array with required rotation angles in degrees, in <0, 360).
+    """
+    if angle_method not in ("PLANAR", "GEODESIC"):
         raise Exception("Unsupported angle_method provided. Available methods are 'PLANAR' and 'GEODESIC'.")
+    # Read in near table data, keeping only the nearest feature's angle of each rectangle
+    usecols = ["NEAR_RANK", "NEAR_ANGLE"] + (["IN_FID"] if by_feature_id else [])
+    if isinstance(near_table_path, pd.DataFrame):
+        chunks = [near_table_path[usecols]]
+    else:
+        chunks = pd.read_csv(near_table_path, sep=";", decimal=",", usecols=usecols, chunksize=chunksize)
+    near_table = pd.concat([chunk.loc[chunk["NEAR_RANK"] == 1] for chunk in chunks])
+    # Angles of the line connecting rectangle's centroid and nearest point on the near feature line
+    angles = near_table["NEAR_ANGLE"].to_numpy(dtype=float)
+    if angle_method == "GEODESIC":
+        # Convert azimuth (clockwise from north) to planar angle (counterclockwise from east)
+        angles = 90 - angles
+        angles = np.where(angles > 180, angles - 360, angles)
+    # Compute required rotation angles
+    req_rot = np.where(angles < 0, angles + 360, angles)
+    if by_feature_id:
+        return pd.Series(req_rot, index=near_table["IN_FID"].to_numpy())
     return req_rot
 
 
@@ -68,3 +79,261 @@ def rotate_point(x, y, x_c=0, y_c=0, angle=0, units="degrees"):
     x_r = (x * math.cos(angle)) - (y * math.sin(angle)) + x_c
     y_r = (x * math.sin(angle)) + (y * math.cos(angle)) + y_c
     return x_r, y_r
+
+
+def line_intersection_batch(lines1, lines2):
+    """
+    Vectorised line_intersection for many pairs of lines at once.
+    :param lines1: Array-like of shape (N, 2, 2); N lines given by two points of x and y coordinates each.
+    :param lines2: Array-like of shape (N, 2, 2), or (2, 2) to intersect all of lines1 with the same line.
+    :return: An (N, 2) array of x and y coordinates of intersection points; NaN for parallel lines.
+    """
+    lines1 = np.asarray(lines1, dtype=float)
+    lines2 = np.broadcast_to(np.asarray(lines2, dtype=float), lines1.shape)
+    xdiff = (lines1[:, 0, 0] - lines1[:, 1, 0], lines2[:, 0, 0] - lines2[:, 1, 0])
+    ydiff = (lines1[:, 0, 1] - lines1[:, 1, 1], lines2[:, 0, 1] - lines2[:, 1, 1])
+
+    def det(a, b):
+        return a[0] * b[1] - a[1] * b[0]
+
+    div = det(xdiff, ydiff)
+    div = np.where(div == 0, np.nan, div)
+
+    d = (det(lines1[:, 0].T, lines1[:, 1].T), det(lines2[:, 0].T, lines2[:, 1].T))
+    x = det(d, xdiff) / div
+    y = det(d, ydiff) / div
+    return np.stack([x, y], axis=-1)
+
+
+def rotate_points(points, centers=(0, 0), angles=0, units="degrees"):
+    """
+    Vectorised rotate_point for many points at once.
+    :param points: Array-like of shape (N, 2) with x and y coordinates of the points to be rotated.
+    :param centers: Array-like of shape (N, 2), or (2,) to rotate all points around the same center.
+    :param angles: Array-like of shape (N,), or a scalar to rotate all points by the same angle.
+    :param units: "degrees" or "radians"
+    :return: An (N, 2) array of x and y coordinates of the rotated points.
+    """
+    points = np.asarray(points, dtype=float)
+    centers = np.broadcast_to(np.asarray(centers, dtype=float), points.shape)
+    angles = np.asarray(angles, dtype=float)
+    x = points[:, 0] - centers[:, 0]
+    y = points[:, 1] - centers[:, 1]
+    if units == "degrees":
+        angles = np.radians(angles)
+    cos, sin = np.cos(angles), np.sin(angles)
+    x_r = (x * cos) - (y * sin) + centers[:, 0]
+    y_r = (x * sin) + (y * cos) + centers[:, 1]
+    return np.stack([x_r, y_r], axis=-1)
+
+
+def segments_from_polylines(polylines, feature_ids=None):
+    """
+    Split polylines into their straight line segments.
+    :param polylines: A list of array-likes of shape (P, 2), each with x and y coordinates of a line's vertices.
+    :param feature_ids: Optional list of IDs of the polylines; defaults to their positions in polylines.
+    :return: A tuple; an (M, 2, 2) array of segments and an (M,) array of IDs of the polylines they belong to.
+    """
+    if feature_ids is None:
+        feature_ids = np.arange(len(polylines))
+    vertices = [np.asarray(polyline, dtype=float).reshape(-1, 2) for polyline in polylines]
+    segments = np.concatenate([np.stack([v[:-1], v[1:]], axis=1) for v in vertices])
+    segment_feature_ids = np.repeat(np.asarray(feature_ids), [len(v) - 1 for v in vertices])
+    return segments, segment_feature_ids
+
+
+class SegmentIndex:
+    """
+    Uniform grid spatial index over line segments, answering k-nearest feature queries for many points at once.
+    Replaces arcpy.GenerateNearTable_analysis() with the PLANAR method.
+
+    Usage example:
+        segments, feature_ids = segments_from_polylines(lines)
+        index = SegmentIndex(segments, feature_ids)
+        near_table = index.generate_near_table(rectangle_centroids, k=3)
+        rotation = get_parallelizing_rotation(near_table)
+    """
+
+    def __init__(self, segments, feature_ids=None, cell_size=None):
+        """
+        :param segments: Array-like of shape (M, 2, 2); M segments given by two points of x and y coordinates each.
+        :param feature_ids: Optional (M,) array of IDs of the line features the segments belong to.
+        :param cell_size: Side length of the grid cells; by default chosen to hold about one segment per cell.
+        """
+        self.segments = np.asarray(segments, dtype=float)
+        self.feature_ids = np.arange(len(self.segments)) if feature_ids is None else np.asarray(feature_ids)
+        self._feature_codes = np.unique(self.feature_ids, return_inverse=True)[1].ravel()
+        lower = self.segments.min(axis=1)
+        upper = self.segments.max(axis=1)
+        self.origin = lower.min(axis=0)
+        extent = np.maximum(upper.max(axis=0) - self.origin, np.finfo(float).eps)
+        if cell_size is None:
+            cell_size = max(np.sqrt(extent[0] * extent[1] / len(self.segments)), extent.max() / 4096)
+        self.cell_size = cell_size
+        self.shape = (np.floor(extent / cell_size).astype(int) + 1).clip(max=2**20)
+        # Register each segment in all the cells its bounding box overlaps, in CSR layout sorted by cell
+        cell_lower = self._cell_of(lower)
+        cell_upper = self._cell_of(upper)
+        widths = cell_upper[:, 0] - cell_lower[:, 0] + 1
+        num_cells = widths * (cell_upper[:, 1] - cell_lower[:, 1] + 1)
+        segment_idx = np.repeat(np.arange(len(self.segments)), num_cells)
+        local_idx = np.arange(num_cells.sum()) - np.repeat(np.cumsum(num_cells) - num_cells, num_cells)
+        ix = cell_lower[segment_idx, 0] + local_idx % widths[segment_idx]
+        iy = cell_lower[segment_idx, 1] + local_idx // widths[segment_idx]
+        cell_ids = iy * self.shape[0] + ix
+        order = np.argsort(cell_ids, kind="stable")
+        self._cell_segments = segment_idx[order]
+        self._cell_offsets = np.concatenate([[0], np.cumsum(np.bincount(cell_ids, minlength=self.shape.prod()))])
+
+    def query(self, points, k=1, search_radius=None):
+        """
+        Find the k nearest line features of each point.
+        :param points: Array-like of shape (N, 2) with x and y coordinates.
+        :param k: Number of nearest distinct features to find per point.
+        :param search_radius: Optional maximum distance of the features to find.
+        :return: A tuple of (N, k) arrays; distances and segment indices, ordered from nearest.
+        Missing neighbours have infinite distance and segment index -1.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        best_dist = np.full((len(points), k), np.inf)
+        best_seg = np.full((len(points), k), -1)
+        # Beyond the number of features there is nothing more to find, so the search stops at that many
+        last = min(k, len(np.unique(self._feature_codes))) - 1
+        if last < 0:
+            return best_dist, best_seg
+        point_cells = np.floor((points - self.origin) / self.cell_size).astype(int)
+        max_ring = np.maximum(np.abs(point_cells), np.abs(point_cells - (self.shape - 1))).max(axis=1)
+        # Rings nearer than a point's Chebyshev distance to the grid hold no cells of it, so start from there
+        rings = np.maximum(-point_cells, point_cells - (self.shape - 1)).max(axis=1).clip(min=0)
+        active = np.arange(len(points))
+        while len(active):
+            owner, cells = self._ring_cells(point_cells[active], rings[active])
+            query_idx = active[owner]
+            cell_ids = cells[:, 1] * self.shape[0] + cells[:, 0]
+            starts, ends = self._cell_offsets[cell_ids], self._cell_offsets[cell_ids + 1]
+            counts = ends - starts
+            candidate_points = np.repeat(query_idx, counts)
+            candidate_segments = self._cell_segments[
+                np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - starts, counts)
+            ]
+            candidate_dist, _ = _point_segment_distance(points[candidate_points], self.segments[candidate_segments])
+            # Drop candidates that are not nearer than the current k-th neighbour or outside search_radius
+            within = candidate_dist < best_dist[candidate_points, last]
+            if search_radius is not None:
+                within &= candidate_dist <= search_radius
+            candidate_points, candidate_segments = candidate_points[within], candidate_segments[within]
+            candidate_dist = candidate_dist[within]
+            self._merge_candidates(best_dist, best_seg, active, candidate_points, candidate_segments, candidate_dist)
+            # Cells beyond a point's ring are at least ring * cell_size away from it
+            reach = rings[active] * self.cell_size
+            done = (best_dist[active, last] <= reach) | (rings[active] >= max_ring[active])
+            if search_radius is not None:
+                done |= reach >= search_radius
+            rings[active] += 1
+            active = active[~done]
+        return best_dist, best_seg
+
+    def generate_near_table(self, points, k=1, search_radius=None, in_fids=None):
+        """
+        Compute a near table in the format of arcpy.GenerateNearTable_analysis() with the PLANAR method.
+        :param points: Array-like of shape (N, 2) with x and y coordinates, e.g. rectangle centroids.
+        :param k: Number of nearest features to report per point.
+        :param search_radius: Optional maximum distance of the features to report.
+        :param in_fids: Optional (N,) IDs of the points; defaults to their positions in points.
+        :return: A pd.DataFrame with IN_FID, NEAR_FID, NEAR_DIST, NEAR_RANK, NEAR_X, NEAR_Y and NEAR_ANGLE columns.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        in_fids = np.arange(len(points)) if in_fids is None else np.asarray(in_fids)
+        best_dist, best_seg = self.query(points, k=k, search_radius=search_radius)
+        found = best_seg >= 0
+        point_idx = np.nonzero(found)[0]
+        segment_idx = best_seg[found]
+        dist, nearest = _point_segment_distance(points[point_idx], self.segments[segment_idx])
+        delta = nearest - points[point_idx]
+        return pd.DataFrame(
+            {
+                "IN_FID": in_fids[point_idx],
+                "NEAR_FID": self.feature_ids[segment_idx],
+                "NEAR_DIST": dist,
+                "NEAR_RANK": np.nonzero(found)[1] + 1,
+                "NEAR_X": nearest[:, 0],
+                "NEAR_Y": nearest[:, 1],
+                "NEAR_ANGLE": np.degrees(np.arctan2(delta[:, 1], delta[:, 0])),
+            }
+        )
+
+    def _cell_of(self, xy):
+        return np.floor((xy - self.origin) / self.cell_size).astype(int).clip(0, self.shape - 1)
+
+    def _ring_cells(self, centers, rings):
+        """
+        Cells of the grid on square rings of the given Chebyshev radii around the given cells, one ring per point.
+        Only the parts of the rings inside the grid are listed, so a ring costs at most the grid's perimeter.
+        :param centers: An (N, 2) array of cells.
+        :param rings: An (N,) array of ring radii.
+        :return: A tuple of a (C,) array of positions in centers and a (C, 2) array of cells.
+        """
+        cx, cy = centers[:, 0], centers[:, 1]
+        width, height = self.shape
+        # Each ring as four runs of cells: the bottom and top rows, then the left and right columns between them
+        fixed = np.stack([cy - rings, cy + rings, cx - rings, cx + rings], axis=1)
+        first = np.stack([cx - rings, cx - rings, cy - rings + 1, cy - rings + 1], axis=1).clip(min=0)
+        last = np.minimum(
+            np.stack([cx + rings, cx + rings, cy + rings - 1, cy + rings - 1], axis=1), self.shape[[0, 0, 1, 1]] - 1
+        )
+        fixed_in_grid = (fixed >= 0) & (fixed < np.array([height, height, width, width]))
+        counts = np.where(fixed_in_grid, last - first + 1, 0).clip(min=0)
+        # A ring of radius 0 is just its center cell
+        counts[rings == 0, 1:] = 0
+        counts = counts.ravel()
+        run = np.repeat(np.arange(len(counts)), counts)
+        along = first.ravel()[run] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        fixed = fixed.ravel()[run]
+        is_row = (run % 4 < 2)[:, None]
+        cells = np.where(is_row, np.stack([along, fixed], axis=1), np.stack([fixed, along], axis=1))
+        return run // 4, cells
+
+    def _merge_candidates(self, best_dist, best_seg, active, candidate_points, candidate_segments, candidate_dist):
+        """
+        Merge candidates into the per-point top-k arrays in place, keeping the nearest segment per feature.
+        """
+        k = best_dist.shape[1]
+        current = best_seg[active] >= 0
+        points = np.concatenate([np.broadcast_to(active[:, None], current.shape)[current], candidate_points])
+        segments = np.concatenate([best_seg[active][current], candidate_segments])
+        dist = np.concatenate([best_dist[active][current], candidate_dist])
+        # Sort by point and distance, then deduplicate (point, feature) pairs, keeping the nearest segment
+        order = np.argsort(dist)
+        order = order[np.argsort(points[order], kind="stable")]
+        points, segments, dist = points[order], segments[order], dist[order]
+        pairs = points * (self._feature_codes.max() + 1) + self._feature_codes[segments]
+        order = np.argsort(pairs, kind="stable")
+        first = np.ones(len(points), dtype=bool)
+        first[order[1:]] = pairs[order[1:]] != pairs[order[:-1]]
+        points, segments, dist = points[first], segments[first], dist[first]
+        # Keep the k nearest features per point
+        group_start = np.ones(len(points), dtype=bool)
+        group_start[1:] = points[1:] != points[:-1]
+        rank = np.arange(len(points)) - np.maximum.accumulate(np.where(group_start, np.arange(len(points)), 0))
+        keep = rank < k
+        best_dist[active] = np.inf
+        best_seg[active] = -1
+        best_dist[points[keep], rank[keep]] = dist[keep]
+        best_seg[points[keep], rank[keep]] = segments[keep]
+
+
+def _point_segment_distance(points, segments):
+    """
+    Distances from points to segments, pairwise, and the nearest points on the segments.
+    :param points: An (N, 2) array.
+    :param segments: An (N, 2, 2) array.
+    :return: A tuple; an (N,) array of distances and an (N, 2) array of nearest points.
+    """
+    start, end = segments[:, 0], segments[:, 1]
+    direction = end - start
+    length_sq = (direction**2).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = ((points - start) * direction).sum(axis=1) / length_sq
+    t = np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0).clip(0, 1)
+    nearest = start + t[:, None] * direction
+    return np.sqrt(((nearest - points) ** 2).sum(axis=1)), nearest
@@ -1,29 +1,77 @@
+import json
 import os
-import subprocess
+
+import great_expectations as ge
+from great_expectations.data_context.types.resource_identifiers import ValidationResultIdentifier
 
 from utils.aws.s3_client import S3FSClient
 import config
-
+from utils.log import logger
 
 DATA_VALIDATION_DIRPATHS = config.S3_DATA_VALIDATION_DIRPATH
+MANIFEST_FILEPATH = os.path.join(config.GREAT_EXPECTATIONS_VALIDATIONS_DIRPATH, ".s3_manifest.json")
 
 
 def fetch_validation_results_from_s3():
+    """
+    Download the validation results that are new or changed since the last fetch, concurrently.
+    What was fetched is tracked in a local manifest of S3 path to ETag.
+    :return: list of local paths of the downloaded results
+    """
     fs = S3FSClient()
+    manifest = _load_manifest()
+    rpaths, lpaths = [], []
     for dp in DATA_VALIDATION_DIRPATHS:
-        for path, _, file in fs.walk(dp):
-            if file and file[0].endswith(".json"):
-                local_destination_path = os.path.join(
-                    config.GREAT_EXPECTATIONS_VALIDATIONS_DIRPATH,
-                    path.split(config.S3_DATA_VALIDATION_DIRPATH.split("/")[-1])[-1][1:],
-                    file[0],
-                )
-                fs.get(os.path.join(path, file[0]), local_destination_path)
-
-
-def build_data_docs():
-    fetch_validation_results_from_s3()
-    subprocess.run(["great_expectations", "--assume-yes", "docs", "build"])
+        dirname = dp.rstrip("/").split("/")[-1]
+        for rpath, info in fs.find(dp, detail=True).items():
+            if not rpath.endswith(".json"):
+                continue
+            lpath = os.path.join(config.GREAT_EXPECTATIONS_VALIDATIONS_DIRPATH, rpath.split(f"{dirname}/", 1)[-1])
+            if manifest.get(rpath) != info["ETag"] or not os.path.isfile(lpath):
+                rpaths.append(rpath)
+                lpaths.append(lpath)
+                manifest[rpath] = info["ETag"]
+    logger.info(f"Fetching {len(rpaths)} new or changed validation results from S3")
+    fs.get_many(rpaths, lpaths)
+    _save_manifest(manifest)
+    return lpaths
+
+
+def build_data_docs(full_rebuild=False):
+    """
+    Fetch new validation results and build data docs pages for them only, plus the index.
+    :param full_rebuild: rebuild all pages, e.g. after changing the site configuration
+    """
+    lpaths = fetch_validation_results_from_s3()
+    context = ge.get_context()
+    if full_rebuild:
+        context.build_data_docs()
+    elif lpaths:
+        context.build_data_docs(resource_identifiers=[_get_validation_result_identifier(lp) for lp in lpaths])
+
+
+def _get_validation_result_identifier(lpath):
+    """
+    Validation results are stored as '{suite name parts}/{run name}/{run time}/{batch identifier}.json'.
+    """
+    relpath = os.path.relpath(lpath, config.GREAT_EXPECTATIONS_VALIDATIONS_DIRPATH)
+    return ValidationResultIdentifier.from_tuple(tuple(relpath[: -len(".json")].split(os.sep)))
+
+
+def _load_manifest():
+    try:
+        with open(MANIFEST_FILEPATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_manifest(manifest):
+    os.makedirs(os.path.dirname(MANIFEST_FILEPATH), exist_ok=True)
+    tmp_filepath = f"{MANIFEST_FILEPATH}.tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_filepath, MANIFEST_FILEPATH)
 
 
 if __name__ == "__main__":
@@ -1,40 +1,259 @@
+from concurrent.futures import ProcessPoolExecutor
+import copy
+from datetime import datetime, timezone
+from functools import lru_cache
 import os
 
 import great_expectations as ge
+from great_expectations.checkpoint.types.checkpoint_result import CheckpointResult
+from great_expectations.core.batch import RuntimeBatchRequest
+from great_expectations.core.expectation_validation_result import expectationSuiteValidationResultSchema
+from great_expectations.core.id_dict import IDDict
+from great_expectations.core.run_identifier import RunIdentifier
+from great_expectations.data_context.types.resource_identifiers import (
+    ExpectationSuiteIdentifier,
+    ValidationResultIdentifier,
+)
+import numpy as np
 
 from utils.aws.s3_client import S3FSClient
 import config
 from utils.log import logger
 
+CHECKPOINT_NAME = "***"
+CHECKPOINT_CONFIG = {
+    "name": CHECKPOINT_NAME,
+    "config_version": 1,
+    "class_name": "SimpleCheckpoint",
+    "run_name_template": "%Y%m%d-%H%M%S",
+    "validations": [
+        {
+            "batch_request": {
+                "datasource_name": "***",
+                "data_connector_name": "default_runtime_data_connector_name",
+                "data_asset_name": "***",
+            },
+            "expectation_suite_name": config.EXPECTATION_SUITE_NAME,
+        }
+    ],
+}
+BATCH_IDENTIFIERS = {"default_identifier_name": "***"}
 
-def validate_data(df):
-    logger.info(f"Validating data against expectation suite: {config.EXPECTATION_SUITE_NAME}")
+# Column map expectations whose outcome for a row depends on other rows, so they cannot be validated per chunk
+NON_LOCAL_MAP_EXPECTATIONS = {
+    "expect_column_values_to_be_unique",
+    "expect_column_values_to_be_increasing",
+    "expect_column_values_to_be_decreasing",
+    "expect_compound_columns_to_be_unique",
+    "expect_multicolumn_values_to_be_unique",
+}
+# Column map expectations that on pandas check the column's dtype and report no counts to merge over chunks
+COLUMN_TYPE_EXPECTATIONS = {
+    "expect_column_values_to_be_of_type",
+    "expect_column_values_to_be_in_type_list",
+}
+MAP_EXPECTATION_PREFIXES = ("expect_column_values_to_", "expect_column_pair_values_", "expect_multicolumn_values_")
+MAX_PARTIAL_UNEXPECTED = 20
+
+
+@lru_cache(maxsize=None)
+def _get_context(register_checkpoint=True):
+    """
+    Data context of this process, with the checkpoint registered on first use rather than on every validation.
+    Pool workers skip the registration, so they do not all rewrite the checkpoint's config at once.
+    """
     context = ge.get_context()
-    checkpoint_config = {
-        "name": "***",
-        "config_version": 1,
-        "class_name": "SimpleCheckpoint",
-        "run_name_template": "%Y%m%d-%H%M%S",
-        "validations": [
-            {
-                "batch_request": {
-                    "datasource_name": "***",
-                    "data_connector_name": "default_runtime_data_connector_name",
-                    "data_asset_name": "***",
-                },
-                "expectation_suite_name": config.EXPECTATION_SUITE_NAME,
-            }
-        ],
-    }
-    context.add_checkpoint(**checkpoint_config)
-    validation_results = context.run_checkpoint(
-        checkpoint_name="***",
+    if register_checkpoint:
+        context.add_checkpoint(**CHECKPOINT_CONFIG)
+    return context
+
+
+def validate_data(df, n_chunks=None, partition_by=None, max_workers=None, sample_size=None, random_state=None):
+    """
+    Validate df against the expectation suite with the registered checkpoint.
+    With n_chunks or partition_by, row-wise expectations are validated on chunks of df in a process pool while
+    the others, e.g. on row counts, means or uniqueness, are validated on the whole df in this process.
+    The per-chunk results are merged and stored as a single validation result, and a CheckpointResult
+    is returned, like `run_checkpoint` would.
+    :param n_chunks: number of row chunks of about equal size
+    :param partition_by: column name or list of column names; validate each group as a chunk, e.g. 'date'
+    :param max_workers: processes validating chunks
+    :param sample_size: validate a random sample of this many rows instead, as a cheap pre-check;
+    counts and aggregate expectations then refer to the sample, not to df
+    :param random_state: seed of the sample
+    """
+    logger.info(f"Validating data against expectation suite: {config.EXPECTATION_SUITE_NAME}")
+    context = _get_context()
+    if sample_size is not None and sample_size < len(df):
+        logger.info(f"Validating a sample of {sample_size} out of {len(df)} rows")
+        df = df.sample(n=sample_size, random_state=random_state)
+    if n_chunks is None and partition_by is None:
+        return _run_checkpoint(context, df)
+    return _validate_in_chunks(context, df, n_chunks, partition_by, max_workers)
+
+
+def _run_checkpoint(context, df):
+    return context.run_checkpoint(
+        checkpoint_name=CHECKPOINT_NAME,
         batch_request={
             "runtime_parameters": {"batch_data": df},
-            "batch_identifiers": {"default_identifier_name": "***"},
+            "batch_identifiers": BATCH_IDENTIFIERS,
         },
     )
-    return validation_results
+
+
+def _validate_in_chunks(context, df, n_chunks, partition_by, max_workers):
+    expectations = context.get_expectation_suite(config.EXPECTATION_SUITE_NAME).expectations
+    is_local = [_is_local_map_expectation(e.expectation_type) for e in expectations]
+    local_ids = [i for i, local in enumerate(is_local) if local]
+    aggregate_ids = [i for i, local in enumerate(is_local) if not local]
+    if not local_ids:
+        logger.info("No row-wise expectations to validate in chunks, validating the whole data at once")
+        return _run_checkpoint(context, df)
+    if partition_by is not None:
+        # Keep rows with missing partition values, which groupby drops by default, so that they get validated too
+        chunks = [chunk for _, chunk in df.groupby(partition_by, sort=False, dropna=False)]
+    else:
+        bounds = np.linspace(0, len(df), max(min(n_chunks, len(df)), 1) + 1).astype(int)
+        chunks = [df.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    logger.info(
+        f"Validating {len(local_ids)} row-wise expectations on {len(chunks)} chunks "
+        f"and {len(aggregate_ids)} other expectations on the whole data"
+    )
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_validate_expectations, chunk, local_ids) for chunk in chunks]
+        aggregate_result = _validate_expectations(df, aggregate_ids, context) if aggregate_ids else None
+        chunk_results = [future.result() for future in futures]
+
+    results_by_id = dict(zip(aggregate_ids, aggregate_result["results"])) if aggregate_result else {}
+    for position, expectation_id in enumerate(local_ids):
+        results_by_id[expectation_id] = _merge_map_results([r["results"][position] for r in chunk_results])
+    results = [results_by_id[i] for i in range(len(expectations))]
+    meta = copy.deepcopy((aggregate_result or chunk_results[0])["meta"])
+    return _store_merged_result(context, results, meta, num_chunks=len(chunks))
+
+
+def _validate_expectations(df, expectation_ids, context=None):
+    """
+    Validate df against the expectations of the suite at the given positions, without running checkpoint actions.
+    Returns the validation result as a JSON dict, so it can be passed back from pool workers.
+    """
+    context = context or _get_context(register_checkpoint=False)
+    suite = context.get_expectation_suite(config.EXPECTATION_SUITE_NAME)
+    suite.expectations = [suite.expectations[i] for i in expectation_ids]
+    validation_config = CHECKPOINT_CONFIG["validations"][0]["batch_request"]
+    validator = context.get_validator(
+        batch_request=RuntimeBatchRequest(
+            **validation_config,
+            runtime_parameters={"batch_data": df},
+            batch_identifiers=BATCH_IDENTIFIERS,
+        ),
+        expectation_suite=suite,
+    )
+    return validator.validate(result_format="SUMMARY", catch_exceptions=True).to_json_dict()
+
+
+def _is_local_map_expectation(expectation_type):
+    return (
+        expectation_type.startswith(MAP_EXPECTATION_PREFIXES)
+        and expectation_type not in NON_LOCAL_MAP_EXPECTATIONS
+        and expectation_type not in COLUMN_TYPE_EXPECTATIONS
+    )
+
+
+def _merge_map_results(chunk_results):
+    """
+    Merge the results of one column map expectation over all chunks: counts are summed,
+    and success is recomputed from the totals and the expectation's `mostly`.
+    Results without counts to sum succeed only if they succeed on every chunk, and keep the first failing result.
+    """
+    merged = copy.deepcopy(chunk_results[0])
+    exceptions = [r["exception_info"] for r in chunk_results if (r.get("exception_info") or {}).get("raised_exception")]
+    if exceptions:
+        merged.update(success=False, exception_info=exceptions[0], result={})
+        return merged
+    if not all("element_count" in r["result"] and "unexpected_count" in r["result"] for r in chunk_results):
+        failed = [r for r in chunk_results if not r["success"]]
+        return copy.deepcopy(failed[0]) if failed else merged
+
+    element_count = sum(r["result"]["element_count"] for r in chunk_results)
+    missing_count = sum(r["result"].get("missing_count", 0) for r in chunk_results)
+    unexpected_count = sum(r["result"]["unexpected_count"] for r in chunk_results)
+    nonmissing_count = element_count - missing_count
+    partial_unexpected_list = [v for r in chunk_results for v in r["result"].get("partial_unexpected_list", [])]
+    merged["result"] = {
+        "element_count": element_count,
+        "missing_count": missing_count,
+        "missing_percent": missing_count / element_count * 100 if element_count else None,
+        "unexpected_count": unexpected_count,
+        "unexpected_percent": unexpected_count / nonmissing_count * 100 if nonmissing_count else None,
+        "unexpected_percent_total": unexpected_count / element_count * 100 if element_count else None,
+        "unexpected_percent_nonmissing": unexpected_count / nonmissing_count * 100 if nonmissing_count else None,
+        "partial_unexpected_list": partial_unexpected_list[:MAX_PARTIAL_UNEXPECTED],
+    }
+    if any("partial_unexpected_index_list" in r["result"] for r in chunk_results):
+        # Chunks keep the index of the whole data, so their indices are valid as they are
+        index_list = [i for r in chunk_results for i in r["result"].get("partial_unexpected_index_list") or []]
+        merged["result"]["partial_unexpected_index_list"] = index_list[:MAX_PARTIAL_UNEXPECTED]
+    if any("partial_unexpected_counts" in r["result"] for r in chunk_results):
+        merged["result"]["partial_unexpected_counts"] = _merge_partial_unexpected_counts(
+            [r["result"].get("partial_unexpected_counts") or [] for r in chunk_results]
+        )
+    mostly = merged["expectation_config"]["kwargs"].get("mostly", 1)
+    merged["success"] = nonmissing_count == 0 or 1 - unexpected_count / nonmissing_count >= mostly
+    return merged
+
+
+def _merge_partial_unexpected_counts(chunk_counts):
+    """
+    Sum the per-chunk counts of unexpected values by value, most frequent first. Like the per-chunk lists,
+    the result is partial: values outside a chunk's most frequent ones are not counted for that chunk.
+    """
+    counts = {}
+    for value_counts in chunk_counts:
+        for value_count in value_counts:
+            # Values may be unhashable, e.g. lists, so they are keyed by their repr
+            key = repr(value_count["value"])
+            counts.setdefault(key, {"value": value_count["value"], "count": 0})["count"] += value_count["count"]
+    return sorted(counts.values(), key=lambda value_count: -value_count["count"])[:MAX_PARTIAL_UNEXPECTED]
+
+
+def _store_merged_result(context, results, meta, num_chunks):
+    """
+    Store the merged validation result and update data docs for it, as the checkpoint's actions would,
+    and wrap it in a CheckpointResult.
+    """
+    run_time = datetime.now(timezone.utc)
+    run_id = RunIdentifier(run_name=run_time.strftime(CHECKPOINT_CONFIG["run_name_template"]), run_time=run_time)
+    successful = sum(result["success"] for result in results)
+    meta.update(run_id=run_id.to_json_dict(), num_chunks=num_chunks)
+    validation_result = expectationSuiteValidationResultSchema.load(
+        {
+            "success": successful == len(results),
+            "results": results,
+            "evaluation_parameters": {},
+            "statistics": {
+                "evaluated_expectations": len(results),
+                "successful_expectations": successful,
+                "unsuccessful_expectations": len(results) - successful,
+                "success_percent": successful / len(results) * 100 if results else None,
+            },
+            "meta": meta,
+        }
+    )
+    identifier = ValidationResultIdentifier(
+        expectation_suite_identifier=ExpectationSuiteIdentifier(config.EXPECTATION_SUITE_NAME),
+        run_id=run_id,
+        batch_identifier=IDDict(BATCH_IDENTIFIERS).to_id(),
+    )
+    context.validations_store.set(identifier, validation_result)
+    context.build_data_docs(resource_identifiers=[identifier])
+    return CheckpointResult(
+        run_id=run_id,
+        run_results={identifier: {"validation_result": validation_result, "actions_results": {}}},
+        checkpoint_config=context.get_checkpoint(CHECKPOINT_NAME).config,
+    )
 
 
 def upload_validation_results_to_s3(local_results_dirpath, dirname):
@@ -48,8 +267,11 @@ def upload_validation_results_to_s3(local_results_dirpath, dirname):
     fs.put(local_results_dirpath, destination_dirpath, recursive=True)
 
 
-def run_data_validation(df):
-    validation_results = validate_data(df)
+def run_data_validation(df, **validate_kwargs):
+    """
+    :param validate_kwargs: passed to `validate_data`, e.g. n_chunks=16 for parallel validation of a large df
+    """
+    validation_results = validate_data(df, **validate_kwargs)
     local_results_dirpath = os.path.join(
         config.GREAT_EXPECTATIONS_VALIDATIONS_DIRPATH,
         config.EXPECTATION_SUITE_NAME,
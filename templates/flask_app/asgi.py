@@ -0,0 +1,59 @@
+"""
+ASGI variant of the model server, with the same /v0/get_metadata and /v0/predict contracts.
+Run it with the model pre-loaded in the master process, e.g.:
+gunicorn templates.flask_app.asgi:app --preload --workers 4 --worker-class uvicorn.workers.UvicornWorker
+With --preload this module, and so the model, is loaded once before the workers are forked,
+and the workers share the model's memory pages copy-on-write instead of each loading their own copy.
+"""
+
+import asyncio
+import gc
+import traceback
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+from templates.flask_app import start_model_server as server
+from mopy.utils.timing import registry, timed
+
+
+async def get_metadata(request):
+    return JSONResponse(server.meta)
+
+
+async def metrics(request):
+    return PlainTextResponse(registry.export_prometheus())
+
+
+async def predict(request):
+    with timed("server.predict"):
+        return await _predict(request)
+
+
+async def _predict(request):
+    input_request = None
+    try:
+        input_request = await request.json()
+        server.validate_predict_input(input_request)
+        # Predictions run in the batcher's worker thread, so the event loop keeps serving other requests
+        future = asyncio.wrap_future(server.batcher.submit(input_request))
+        preds = await asyncio.wait_for(future, timeout=server.PREDICT_TIMEOUT_S)
+        return JSONResponse(server.build_predict_response(input_request, preds=preds))
+    except Exception:
+        traceback.print_exc()
+        return JSONResponse(server.build_predict_response(input_request, error=traceback.format_exc()))
+
+
+server.setup_model()
+# Move the loaded model out of the garbage collector's reach, so that collections in the workers
+# do not write to its objects' pages and break copy-on-write sharing
+gc.freeze()
+
+app = Starlette(
+    routes=[
+        Route("/v0/get_metadata", get_metadata, methods=["GET"]),
+        Route("/v0/predict", predict, methods=["POST"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ]
+)
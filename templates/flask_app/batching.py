@@ -0,0 +1,73 @@
+from concurrent.futures import Future
+import os
+import queue
+import threading
+import time
+
+
+class MicroBatcher:
+    """
+    Groups concurrently submitted requests into batches for a single vectorised model call.
+    A batch is run as soon as it holds max_batch_size requests or max_wait_ms passed since its first request.
+    The worker thread is started on first use in each process, so it also works in pre-forked server workers.
+
+    Usage example:
+        batcher = MicroBatcher(predict_batch, max_batch_size=32, max_wait_ms=5)
+        pred = batcher.submit(request_json).result(timeout=10)
+    """
+
+    def __init__(self, predict_batch, max_batch_size=32, max_wait_ms=5, max_queue_size=1024):
+        """
+        :param predict_batch: callable taking a list of inputs and returning a list of predictions, one per input
+        :param max_batch_size: maximum number of requests passed to predict_batch at once
+        :param max_wait_ms: maximum time the first request of a batch waits for others to join it
+        :param max_queue_size: maximum number of requests waiting; further submits raise queue.Full
+        """
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, item):
+        """
+        Queue an input for prediction.
+        :return: concurrent.futures.Future resolving to its prediction
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put_nowait((item, future))
+        return future
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            # Drop requests whose callers gave up waiting; the rest can no longer be cancelled
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            try:
+                preds = self.predict_batch(items)
+                if len(preds) != len(items):
+                    raise ValueError(f"predict_batch returned {len(preds)} predictions for {len(items)} inputs")
+                for (_, future), pred in zip(batch, preds):
+                    future.set_result(pred)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
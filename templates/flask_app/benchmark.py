@@ -0,0 +1,190 @@
+"""
+Load test of the model server's /v0/predict endpoint, reporting latency percentiles, throughput and error rate.
+By default it starts the Flask app with a dummy model in a separate process, so that the server does not share
+the GIL with the load-generating clients; pass --url to target a running server instead.
+Example usage:
+python -m templates.flask_app.benchmark --mode closed --concurrency 16 --duration 30
+python -m templates.flask_app.benchmark --mode rate --rate 200 --duration 30 --url http://localhost:8887
+Results are saved as JSON, tagged with the current commit, so runs can be compared between commits.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+import json
+import multiprocessing
+import os
+import time
+import urllib.request
+
+import numpy as np
+
+from reprod import get_commit_hash
+from utils import misc
+from utils.misc import get_current_timestamp_as_pretty_string
+
+
+def setup_dummy_model(server, latency_ms=1.0):
+    """
+    Fill in the template's placeholders with a dummy model whose batch prediction takes latency_ms.
+    """
+
+    def predict_batch(input_requests):
+        time.sleep(latency_ms / 1000)
+        return [0.5 for _ in input_requests]
+
+    server.meta = {"model": "dummy"}
+    server.utils = misc
+    server.batcher.predict_batch = predict_batch
+
+
+@contextmanager
+def run_local_server(startup_timeout=30):
+    """
+    Serve the template app with a dummy model from a separate process on a free port, stopped on exit.
+    :yield: base URL of the server
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_serve_dummy_model, args=(sender,), daemon=True)
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(startup_timeout):
+            raise RuntimeError(f"The local server did not start within {startup_timeout} seconds")
+        try:
+            port = receiver.recv()
+        except EOFError:
+            raise RuntimeError(f"The local server exited with code {process.exitcode} before starting") from None
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.join()
+
+
+def _serve_dummy_model(sender):
+    """
+    Entry point of the local server process: bind to a free port, report it to the parent and serve forever.
+    """
+    from werkzeug.serving import make_server
+
+    from templates.flask_app import start_model_server as server
+
+    setup_dummy_model(server)
+    http_server = make_server("127.0.0.1", 0, server.app, threaded=True)
+    sender.send(http_server.server_port)
+    sender.close()
+    http_server.serve_forever()
+
+
+def send_request(url, payload, timeout):
+    """
+    :return: True if the request succeeded, False otherwise
+    """
+    request = urllib.request.Request(
+        f"{url}/v0/predict", data=payload, headers={"Content-Type": "application/json"}, method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status == 200 and json.loads(response.read())["error"] is None
+    except Exception:
+        return False
+
+
+def run_closed_loop(url, payload, concurrency, duration, timeout):
+    """
+    Each of `concurrency` clients sends its next request as soon as the previous one is answered.
+    :return: list of (latency in seconds, success) tuples
+    """
+    deadline = time.monotonic() + duration
+
+    def client():
+        results = []
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            ok = send_request(url, payload, timeout)
+            results.append((time.monotonic() - start, ok))
+        return results
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(client) for _ in range(concurrency)]
+        return [result for future in futures for result in future.result()]
+
+
+def run_fixed_rate(url, payload, rate, concurrency, duration, timeout):
+    """
+    Send requests at a fixed rate regardless of how fast they are answered, with up to `concurrency` in flight.
+    Latency is measured from the scheduled send time, so queueing in the client is counted too.
+    :return: list of (latency in seconds, success) tuples
+    """
+
+    def timed_request(scheduled):
+        ok = send_request(url, payload, timeout)
+        return time.monotonic() - scheduled, ok
+
+    start = time.monotonic()
+    futures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(int(rate * duration)):
+            scheduled = start + i / rate
+            time.sleep(max(scheduled - time.monotonic(), 0))
+            futures.append(executor.submit(timed_request, scheduled))
+        return [future.result() for future in futures]
+
+
+def summarize(results, elapsed):
+    latencies_ms = np.array([latency for latency, _ in results]) * 1000
+    errors = sum(not ok for _, ok in results)
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "error_rate": errors / len(results) if results else 0.0,
+        "throughput_rps": len(results) / elapsed,
+        "latency_ms": {
+            "mean": float(latencies_ms.mean()) if results else None,
+            "p50": float(np.percentile(latencies_ms, 50)) if results else None,
+            "p95": float(np.percentile(latencies_ms, 95)) if results else None,
+            "p99": float(np.percentile(latencies_ms, 99)) if results else None,
+            "max": float(latencies_ms.max()) if results else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["closed", "rate"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=8, help="clients, or max requests in flight for rate mode")
+    parser.add_argument("--rate", type=float, default=100, help="requests per second in rate mode")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout in seconds")
+    parser.add_argument("--payload", default='{"features": [0.0]}', help="JSON request body")
+    parser.add_argument("--url", help="base URL of a running server; a local dummy server is started if not given")
+    parser.add_argument("--output-dir", default="benchmark_results")
+    args = parser.parse_args()
+
+    payload = args.payload.encode("utf-8")
+    with ExitStack() as stack:
+        url = args.url or stack.enter_context(run_local_server())
+        start = time.monotonic()
+        if args.mode == "closed":
+            results = run_closed_loop(url, payload, args.concurrency, args.duration, args.timeout)
+        else:
+            results = run_fixed_rate(url, payload, args.rate, args.concurrency, args.duration, args.timeout)
+        elapsed = time.monotonic() - start
+    summary = {
+        "commit": get_commit_hash(),
+        "timestamp": get_current_timestamp_as_pretty_string(precision="seconds"),
+        "config": vars(args),
+        **summarize(results, elapsed),
+    }
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"{summary['timestamp']}_{summary['commit'][:8]}.json")
+    with open(output_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    print(json.dumps(summary, indent=2))
+    print(f"Saved results to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,20 @@
+from concurrent.futures import TimeoutError
+import os
 import traceback
 
 import flask
 import pandas as pd
 
+from templates.flask_app.batching import MicroBatcher
+from mopy.utils.timing import registry, timed
+
+# Requests arriving within MAX_WAIT_MS of each other are predicted together, up to MAX_BATCH_SIZE at once
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 32))
+MAX_WAIT_MS = float(os.getenv("MAX_WAIT_MS", 5))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", 1024))
+PREDICT_TIMEOUT_S = float(os.getenv("PREDICT_TIMEOUT_S", 30))
+# Echo the request back in successful responses; failed ones always include it
+ECHO_REQUEST = os.getenv("ECHO_REQUEST", "false").lower() == "true"
 
 app = flask.Flask(__name__)
 
@@ -12,44 +24,64 @@ def get_metadata():
     return flask.jsonify(meta)
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return flask.Response(registry.export_prometheus(), mimetype="text/plain")
+
+
 @app.route("/v0/predict", methods=["POST"])
+@timed("server.predict")
 def predict():
     try:
         validate_predict_input(flask.request.json)
-        # get preds
-        return flask.jsonify(
-            {
-                "preds": preds,
-                "prediction_generated_at": utils.get_current_timestamp_as_pretty_string(),
-                "original_request": flask.request.json,
-                "error": None,
-            }
-        )
+        future = batcher.submit(flask.request.json)
+        try:
+            preds = future.result(timeout=PREDICT_TIMEOUT_S)
+        except TimeoutError:
+            # Withdraw the request, so that it is not predicted in a later batch for nobody
+            future.cancel()
+            raise
+        return flask.jsonify(build_predict_response(flask.request.json, preds=preds))
     except Exception:
         traceback.print_exc()
-        return flask.jsonify(
-            {
-                "preds": None,
-                "prediction_generated_at": utils.get_current_timestamp_as_pretty_string(),
-                "original_request": flask.request.json,
-                "error": traceback.format_exc(),
-            }
-        )
+        return flask.jsonify(build_predict_response(flask.request.json, error=traceback.format_exc()))
+
+
+def build_predict_response(input_request, preds=None, error=None):
+    response = {
+        "preds": preds,
+        "prediction_generated_at": utils.get_current_timestamp_as_pretty_string(),
+        "error": error,
+    }
+    if ECHO_REQUEST or error is not None:
+        response["original_request"] = input_request
+    return response
 
 
 def validate_predict_input(input_request):
     pass
 
 
+@timed("server.predict_batch")
+def predict_batch(input_requests):
+    # run one vectorised model call for all the requests and return a list with one prediction per request
+    pass
+
+
 def setup_model():
     global model
     global meta
     pass
 
 
+batcher = MicroBatcher(
+    predict_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, max_queue_size=MAX_QUEUE_SIZE
+)
+
+
 def run_app():
     setup_model()
-    app.run(host=host, port=port)
+    app.run(host=host, port=port, threaded=True)
 
 
 if __name__ == "__main__":
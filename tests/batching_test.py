@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+from templates.flask_app.batching import MicroBatcher
+
+
+class TestMicroBatcher(object):
+    def test_full_batch_runs_without_waiting(self):
+        batches = []
+
+        def predict_batch(items):
+            batches.append(items)
+            return [item * 2 for item in items]
+
+        batcher = MicroBatcher(predict_batch, max_batch_size=4, max_wait_ms=10_000)
+        start = time.monotonic()
+        futures = [batcher.submit(i) for i in range(8)]
+        assert [future.result(timeout=5) for future in futures] == [i * 2 for i in range(8)]
+        assert time.monotonic() - start < 5
+        assert batches == [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+    def test_partial_batch_runs_after_max_wait(self):
+        batches = []
+
+        def predict_batch(items):
+            batches.append(items)
+            return items
+
+        batcher = MicroBatcher(predict_batch, max_batch_size=100, max_wait_ms=50)
+        start = time.monotonic()
+        futures = [batcher.submit(i) for i in range(3)]
+        assert [future.result(timeout=5) for future in futures] == [0, 1, 2]
+        assert time.monotonic() - start >= 0.045
+        assert batches == [[0, 1, 2]]
+
+    def test_wrong_number_of_predictions_fails_the_batch(self):
+        batcher = MicroBatcher(lambda items: items[:-1], max_batch_size=2, max_wait_ms=10_000)
+        futures = [batcher.submit(i) for i in range(2)]
+        for future in futures:
+            with pytest.raises(ValueError, match="returned 1 predictions for 2 inputs"):
+                future.result(timeout=5)
+
+    def test_cancelled_requests_are_skipped(self):
+        batches, release = [], threading.Event()
+
+        def predict_batch(items):
+            batches.append(items)
+            release.wait(timeout=5)
+            return items
+
+        batcher = MicroBatcher(predict_batch, max_batch_size=1, max_wait_ms=0)
+        first = batcher.submit("first")
+        cancelled = batcher.submit("cancelled")
+        assert cancelled.cancel()
+        last = batcher.submit("last")
+        release.set()
+        assert first.result(timeout=5) == "first"
+        assert last.result(timeout=5) == "last"
+        assert batches == [["first"], ["last"]]
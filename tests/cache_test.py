@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from utils.cache import DiskCache
+
+
+def writer(content):
+    def download(fp):
+        fp.write(content)
+
+    return download
+
+
+class TestDiskCache(object):
+    def test_hit_miss_and_stats(self, tmp_path):
+        cache = DiskCache(str(tmp_path))
+        with cache.open("gs://bucket/a", 1, 3, writer(b"abc")) as fp:
+            assert fp.read() == b"abc"
+        with cache.open("gs://bucket/a", 1, 3, writer(b"not downloaded again")) as fp:
+            assert fp.read() == b"abc"
+        assert cache.stats == {"hits": 1, "misses": 1, "bytes_saved": 3, "bytes_downloaded": 3}
+
+    def test_new_version_is_a_new_entry(self, tmp_path):
+        cache = DiskCache(str(tmp_path))
+        cache.open("gs://bucket/a", 1, 3, writer(b"old")).close()
+        with cache.open("gs://bucket/a", 2, 3, writer(b"new")) as fp:
+            assert fp.read() == b"new"
+        with cache.open("gs://bucket/b", 1, 3, writer(b"bbb")) as fp:
+            assert fp.read() == b"bbb"
+        assert cache.stats["misses"] == 3
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = DiskCache(str(tmp_path), max_size_bytes=25)
+        cache.open("a", 1, 10, writer(b"a" * 10)).close()
+        cache.open("b", 1, 10, writer(b"b" * 10)).close()
+        os.utime(cache._entry_path("a", 1), (2, 2))
+        os.utime(cache._entry_path("b", 1), (1, 1))
+        cache.open("c", 1, 10, writer(b"c" * 10)).close()
+        assert os.path.isfile(cache._entry_path("a", 1))
+        assert not os.path.isfile(cache._entry_path("b", 1))
+        assert os.path.isfile(cache._entry_path("c", 1))
+
+    def test_entry_larger_than_the_cache_is_kept_until_the_next_open(self, tmp_path):
+        cache = DiskCache(str(tmp_path), max_size_bytes=5)
+        cache.open("a", 1, 3, writer(b"abc")).close()
+        with cache.open("b", 1, 10, writer(b"b" * 10)) as fp:
+            assert fp.read() == b"b" * 10
+        assert not os.path.isfile(cache._entry_path("a", 1))
+        with cache.open("b", 1, 10, writer(b"not downloaded again")) as fp:
+            assert fp.read() == b"b" * 10
+        assert cache.stats["hits"] == 1
+        cache.open("c", 1, 3, writer(b"ccc")).close()
+        assert not os.path.isfile(cache._entry_path("b", 1))
+        assert os.path.isfile(cache._entry_path("c", 1))
+
+    def test_clear(self, tmp_path):
+        cache = DiskCache(str(tmp_path))
+        cache.open("a", 1, 3, writer(b"abc")).close()
+        cache.clear()
+        assert not os.path.isfile(cache._entry_path("a", 1))
+        assert cache.max_size_bytes == 10 * 1024**3
+
+    def test_failed_download_leaves_no_entry(self, tmp_path):
+        cache = DiskCache(str(tmp_path))
+
+        def failing_download(fp):
+            fp.write(b"partial")
+            raise IOError("connection reset")
+
+        with pytest.raises(IOError, match="connection reset"):
+            cache.open("a", 1, 7, failing_download)
+        assert not os.path.isfile(cache._entry_path("a", 1))
+        assert not [name for name in os.listdir(tmp_path) if name.startswith(".tmp-")]
+        with cache.open("a", 1, 3, writer(b"abc")) as fp:
+            assert fp.read() == b"abc"
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The cloud clients import the repo as the `mopy` package, which resolves from the checkout's parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
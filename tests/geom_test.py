@@ -1,3 +1,5 @@
+import numpy as np
+
 import geom
 
 
@@ -6,3 +8,94 @@ class TestLineIntersection(object):
         expected = 0, 0
         actual = geom.line_intersection(line1=([-1, 0], [1, 0]), line2=([0, -1], [0, 1]))
         assert actual == expected
+
+
+class TestLineIntersectionBatch(object):
+    def test_matches_scalar_function(self):
+        rng = np.random.default_rng(0)
+        lines1, lines2 = rng.normal(size=(2, 1000, 2, 2))
+        expected = [geom.line_intersection(l1.tolist(), l2.tolist()) for l1, l2 in zip(lines1, lines2)]
+        actual = geom.line_intersection_batch(lines1, lines2)
+        np.testing.assert_array_equal(actual, expected)
+
+    def test_parallel_lines_give_nan(self):
+        actual = geom.line_intersection_batch([([0, 0], [1, 1]), ([-1, 0], [1, 0])], ([0, 1], [1, 2]))
+        assert np.isnan(actual[0]).all()
+        np.testing.assert_array_equal(actual[1], [-1, 0])
+
+
+class TestRotatePoints(object):
+    def test_matches_scalar_function(self):
+        rng = np.random.default_rng(0)
+        points, centers = rng.normal(size=(2, 1000, 2))
+        angles = rng.uniform(-360, 360, size=1000)
+        expected = [geom.rotate_point(*p, *c, angle=a) for p, c, a in zip(points, centers, angles)]
+        actual = geom.rotate_points(points, centers, angles)
+        np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-12)
+
+    def test_broadcast_center_and_angle(self):
+        actual = geom.rotate_points([[1, 0], [0, 1]], centers=(0, 0), angles=np.pi / 2, units="radians")
+        np.testing.assert_allclose(actual, [[0, 1], [-1, 0]], atol=1e-12)
+
+
+class TestGetParallelizingRotation(object):
+    near_table = (
+        "OBJECTID;IN_FID;NEAR_FID;NEAR_DIST;NEAR_RANK;NEAR_ANGLE\n"
+        "1;1;7;1,5;1;-90,5\n"
+        "2;1;8;2,5;2;10\n"
+        "3;2;7;0,5;1;45,25\n"
+    )
+
+    def test_planar(self, tmp_path):
+        near_table_path = tmp_path / "near_table.csv"
+        near_table_path.write_text(self.near_table)
+        actual = geom.get_parallelizing_rotation(near_table_path)
+        np.testing.assert_array_equal(actual, [269.5, 45.25])
+
+    def test_geodesic_by_feature_id(self, tmp_path):
+        near_table_path = tmp_path / "near_table.csv"
+        near_table_path.write_text(self.near_table)
+        actual = geom.get_parallelizing_rotation(near_table_path, angle_method="GEODESIC", by_feature_id=True)
+        assert actual.to_dict() == {1: 180.5, 2: 44.75}
+
+
+class TestSegmentIndex(object):
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        starts = rng.uniform(0, 100, size=(500, 2))
+        segments = np.stack([starts, starts + rng.normal(0, 3, size=(500, 2))], axis=1)
+        feature_ids = np.arange(500) // 4
+        points = rng.uniform(-10, 110, size=(200, 2))
+        index = geom.SegmentIndex(segments, feature_ids)
+        actual, _ = index.query(points, k=3)
+        for point, actual_dist in zip(points, actual):
+            dist, _ = geom._point_segment_distance(np.repeat(point[None], len(segments), axis=0), segments)
+            expected = np.sort([dist[feature_ids == fid].min() for fid in np.unique(feature_ids)])[:3]
+            np.testing.assert_allclose(actual_dist, expected)
+
+    def test_points_far_outside_the_grid(self):
+        segments = np.array([[[0, 0], [1, 1]], [[1, 0], [2, 0]]])
+        points = np.array([[500.0, 500.0], [-3000.0, 0.5], [1.0, 0.5]])
+        actual, actual_segments = geom.SegmentIndex(segments).query(points, k=2)
+        for point, actual_dist in zip(points, actual):
+            dist, _ = geom._point_segment_distance(np.repeat(point[None], len(segments), axis=0), segments)
+            np.testing.assert_allclose(actual_dist, np.sort(dist))
+        assert actual_segments[1, 0] == 0
+
+    def test_collinear_segments_and_k_above_number_of_features(self):
+        xs = np.linspace(0, 100, 201)
+        segments, feature_ids = geom.segments_from_polylines([np.column_stack([xs, np.zeros_like(xs)])])
+        points = np.random.default_rng(0).uniform(-50, 150, size=(200, 2))
+        index = geom.SegmentIndex(segments, feature_ids)
+        actual, actual_segments = index.query(points, k=2)
+        dist = np.hypot(points[:, 0] - points[:, 0].clip(0, 100), points[:, 1])
+        np.testing.assert_allclose(actual[:, 0], dist)
+        assert np.isinf(actual[:, 1]).all() and (actual_segments[:, 1] == -1).all()
+
+    def test_near_table_feeds_parallelizing_rotation(self):
+        segments, feature_ids = geom.segments_from_polylines([[[0, 0], [10, 0]], [[0, 5], [0, 10], [10, 10]]], [7, 8])
+        index = geom.SegmentIndex(segments, feature_ids)
+        near_table = index.generate_near_table([[5, 1], [5, 9]], k=2)
+        assert near_table.loc[near_table.NEAR_RANK == 1, "NEAR_FID"].tolist() == [7, 8]
+        np.testing.assert_allclose(near_table.loc[near_table.NEAR_RANK == 1, "NEAR_DIST"], [1, 1])
+        np.testing.assert_allclose(geom.get_parallelizing_rotation(near_table), [270, 90])
@@ -0,0 +1,79 @@
+import logging
+import queue
+import threading
+
+import pytest
+
+from utils import log
+
+
+def _record(msg, name="default", level=logging.INFO):
+    return logging.makeLogRecord({"name": name, "levelno": level, "levelname": logging.getLevelName(level), "msg": msg})
+
+
+@pytest.fixture
+def restore_logger():
+    yield
+    log.get_logger()
+
+
+class TestBoundedQueueHandler(object):
+    def test_drop_counts_records_and_reports_them_once_there_is_room(self):
+        log_queue = queue.Queue(maxsize=2)
+        handler = log._BoundedQueueHandler(log_queue, "drop")
+        for i in range(5):
+            handler.emit(_record(f"message {i}"))
+        assert handler.dropped == 3
+        assert [log_queue.get_nowait().getMessage() for _ in range(2)] == ["message 0", "message 1"]
+        handler.emit(_record("message 5"))
+        messages = [log_queue.get_nowait() for _ in range(2)]
+        assert messages[0].getMessage() == "message 5"
+        assert messages[1].levelno == logging.WARNING
+        assert messages[1].getMessage() == "Dropped 3 log records because the logging queue was full"
+        handler.emit(_record("message 6"))
+        assert log_queue.get_nowait().getMessage() == "message 6" and log_queue.empty()
+        assert handler.dropped == 3
+
+    def test_block_waits_for_room(self):
+        log_queue = queue.Queue(maxsize=1)
+        handler = log._BoundedQueueHandler(log_queue, "block")
+        handler.emit(_record("first"))
+        writer = threading.Thread(target=handler.emit, args=(_record("second"),))
+        writer.start()
+        writer.join(timeout=0.2)
+        assert writer.is_alive()
+        assert log_queue.get().getMessage() == "first"
+        writer.join(timeout=5)
+        assert not writer.is_alive()
+        assert log_queue.get_nowait().getMessage() == "second" and handler.dropped == 0
+
+    def test_invalid_overflow(self):
+        with pytest.raises(ValueError, match="'overflow' should be one of"):
+            log._BoundedQueueHandler(queue.Queue(), "wait")
+
+
+class TestGetLogger(object):
+    def test_module_level_filter_and_logger_level(self, capsys, restore_logger):
+        logger = log.get_logger(level="INFO", level_overrides={"noisy": "WARNING", "chatty": logging.DEBUG})
+        assert logger.level == logging.DEBUG
+        for name in ("noisy", "chatty", "other"):
+            for level in (logging.DEBUG, logging.INFO, logging.WARNING):
+                logger.handle(_record(f"{name} {logging.getLevelName(level)}", name=name, level=level))
+        lines = capsys.readouterr().err.splitlines()
+        assert [line.rsplit(": ", 1)[1] for line in lines] == [
+            "noisy WARNING",
+            "chatty DEBUG",
+            "chatty INFO",
+            "chatty WARNING",
+            "other INFO",
+            "other WARNING",
+        ]
+        assert log.get_logger(level="WARNING", level_overrides={"noisy": "ERROR"}).level == logging.WARNING
+        assert log.get_logger().level == logging.DEBUG
+
+    def test_async_mode_writes_records_and_counts_drops(self, capsys, restore_logger):
+        logger = log.get_logger(async_mode=True, queue_size=10, json_format=True)
+        logger.info("Hello")
+        assert log.get_dropped_count() == 0
+        log.get_logger()
+        assert '"message": "Hello"' in capsys.readouterr().err
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("sklearn")
+
+from utils import metrics
+
+
+class PrecomputedModel(object):
+    def __init__(self, y_prob):
+        self.y_prob = y_prob
+
+    def predict_proba(self, X):
+        return np.column_stack([1 - self.y_prob[X], self.y_prob[X]])
+
+
+class TestCalibrationAccumulator(object):
+    rng = np.random.default_rng(0)
+    y_prob = rng.beta(2, 5, size=100_000)
+    y_true = (rng.random(100_000) < y_prob).astype(int)
+    y_prob_by_distribution = {
+        "beta": y_prob,
+        "discrete": rng.choice(np.linspace(0.05, 0.95, 12), size=100_000),
+        "rounded": np.round(y_prob, 2),
+    }
+
+    @pytest.mark.parametrize("distribution", ["beta", "discrete", "rounded"])
+    def test_batched_quantile_score_matches_calibration_score(self, distribution):
+        y_prob = self.y_prob_by_distribution[distribution]
+        expected = metrics.calibration_score(self.y_true, np.arange(len(y_prob)), PrecomputedModel(y_prob))
+        accumulator = metrics.CalibrationAccumulator(n_bins=10)
+        batches = [slice(start, start + 30_000) for start in range(0, len(y_prob), 30_000)]
+        for batch in batches:
+            accumulator.update(self.y_true[batch], y_prob[batch])
+        # Only continuous predictions put quantile edges in fine bins of distinct values
+        assert accumulator.needs_refinement() == (distribution == "beta")
+        if accumulator.needs_refinement():
+            with pytest.raises(ValueError, match="refine"):
+                accumulator.score()
+            for batch in batches:
+                accumulator.refine(self.y_true[batch], y_prob[batch])
+        # Equal up to the order in which floats are summed
+        assert accumulator.score() == pytest.approx(expected, rel=1e-9)
+
+    def test_grouped_quantile_scores_with_groups_added_over_batches(self):
+        # each batch of 10_000 predictions brings 30 new groups
+        groups = np.arange(len(self.y_prob)) % 30 + np.arange(len(self.y_prob)) // 10_000 * 30
+        accumulator = metrics.CalibrationAccumulator(n_bins=10)
+        batches = [slice(start, start + 10_000) for start in range(0, len(self.y_prob), 10_000)]
+        for batch in batches:
+            accumulator.update(self.y_true[batch], self.y_prob[batch], groups=groups[batch])
+        for batch in batches:
+            accumulator.refine(self.y_true[batch], self.y_prob[batch], groups=groups[batch])
+        scores = accumulator.scores()
+        assert len(scores) == 300
+        for group in [0, 15, 299]:
+            mask = groups == group
+            expected = metrics.calibration_score(self.y_true[mask], np.flatnonzero(mask), PrecomputedModel(self.y_prob))
+            assert scores[group] == pytest.approx(expected, rel=1e-9)
+
+    def test_grouped_scores_and_accuracy(self):
+        groups = np.where(np.arange(len(self.y_prob)) % 2 == 0, "even", "odd")
+        accumulator = metrics.CalibrationAccumulator(n_bins=10, strategy="uniform")
+        accumulator.update(self.y_true, self.y_prob, groups=groups)
+        for group in ["even", "odd"]:
+            mask = groups == group
+            single = metrics.CalibrationAccumulator(n_bins=10, strategy="uniform")
+            single.update(self.y_true[mask], self.y_prob[mask])
+            assert accumulator.scores()[group] == pytest.approx(single.score())
+            assert accumulator.accuracy(group) == pytest.approx(((self.y_prob[mask] > 0.5) == self.y_true[mask]).mean())
@@ -0,0 +1,159 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import pandas as pandas_utils
+
+
+class TestDataFrameFormats(object):
+    def test_format_is_inferred_from_extension(self):
+        assert pandas_utils.infer_df_format("data/df.parquet") == "parquet"
+        assert pandas_utils.infer_df_format("data/df.csv.gz") == "csv.gz"
+        assert pandas_utils.infer_df_format("data/df", default="csv.gz") == "csv.gz"
+
+    @pytest.mark.parametrize("file_format", ["parquet", "feather", "csv", "csv.gz"])
+    def test_round_trip_with_column_projection(self, file_format):
+        pytest.importorskip("pyarrow")
+        df = pd.DataFrame({"a": [1, 2, 3], "b": ["x", "y", "z"]})
+        fp = io.BytesIO()
+        pandas_utils.write_df_to_buffer(df, fp, file_format)
+        fp.seek(0)
+        actual = pandas_utils.read_df_from_buffer(fp, file_format, columns=["a"])
+        pd.testing.assert_frame_equal(actual, df[["a"]])
+
+    def test_parquet_filters(self):
+        pytest.importorskip("pyarrow")
+        df = pd.DataFrame({"a": [1, 2, 3], "b": ["x", "y", "z"]})
+        fp = io.BytesIO()
+        pandas_utils.write_df_to_buffer(df, fp, "parquet")
+        fp.seek(0)
+        actual = pandas_utils.read_df_from_buffer(fp, "parquet", filters=[("a", ">", 1)])
+        assert actual["a"].tolist() == [2, 3]
+
+
+class TestChunkedDataFrameIO(object):
+    @pytest.mark.parametrize("file_format", ["parquet", "feather", "csv", "csv.gz"])
+    def test_chunks_round_trip(self, file_format):
+        pytest.importorskip("pyarrow")
+        df = pd.DataFrame({"a": range(100), "b": ["x"] * 100})
+        fp = io.BytesIO()
+        num_rows = pandas_utils.write_df_chunks_to_buffer([df.iloc[:40], df.iloc[40:]], fp, file_format)
+        fp.seek(0)
+        chunks = list(pandas_utils.iter_df_chunks_from_buffer(fp, file_format, chunksize=30))
+        assert num_rows == 100
+        assert max(len(chunk) for chunk in chunks) == 30
+        pd.testing.assert_frame_equal(pd.concat(chunks).reset_index(drop=True), df)
+
+    def test_chunk_bytes_bounds_chunk_memory(self):
+        df = pd.DataFrame({"a": range(1000)})
+        fp = io.BytesIO(df.to_csv(index=False).encode("utf-8"))
+        chunks = list(pandas_utils.iter_df_chunks_from_buffer(fp, "csv", chunk_bytes=800, probe_rows=10))
+        assert sum(len(chunk) for chunk in chunks) == 1000
+        assert all(chunk.memory_usage(index=False).sum() <= 800 for chunk in chunks)
+
+
+class TestOptimizeDfMemoryUsage(object):
+    def test_downcasts_and_converts_low_cardinality_strings(self):
+        df = pd.DataFrame(
+            {
+                "int": [1, 2, 3, 4] * 5000,
+                "float": [0.5, 1.5, 2.5, 3.5] * 5000,
+                "low_card": ["a", "b", "c", "d"] * 5000,
+                "high_card": [str(i) for i in range(20000)],
+            }
+        )
+        df, report = pandas_utils.optimize_df_memory_usage(df, sample_size=1000, max_workers=2, return_report=True)
+        assert df["int"].dtype == "int8"
+        assert df["float"].dtype == "float32"
+        assert df["low_card"].dtype == "category"
+        assert df["high_card"].dtype != "category"
+        assert (report["bytes_after"] <= report["bytes_before"]).all()
+
+    def test_sketch_resolves_inconclusive_sample(self):
+        # each value repeats 4 times, so 25% of values are unique, but a small sample sees mostly distinct values
+        df = pd.DataFrame({"col": [str(i % 25000) for i in range(100000)]})
+        df = pandas_utils.optimize_df_memory_usage(df, sample_size=100)
+        assert df["col"].dtype == "category"
+
+    def test_estimate_nunique(self):
+        series = pd.Series(range(200000)) % 50000
+        assert abs(pandas_utils.estimate_nunique(series, chunk_size=30000) / 50000 - 1) < 0.05
+        assert pandas_utils.estimate_nunique(series.iloc[:1000]) == 1000
+
+
+class TestDtypeSchema(object):
+    def test_csv_loads_with_optimized_dtypes(self):
+        df = pd.DataFrame({"int": [1, 2, 3, 4] * 10, "float": [0.5, 1.5] * 20, "cat": ["a", "b"] * 20})
+        schema = pandas_utils.get_dtype_schema(pandas_utils.optimize_df_memory_usage(df.copy()))
+        assert schema == {"int": "Int8", "float": "float32", "cat": "category"}
+        fp = io.BytesIO(df.to_csv(index=False).encode("utf-8"))
+        actual = pd.read_csv(fp, **pandas_utils.get_read_csv_kwargs(schema))
+        assert actual.dtypes.astype(str).to_dict() == {"int": "Int8", "float": "float32", "cat": "category"}
+        pd.testing.assert_frame_equal(actual.astype({"int": "int64", "float": "float64", "cat": "str"}), df)
+        assert pandas_utils.get_dtype_schema_filepath("data/df.csv.gz") == "data/df.csv.gz.dtypes.json"
+
+    def test_float32_only_when_lossless(self):
+        df = pd.DataFrame(
+            {
+                "exact": [0.25, np.nan, -3.0],
+                "inexact": [0.1, 0.2, 0.3],
+                "large": [1e300, 0.0, 1.0],
+                "float32": np.array([0.1, 0.2, 0.3], dtype="float32"),
+                "int64": [0, 2**40, 1],
+                "uint16": np.array([0, 1, 60000], dtype="uint16"),
+            }
+        )
+        schema = pandas_utils.get_dtype_schema(df)
+        assert schema == {"exact": "float32", "float32": "float32", "uint16": "UInt16"}
+        fp = io.BytesIO(df.to_csv(index=False).encode("utf-8"))
+        actual = pd.read_csv(fp, **pandas_utils.get_read_csv_kwargs(schema))
+        np.testing.assert_array_equal(actual["float32"].to_numpy(), df["float32"].to_numpy())
+        np.testing.assert_array_equal(actual["exact"].to_numpy(), df["exact"].to_numpy())
+        assert actual["inexact"].dtype == "float64" and actual["int64"].dtype == "int64"
+
+    def test_later_data_with_new_categories_and_missing_values_loads_correctly(self):
+        df = pd.DataFrame({"int": [1, 2] * 5, "cat": ["a", "b"] * 5, "date": pd.to_datetime(["2022-01-01"] * 10)})
+        schema = pandas_utils.get_dtype_schema(pandas_utils.optimize_df_memory_usage(df.copy()))
+        # a schema saved before integer dtypes were made nullable holds the numpy dtype
+        legacy_schema = {**schema, "int": "int8"}
+        later = pd.DataFrame({"int": [100, None], "cat": ["c", "a"], "date": ["2023-05-01", "2023-05-02"]})
+        for dtype_schema in (schema, legacy_schema):
+            fp = io.BytesIO(later.to_csv(index=False).encode("utf-8"))
+            actual = pd.read_csv(fp, **pandas_utils.get_read_csv_kwargs(dtype_schema))
+            assert actual["int"].dtype == "Int8"
+            assert actual["int"].iloc[0] == 100 and actual["int"].isna().iloc[1]
+            assert actual["cat"].dtype == "category" and actual["cat"].tolist() == ["c", "a"]
+            assert actual["date"].dtype.kind == "M" and actual["date"].iloc[0] == pd.Timestamp("2023-05-01")
+
+
+class TestConcatWithCategoricals(object):
+    def test_unions_categories_without_modifying_inputs(self):
+        df1 = pd.DataFrame({"cat": pd.Categorical(["a", "b", None]), "num": [1, 2, 3]})
+        df2 = pd.DataFrame({"num": [4, 5], "cat": pd.Categorical(["c", "a"])})
+        df1_before = df1.copy()
+        actual = pandas_utils.concat_with_categoricals(iter([df1, df2]))
+        assert actual["cat"].dtype == "category"
+        assert list(actual["cat"].cat.categories) == ["a", "b", "c"]
+        assert actual["cat"].tolist()[:2] + actual["cat"].tolist()[3:] == ["a", "b", "c", "a"]
+        assert pd.isna(actual["cat"].iloc[2])
+        assert actual["num"].tolist() == [1, 2, 3, 4, 5]
+        pd.testing.assert_frame_equal(df1, df1_before)
+
+    def test_column_not_categorical_in_all_frames(self):
+        df1 = pd.DataFrame({"cat": pd.Categorical(["a"])})
+        df2 = pd.DataFrame({"cat": ["b"]})
+        actual = pandas_utils.concat_with_categoricals([df1, df2])
+        assert actual["cat"].dtype != "category"
+        assert actual["cat"].tolist() == ["a", "b"]
+
+    def test_all_null_partitions_without_categories(self):
+        df1 = pd.DataFrame({"cat": pd.Categorical(["a", "b"])})
+        df2 = pd.DataFrame({"cat": pd.Categorical([None, None])})
+        actual = pandas_utils.concat_with_categoricals([df1, df2])
+        assert actual["cat"].dtype == "category"
+        assert actual["cat"].tolist()[:2] == ["a", "b"] and actual["cat"].isna().tolist() == [False, False, True, True]
+        only_nulls = pandas_utils.concat_with_categoricals([df2, df2.copy()])
+        assert only_nulls["cat"].dtype == "category" and only_nulls["cat"].isna().all()
+        assert len(only_nulls["cat"].cat.categories) == 0
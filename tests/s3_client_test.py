@@ -0,0 +1,131 @@
+import json
+import os
+import sys
+import types
+
+import pytest
+
+moto_server = pytest.importorskip("moto.server")
+try:
+    import constants
+except ImportError:
+    # The client takes the bucket it may write to and remove from from the project's constants module
+    constants = types.ModuleType("constants")
+    constants.S3_BUCKET = "test-bucket"
+    sys.modules["constants"] = constants
+s3_client = pytest.importorskip("mopy.aws.s3_client")
+
+PART_SIZE = 5 * 1024**2
+
+
+@pytest.fixture(scope="module")
+def client():
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    env = {
+        "AWS_ENDPOINT_URL": f"http://{host}:{port}",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_REGION": "us-east-1",
+    }
+    previous_env = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        client = s3_client.S3FSClient()
+        client.fs.mkdir(constants.S3_BUCKET)
+        yield client
+    finally:
+        for name, value in previous_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        server.stop()
+
+
+@pytest.fixture
+def big_file(tmp_path):
+    path = str(tmp_path / "big.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(2 * PART_SIZE + 123))
+    return path
+
+
+def count_part_uploads(client, monkeypatch, fail_from_part=None):
+    """Count upload_part calls of the client, failing those from part number fail_from_part on."""
+    call_s3 = client.fs._call_s3
+    uploaded = []
+
+    async def counting_call_s3(method, *args, **kwargs):
+        if method == "upload_part":
+            if fail_from_part is not None and kwargs["PartNumber"] >= fail_from_part:
+                raise RuntimeError("connection lost")
+            uploaded.append(kwargs["PartNumber"])
+        return await call_s3(method, *args, **kwargs)
+
+    monkeypatch.setattr(client.fs, "_call_s3", counting_call_s3)
+    return uploaded
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class TestBatchTransfers(object):
+    def test_round_trip_and_rm_many(self, client, tmp_path, big_file):
+        lpaths = [str(tmp_path / f"f{i}.bin") for i in range(5)]
+        for i, lpath in enumerate(lpaths):
+            with open(lpath, "wb") as f:
+                f.write(os.urandom(100 + i))
+        rpaths = [f"{constants.S3_BUCKET}/batch/f{i}.bin" for i in range(5)] + [f"{constants.S3_BUCKET}/batch/big.bin"]
+        client.put_many(lpaths + [big_file], rpaths, multipart_threshold=PART_SIZE, part_size=PART_SIZE)
+        assert not os.path.exists(big_file + s3_client.CHECKPOINT_SUFFIX)
+        out_paths = [str(tmp_path / "out" / os.path.basename(rpath)) for rpath in rpaths]
+        client.get_many(rpaths, out_paths)
+        for lpath, out_path in zip(lpaths + [big_file], out_paths):
+            assert read_bytes(out_path) == read_bytes(lpath)
+        client.rm_many(rpaths)
+        assert client.find(f"{constants.S3_BUCKET}/batch") == []
+
+    def test_resume_sends_only_missing_parts(self, client, big_file, monkeypatch):
+        rpath = f"{constants.S3_BUCKET}/resume/big.bin"
+        count_part_uploads(client, monkeypatch, fail_from_part=2)
+        with pytest.raises(RuntimeError):
+            client.put_many([big_file], [rpath], max_concurrency=1, multipart_threshold=1, part_size=PART_SIZE)
+        assert os.path.exists(big_file + s3_client.CHECKPOINT_SUFFIX)
+        monkeypatch.undo()
+        uploaded = count_part_uploads(client, monkeypatch)
+        client.put_many([big_file], [rpath], multipart_threshold=1, part_size=PART_SIZE)
+        assert sorted(uploaded) == [2, 3]
+        assert client.fs.cat(rpath) == read_bytes(big_file)
+        assert not os.path.exists(big_file + s3_client.CHECKPOINT_SUFFIX)
+
+    def test_expired_upload_starts_afresh(self, client, big_file, monkeypatch):
+        rpath = f"{constants.S3_BUCKET}/expired/big.bin"
+        count_part_uploads(client, monkeypatch, fail_from_part=2)
+        with pytest.raises(RuntimeError):
+            client.put_many([big_file], [rpath], max_concurrency=1, multipart_threshold=1, part_size=PART_SIZE)
+        monkeypatch.undo()
+        with open(big_file + s3_client.CHECKPOINT_SUFFIX) as f:
+            upload_id = json.load(f)["upload_id"]
+        # e.g. removed by the bucket's lifecycle rule for incomplete multipart uploads
+        client.fs.call_s3(
+            "abort_multipart_upload", Bucket=constants.S3_BUCKET, Key="expired/big.bin", UploadId=upload_id
+        )
+        uploaded = count_part_uploads(client, monkeypatch)
+        client.put_many([big_file], [rpath], multipart_threshold=1, part_size=PART_SIZE)
+        assert sorted(uploaded) == [1, 2, 3]
+        assert client.fs.cat(rpath) == read_bytes(big_file)
+
+    def test_permission_errors_name_the_operation(self, client, tmp_path):
+        lpath = str(tmp_path / "f.bin")
+        with open(lpath, "wb") as f:
+            f.write(b"x")
+        with pytest.raises(PermissionError, match="writing"):
+            client.put_many([lpath], ["other-bucket/f.bin"])
+        client.put_many([lpath], [f"{constants.S3_BUCKET}/perm/f.bin"])
+        with pytest.raises(PermissionError, match="removing"):
+            client.rm_many([f"{constants.S3_BUCKET}/perm/f.bin", f"{constants.S3_BUCKET}-prod"])
+        assert client.fs.exists(f"{constants.S3_BUCKET}/perm/f.bin")
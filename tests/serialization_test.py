@@ -0,0 +1,36 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.serialization import dump_object, is_serialized_object, load_object
+
+
+class TestDumpLoadObject(object):
+    obj = {"array": np.arange(100_000, dtype="float64"), "df": pd.DataFrame({"x": [1, 2], "s": ["a", "b"]}), "n": 7}
+
+    @pytest.mark.parametrize("codec", [None, "lz4", "zstd"])
+    def test_round_trip(self, codec):
+        pytest.importorskip({None: "pickle", "lz4": "lz4.frame", "zstd": "zstandard"}[codec])
+        fp = io.BytesIO()
+        stats = dump_object(self.obj, fp, codec=codec, block_size=64 * 1024)
+        assert stats["num_buffers"] >= 1
+        assert stats["stored_bytes"] == len(fp.getvalue())
+        fp.seek(0)
+        assert is_serialized_object(fp)
+        actual = load_object(fp)
+        np.testing.assert_array_equal(actual["array"], self.obj["array"])
+        pd.testing.assert_frame_equal(actual["df"], self.obj["df"])
+        assert actual["n"] == 7
+
+    def test_mmap_load_is_zero_copy_and_writable(self, tmp_path):
+        path = tmp_path / "obj.pkl"
+        with open(path, "wb") as f:
+            dump_object(self.obj, f)
+        with open(path, "rb") as f:
+            actual = load_object(f, use_mmap=True)
+        assert not actual["array"].flags.owndata
+        actual["array"][0] = -1
+        with open(path, "rb") as f:
+            assert load_object(f)["array"][0] == 0
@@ -0,0 +1,94 @@
+import base64
+import os
+
+import pytest
+
+google_crc32c = pytest.importorskip("google_crc32c")
+storage_client = pytest.importorskip("mopy.gcp.storage_client")
+
+
+class FakeBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def size(self):
+        return len(self.bucket.objects[self.name])
+
+    @property
+    def crc32c(self):
+        if not self.bucket.with_crc32c:
+            return None
+        return base64.b64encode(google_crc32c.Checksum(self.bucket.objects[self.name]).digest()).decode("utf-8")
+
+    def upload_from_filename(self, filename):
+        self.bucket.uploads.append(self.name)
+        with open(filename, "rb") as f:
+            self.bucket.objects[self.name] = f.read()
+
+    def download_to_filename(self, filename):
+        self.bucket.downloads.append(self.name)
+        with open(filename, "wb") as f:
+            f.write(self.bucket.objects[self.name])
+
+
+class FakeBucket(object):
+    def __init__(self):
+        self.objects, self.uploads, self.downloads = {}, [], []
+        self.with_crc32c = True
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.fake_bucket = FakeBucket()
+
+    def bucket(self, name):
+        return self.fake_bucket
+
+    def list_blobs(self, bucket_name, prefix=None):
+        names = sorted(name for name in self.fake_bucket.objects if name.startswith(prefix or ""))
+        return [FakeBlob(self.fake_bucket, name) for name in names]
+
+
+def write_files(paths_and_contents):
+    for path, content in paths_and_contents.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+
+
+class TestFolderTransfer(object):
+    @pytest.fixture
+    def client(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        write_files({"data/shards/a.bin": b"a", "data/shards/sub/b.bin": b"bb", "data/shards2/c.bin": b"ccc"})
+        return storage_client.StorageClient("bucket", client=FakeClient())
+
+    def test_round_trip_stays_within_the_folder(self, client, tmp_path):
+        assert sorted(client.upload_folder("data/shards")) == ["data/shards/a.bin", "data/shards/sub/b.bin"]
+        client.upload_folder("data/shards2")
+        downloaded = client.download_folder("data/shards", str(tmp_path / "local"))
+        assert sorted(downloaded) == [str(tmp_path / "local" / "a.bin"), str(tmp_path / "local" / "sub" / "b.bin")]
+        assert (tmp_path / "local" / "sub" / "b.bin").read_bytes() == b"bb"
+        assert not (tmp_path / "shards2").exists()
+
+    def test_existing_files_need_force_overwrite(self, client):
+        client.upload_folder("data/shards")
+        with pytest.raises(Exception, match="exists"):
+            client.upload_folder("data/shards")
+        assert len(client.upload_folder("data/shards", force_overwrite=True)) == 2
+
+    def test_skip_unchanged(self, client, tmp_path):
+        client.upload_folder("data/shards")
+        write_files({"data/shards/a.bin": b"changed"})
+        assert client.upload_folder("data/shards", skip_unchanged=True, force_overwrite=True) == ["data/shards/a.bin"]
+        local_dir = str(tmp_path / "local")
+        client.download_folder("data/shards", local_dir)
+        assert client.download_folder("data/shards", local_dir, skip_unchanged=True) == []
+        # Without a CRC32C to compare, files of the same size are downloaded again
+        client.bucket.with_crc32c = False
+        assert len(client.download_folder("data/shards", local_dir, skip_unchanged=True)) == 2
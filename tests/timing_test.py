@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+from utils.timing import TimingRegistry, timed, timed_methods
+
+
+class TestTimed(object):
+    def test_context_manager_and_decorator(self):
+        registry = TimingRegistry()
+
+        @timed("sleep", registry)
+        def sleep():
+            time.sleep(0.002)
+
+        sleep()
+        with timed("sleep", registry):
+            time.sleep(0.002)
+        histogram = registry.histograms["sleep"]
+        assert histogram.count == 2
+        assert histogram.sum_ns >= 4_000_000
+        assert histogram.quantile_upper_bound_s(0.5) >= 0.0025
+
+    def test_timed_methods_skips_private_and_generator_methods(self):
+        registry = TimingRegistry()
+
+        @timed_methods("client", registry)
+        class Client:
+            def load(self):
+                return self._helper()
+
+            def _helper(self):
+                return 1
+
+            def iterate(self):
+                yield 1
+
+        client = Client()
+        assert client.load() == 1
+        assert list(client.iterate()) == [1]
+        assert list(registry.histograms) == ["client.load"]
+
+    def test_prometheus_export(self):
+        registry = TimingRegistry(buckets_s=(0.001, 1))
+        registry.observe("op", 2_000_000)
+        assert registry.export_prometheus().splitlines()[2:] == [
+            'operation_duration_seconds_bucket{operation="op",le="0.001"} 0',
+            'operation_duration_seconds_bucket{operation="op",le="1"} 1',
+            'operation_duration_seconds_bucket{operation="op",le="+Inf"} 1',
+            'operation_duration_seconds_sum{operation="op"} 0.002',
+            'operation_duration_seconds_count{operation="op"} 1',
+        ]
+
+
+class TestServerMetrics(object):
+    def test_metrics_include_client_timings(self):
+        mopy_timing = pytest.importorskip("mopy.utils.timing")
+        pytest.importorskip("flask")
+        from templates.flask_app import start_model_server as server
+
+        with mopy_timing.timed("clickhouse.query_to_parquet"):
+            pass
+        response = server.app.test_client().get("/metrics")
+        assert 'operation="clickhouse.query_to_parquet"' in response.get_data(as_text=True)
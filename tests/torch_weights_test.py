@@ -0,0 +1,135 @@
+import importlib.util
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+nn = torch.nn
+
+# The repo's torch directory is shadowed by the torch package itself, so the module is loaded from its path
+_spec = importlib.util.spec_from_file_location(
+    "torch_weights", os.path.join(os.path.dirname(__file__), "..", "torch", "weights.py")
+)
+weights = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(weights)
+
+
+class TiedModel(nn.Module):
+    def __init__(self, vocab_size=10, dim=4):
+        super().__init__()
+        self.embedding = nn.Embedding(vocab_size, dim)
+        self.head = nn.Linear(dim, vocab_size, bias=False)
+        self.head.weight = self.embedding.weight
+        self.norm = nn.LayerNorm(dim)
+        self.register_buffer("steps", torch.zeros(1, dtype=torch.int64))
+        self.register_buffer("inv_freq", 1.0 / 10000 ** (torch.arange(0, dim, 2) / dim), persistent=False)
+
+
+def _round_trip(tensors, tmp_path, metadata=None):
+    path = tmp_path / "weights.safetensors"
+    with open(path, "wb") as f:
+        weights.write_tensors(tensors, f, metadata=metadata)
+    with open(path, "rb") as f:
+        return weights.read_tensors(f)
+
+
+class TestWriteReadTensors(object):
+    def test_round_trip(self, tmp_path):
+        tensors = {
+            "f32": torch.randn(3, 5),
+            "bf16": torch.randn(7).to(torch.bfloat16),
+            "i8": torch.arange(-3, 4, dtype=torch.int8),
+            "bool": torch.tensor([True, False, True]),
+            "empty": torch.zeros(0, 4),
+            "transposed": torch.randn(4, 6).t(),
+        }
+        actual, metadata = _round_trip(tensors, tmp_path, metadata={"format": "pt"})
+        assert metadata == {"format": "pt"}
+        assert actual.keys() == tensors.keys()
+        for name, tensor in tensors.items():
+            assert actual[name].dtype == tensor.dtype
+            torch.testing.assert_close(actual[name], tensor, rtol=0, atol=0)
+
+    @pytest.mark.parametrize("name", ["U16", "U32", "U64", "F8_E4M3", "F8_E5M2", "C64"])
+    def test_round_trip_recent_dtypes(self, tmp_path, name):
+        if name not in weights.DTYPE_BY_NAME:
+            pytest.skip(f"{name} is not available in torch {torch.__version__}")
+        dtype = weights.DTYPE_BY_NAME[name]
+        tensor = torch.arange(6, dtype=torch.float32).reshape(2, 3).to(dtype)
+        actual, _ = _round_trip({"x": tensor, "y": torch.ones(3)}, tmp_path)
+        assert actual["x"].dtype == dtype
+        assert torch.equal(actual["x"].view(torch.uint8), tensor.view(torch.uint8))
+
+    def test_unsupported_dtype(self, tmp_path):
+        path = tmp_path / "weights.safetensors"
+        header = b'{"x":{"dtype":"F4","shape":[2],"data_offsets":[0,1]}}'
+        path.write_bytes(len(header).to_bytes(8, "little") + header + b"\x00")
+        with open(path, "rb") as f, pytest.raises(ValueError, match="Unsupported dtype F4 of tensor x"):
+            weights.read_tensors(f)
+
+    def test_read_tensors_are_writable_without_changing_the_file(self, tmp_path):
+        _round_trip({"x": torch.ones(8)}, tmp_path)
+        with open(tmp_path / "weights.safetensors", "rb") as f:
+            tensors, _ = weights.read_tensors(f)
+        tensors["x"] += 1
+        with open(tmp_path / "weights.safetensors", "rb") as f:
+            torch.testing.assert_close(weights.read_tensors(f)[0]["x"], torch.ones(8))
+
+    def test_compatible_with_safetensors(self, tmp_path):
+        safetensors_torch = pytest.importorskip("safetensors.torch")
+        tensors = {"a": torch.randn(2, 3), "b": torch.arange(5, dtype=torch.int64), "c": torch.randn(3).half()}
+        with open(tmp_path / "ours.safetensors", "wb") as f:
+            weights.write_tensors(tensors, f, metadata={"k": "v"})
+        for name, tensor in safetensors_torch.load_file(tmp_path / "ours.safetensors").items():
+            torch.testing.assert_close(tensor, tensors[name])
+        safetensors_torch.save_file(tensors, tmp_path / "theirs.safetensors")
+        with open(tmp_path / "theirs.safetensors", "rb") as f:
+            actual, _ = weights.read_tensors(f)
+        for name, tensor in tensors.items():
+            torch.testing.assert_close(actual[name], tensor)
+
+
+class TestStateDict(object):
+    def test_tied_weights_are_stored_once_and_restored(self, tmp_path):
+        model = TiedModel()
+        tensors, aliases = weights.get_state_dict(model)
+        assert aliases == {"head.weight": "embedding.weight"}
+        assert "head.weight" not in tensors and "inv_freq" not in tensors
+        state_dict, _ = _round_trip(tensors, tmp_path)
+        for name, target in aliases.items():
+            state_dict[name] = state_dict[target]
+
+        loaded = weights.build_on_meta(TiedModel)
+        loaded.load_state_dict(state_dict, assign=True)
+        assert loaded.inv_freq.is_meta
+        assert weights.materialize_buffers(loaded, TiedModel, {}) == ["inv_freq"]
+        assert not any(tensor.is_meta for tensor in list(loaded.parameters()) + list(loaded.buffers()))
+        for name, tensor in model.state_dict().items():
+            torch.testing.assert_close(loaded.state_dict()[name], tensor)
+        torch.testing.assert_close(loaded.inv_freq, model.inv_freq)
+        assert "inv_freq" not in loaded.state_dict()
+        tokens = torch.tensor([1, 2, 3])
+        torch.testing.assert_close(loaded.head(loaded.embedding(tokens)), model.head(model.embedding(tokens)))
+
+    def test_materialize_buffers_keeps_parameters_of_the_second_instance_on_meta(self):
+        instances = []
+
+        class RecordedModel(TiedModel):
+            def __init__(self, **kwargs):
+                super().__init__(**kwargs)
+                instances.append(self)
+
+        loaded = weights.build_on_meta(RecordedModel, dim=8)
+        assert weights.materialize_buffers(loaded, RecordedModel, {"dim": 8}) == ["steps", "inv_freq"]
+        assert all(param.is_meta for param in instances[-1].parameters())
+        assert instances[-1].head.weight is instances[-1].embedding.weight
+        assert not loaded.inv_freq.is_meta and loaded.embedding.weight.is_meta
+        torch.testing.assert_close(loaded.inv_freq, TiedModel(dim=8).inv_freq)
+        assert nn.Module.register_parameter is weights.nn.Module.register_parameter
+        assert not nn.Linear(2, 2).weight.is_meta
+
+    def test_split_into_shards(self):
+        tensors = {"a": torch.zeros(10), "b": torch.zeros(10), "c": torch.zeros(30), "d": torch.zeros(5)}
+        shards = weights.split_into_shards(tensors, max_shard_size=80)
+        assert [list(shard) for shard in shards] == [["a", "b"], ["c"], ["d"]]
+        assert [list(shard) for shard in weights.split_into_shards(tensors, max_shard_size=10**6)] == [list(tensors)]
@@ -0,0 +1,210 @@
+"""
+Reading and writing of model weights in the safetensors format: a JSON header followed by the raw tensor bytes,
+so that a file can be memory-mapped and its tensors used in place, without unpickling or copying.
+Files written here can be read with the `safetensors` package and vice versa.
+"""
+
+import json
+import mmap
+import struct
+from contextlib import contextmanager
+from typing import Optional, Union
+
+import torch
+from torch import nn as nn
+from torch.overrides import TorchFunctionMode
+
+DTYPE_BY_NAME = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+    "C64": torch.complex64,
+}
+# Unsigned and float8 dtypes only exist in recent versions of torch
+for _name, _attr in [
+    ("U64", "uint64"),
+    ("U32", "uint32"),
+    ("U16", "uint16"),
+    ("F8_E4M3", "float8_e4m3fn"),
+    ("F8_E4M3FNUZ", "float8_e4m3fnuz"),
+    ("F8_E5M2", "float8_e5m2"),
+    ("F8_E5M2FNUZ", "float8_e5m2fnuz"),
+]:
+    if hasattr(torch, _attr):
+        DTYPE_BY_NAME[_name] = getattr(torch, _attr)
+NAME_BY_DTYPE = {dtype: name for name, dtype in DTYPE_BY_NAME.items()}
+HEADER_ALIGNMENT = 8
+RANDOM_INIT_FUNCTIONS = {
+    "normal_",
+    "uniform_",
+    "trunc_normal_",
+    "kaiming_normal_",
+    "kaiming_uniform_",
+    "xavier_normal_",
+    "xavier_uniform_",
+    "orthogonal_",
+    "sparse_",
+}
+
+
+class _SkipRandomInit(TorchFunctionMode):
+    """
+    Random initialisation does nothing on meta tensors, yet some of it is slow there:
+    the first normal_ on the meta device imports torch._dynamo, which adds seconds to a cold start.
+    With meta_only=False it is skipped on any device, for models whose parameters are thrown away.
+    """
+
+    def __init__(self, meta_only=True):
+        super().__init__()
+        self.meta_only = meta_only
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if getattr(func, "__name__", None) in RANDOM_INIT_FUNCTIONS:
+            tensor = args[0] if args else kwargs.get("tensor")
+            if isinstance(tensor, torch.Tensor) and (tensor.is_meta or not self.meta_only):
+                return tensor
+        return func(*args, **kwargs)
+
+
+def build_on_meta(model_cls: type[nn.Module], **model_kwargs) -> nn.Module:
+    """
+    Instantiate a model on the meta device: no memory is allocated and no weights are initialised,
+    to be filled in with `model.load_state_dict(state_dict, assign=True)`.
+    """
+    with torch.device("meta"), _SkipRandomInit():
+        return model_cls(**model_kwargs)
+
+
+def materialize_buffers(model: nn.Module, model_cls: type[nn.Module], model_kwargs: dict, device="cpu") -> list[str]:
+    """
+    Fill in the buffers of a model built with `build_on_meta` that are still on the meta device after loading,
+    i.e. non-persistent buffers computed in __init__, such as rotary embedding frequencies.
+    They are taken from a second instance whose buffers are computed on device while its parameters are moved
+    to the meta device as they are registered, so at most one parameter at a time takes up memory on device.
+    :return: names of the buffers filled in
+    """
+    names = [name for name, buffer in model.named_buffers() if buffer.is_meta]
+    if not names:
+        return names
+    with torch.device(device), _SkipRandomInit(meta_only=False), _register_parameters_on_meta():
+        buffers = dict(model_cls(**model_kwargs).named_buffers())
+    for name in names:
+        if name in buffers:
+            module_name, _, buffer_name = name.rpartition(".")
+            setattr(model.get_submodule(module_name), buffer_name, buffers[name])
+    return [name for name in names if name in buffers]
+
+
+@contextmanager
+def _register_parameters_on_meta():
+    """
+    Move parameters to the meta device as modules register them. Patches nn.Module, so it is not thread-safe.
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_on_meta(module, name, param):
+        if param is not None and not param.is_meta:
+            param = type(param)(param.to("meta"), requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    nn.Module.register_parameter = register_on_meta
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def get_state_dict(model_or_state_dict: Union[nn.Module, dict]) -> tuple[dict[str, torch.Tensor], dict[str, str]]:
+    """
+    Return the state_dict with tensors sharing memory, e.g. tied embeddings, reduced to their first name,
+    plus a dict of the dropped names to the names kept, to restore them on load.
+    """
+    state_dict = model_or_state_dict.state_dict() if isinstance(model_or_state_dict, nn.Module) else model_or_state_dict
+    tensors, aliases, name_by_storage = {}, {}, {}
+    for name, tensor in state_dict.items():
+        key = (tensor.device, tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tensor.shape, tensor.dtype)
+        if tensor.numel() and key in name_by_storage:
+            aliases[name] = name_by_storage[key]
+        else:
+            name_by_storage[key] = name
+            tensors[name] = tensor
+    return tensors, aliases
+
+
+def write_tensors(tensors: dict[str, torch.Tensor], fp, metadata: Optional[dict[str, str]] = None) -> None:
+    """
+    Write tensors to a binary file object in the safetensors format.
+    Tensors are laid out by decreasing item size, so that each one starts aligned to its dtype.
+    """
+    tensors = {name: tensor.detach().cpu().contiguous() for name, tensor in tensors.items()}
+    header, offset = {}, 0
+    if metadata:
+        header["__metadata__"] = metadata
+    order = sorted(tensors, key=lambda name: -tensors[name].element_size())
+    for name in order:
+        tensor = tensors[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        if tensor.dtype not in NAME_BY_DTYPE:
+            raise ValueError(f"Unsupported dtype {tensor.dtype} of tensor {name}")
+        header[name] = {
+            "dtype": NAME_BY_DTYPE[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % HEADER_ALIGNMENT)
+    fp.write(struct.pack("<Q", len(header_bytes)) + header_bytes)
+    for name in order:
+        if tensors[name].numel():
+            fp.write(tensors[name].reshape(-1).view(torch.uint8).numpy().data)
+
+
+def read_tensors(fp) -> tuple[dict[str, torch.Tensor], dict[str, str]]:
+    """
+    Memory-map a local safetensors file and return its tensors, backed by the mapping, and its metadata.
+    Nothing is read until a tensor is used, and untouched weights never take up private memory.
+    The mapping is copy-on-write, so tensors are writable without changing the file.
+    """
+    mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+    (header_nbytes,) = struct.unpack("<Q", mapping[:8])
+    header = json.loads(mapping[8 : 8 + header_nbytes])
+    metadata = header.pop("__metadata__", {})
+    data_start = 8 + header_nbytes
+    tensors = {}
+    for name, info in header.items():
+        if info["dtype"] not in DTYPE_BY_NAME:
+            raise ValueError(f"Unsupported dtype {info['dtype']} of tensor {name} with torch {torch.__version__}")
+        dtype = DTYPE_BY_NAME[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+        else:
+            count = (end - begin) // dtype.itemsize
+            tensor = torch.frombuffer(mapping, dtype=dtype, count=count, offset=data_start + begin)
+            tensors[name] = tensor.reshape(info["shape"])
+    return tensors, metadata
+
+
+def split_into_shards(tensors: dict[str, torch.Tensor], max_shard_size: int) -> list[dict[str, torch.Tensor]]:
+    """
+    Greedily split tensors, in order, into shards of at most max_shard_size bytes each;
+    a single tensor larger than that gets a shard of its own.
+    """
+    shards, shard_size = [{}], 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        if shards[-1] and shard_size + nbytes > max_shard_size:
+            shards.append({})
+            shard_size = 0
+        shards[-1][name] = tensor
+        shard_size += nbytes
+    return shards
@@ -0,0 +1,140 @@
+"""
+Local on-disk read-through cache for remote objects, shared safely between processes on one host.
+Example usage:
+from utils.cache import DiskCache
+cache = DiskCache("/tmp/mopy-cache", max_size_bytes=20 * 1024**3)
+storage_client = StorageClient("my-bucket", cache=cache)
+model = storage_client.load_torch_model("models/model.pt")  # downloads
+model = storage_client.load_torch_model("models/model.pt")  # one metadata call, served from disk
+cache.stats
+>> {'hits': 1, 'misses': 1, 'bytes_saved': 104857600, 'bytes_downloaded': 104857600}
+"""
+
+import fcntl
+from contextlib import contextmanager
+import hashlib
+import os
+import tempfile
+
+
+class DiskCache:
+    """
+    Content-addressed cache: entries are keyed by the object's location plus its version (GCS generation, S3 ETag),
+    so a changed object is simply a new entry and stale ones age out through LRU eviction.
+    Entries are written to a temporary file and atomically renamed into place; flock-based locks
+    keep concurrent processes from downloading the same entry twice or evicting a file that is being opened.
+    """
+
+    num_lock_stripes = 64
+
+    def __init__(self, cache_dir, max_size_bytes=10 * 1024**3):
+        """
+        :param cache_dir: directory to keep the cached files in; created if missing
+        :param max_size_bytes: total size of cached files above which least recently used ones are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_downloaded = 0
+        os.makedirs(os.path.join(cache_dir, "locks"), exist_ok=True)
+
+    @property
+    def stats(self):
+        """Hit/miss counters of this process."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "bytes_downloaded": self.bytes_downloaded,
+        }
+
+    def open(self, key, version, size, download_fn):
+        """
+        Return a binary file object with the cached content of key at the given version,
+        calling download_fn(fp) to fill the cache entry on a miss.
+        :param key: str, location of the object, e.g. 'gs://bucket/models/model.pt'
+        :param version: generation, ETag or any other value that changes whenever the object changes
+        :param size: size of the object in bytes, as reported by the metadata call
+        :param download_fn: callable writing the object's content to the binary file object it is given
+        """
+        entry_path = self._entry_path(key, version)
+        entry_name = os.path.basename(entry_path)
+        with self._lock(self._stripe_lock_path(entry_name)):
+            if os.path.isfile(entry_path):
+                self.hits += 1
+                self.bytes_saved += size
+                os.utime(entry_path)
+            else:
+                self.misses += 1
+                self._download(entry_path, download_fn)
+                self.bytes_downloaded += os.path.getsize(entry_path)
+            fp = open(entry_path, "rb")
+        self._evict(keep_entry_name=entry_name)
+        return fp
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_size_bytes.
+        """
+        self._evict()
+
+    def _evict(self, keep_entry_name=None):
+        # The entry just opened is kept even when it does not fit on its own, or it would be downloaded on every open
+        with self._lock(os.path.join(self.cache_dir, "locks", "evict")):
+            entries = []
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.startswith(".") and entry.name != keep_entry_name:
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.name))
+            total_size = sum(size for _, size, _ in entries)
+            if keep_entry_name is not None and os.path.isfile(os.path.join(self.cache_dir, keep_entry_name)):
+                total_size += os.path.getsize(os.path.join(self.cache_dir, keep_entry_name))
+            for _, size, name in sorted(entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                with self._lock(self._stripe_lock_path(name)):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except FileNotFoundError:
+                        pass
+                total_size -= size
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        max_size_bytes, self.max_size_bytes = self.max_size_bytes, -1
+        try:
+            self.evict()
+        finally:
+            self.max_size_bytes = max_size_bytes
+
+    def _download(self, entry_path, download_fn):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                download_fn(fp)
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _entry_path(self, key, version):
+        return os.path.join(self.cache_dir, hashlib.sha256(f"{key}\0{version}".encode("utf-8")).hexdigest())
+
+    def _stripe_lock_path(self, entry_name):
+        stripe = int(entry_name[:8], 16) % self.num_lock_stripes
+        return os.path.join(self.cache_dir, "locks", f"{stripe:02d}")
+
+    @staticmethod
+    @contextmanager
+    def _lock(lock_path):
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -4,15 +4,19 @@ from datetime import datetime
 
 
 class Timer:
-    """Measures the time between two events"""
+    """Measures the time between two events, on a monotonic clock with nanosecond resolution"""
 
     def __init__(self):
         """Create the object and start the virtual timer."""
-        self._start = time.time()
+        self._start = time.perf_counter_ns()
 
     def get_duration(self) -> int:
         """Get number of seconds that passed from starting the virtual timer."""
-        return int(time.time() - self._start)
+        return self.get_duration_ns() // 1_000_000_000
+
+    def get_duration_ns(self) -> int:
+        """Get number of nanoseconds that passed from starting the virtual timer."""
+        return time.perf_counter_ns() - self._start
 
 
 def get_date_iso_8601(include_time=False):
@@ -6,18 +6,138 @@ logger.debug("Testing stuff")
 logger.info("Hello")
 logger.warning("Whoops!")
 logger.error("Uh-oh...")
+
+On latency-sensitive paths, switch the same logger to non-blocking mode once at startup;
+records are then handed to a background thread through a bounded queue:
+from utils.log import get_logger
+get_logger(async_mode=True, queue_size=10_000, overflow="drop", level_overrides={"storage_client": "WARNING"})
+Records dropped because the queue was full are reported in a warning once there is room again,
+and counted by get_dropped_count().
 """
+
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import threading
+
+_listener = None
+
+
+class _BoundedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that either drops records or blocks the caller when the queue is full"""
+
+    def __init__(self, log_queue, overflow):
+        super().__init__(log_queue)
+        if overflow not in ("drop", "block"):
+            raise ValueError("'overflow' should be one of: 'drop', 'block'")
+        self.overflow = overflow
+        self.dropped = 0
+        self._unreported = 0
+        self._dropped_lock = threading.Lock()
+
+    def enqueue(self, record):
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+                self._unreported += 1
+            return
+        if self._unreported:
+            self._report_dropped(record.name)
+
+    def _report_dropped(self, name):
+        with self._dropped_lock:
+            if not self._unreported:
+                return
+            warning = logging.makeLogRecord(
+                {
+                    "name": name,
+                    "levelno": logging.WARNING,
+                    "levelname": logging.getLevelName(logging.WARNING),
+                    "msg": f"Dropped {self._unreported} log records because the logging queue was full",
+                }
+            )
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                return
+            self._unreported = 0
+
+
+class _ModuleLevelFilter(logging.Filter):
+    """Apply per-module minimum levels, matched on the record's logger name or module (file name)"""
 
+    def __init__(self, level_overrides, level=logging.DEBUG):
+        super().__init__()
+        self.level_overrides = {name: _to_level(level) for name, level in level_overrides.items()}
+        self.level = _to_level(level)
 
-def get_logger() -> logging.Logger:
+    def filter(self, record):
+        level = self.level_overrides.get(record.name, self.level_overrides.get(record.module, self.level))
+        return record.levelno >= level
+
+
+def _to_level(level):
+    return level if isinstance(level, int) else logging.getLevelName(level)
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            "level": record.levelname,
+            "process": record.process,
+            "file": record.filename,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def get_logger(
+    async_mode=False, queue_size=10_000, overflow="drop", level_overrides=None, json_format=False, level="DEBUG"
+) -> logging.Logger:
+    """
+    Configure and return the "default" logger; calling it again reconfigures the same logger object in place,
+    so modules that already imported `logger` pick up the new settings.
+    The logger's own level is the lowest of the configured levels, so that records below all of them
+    are discarded before they are created, let alone queued.
+    :param async_mode: if True, records are put on a bounded queue and written by a listener thread
+    :param queue_size: maximum number of records waiting to be written in async mode
+    :param overflow: what to do with records when the queue is full: 'drop' them or 'block' the caller
+    :param level_overrides: dict of logger or module name to minimum level, e.g. {"storage_client": "WARNING"}
+    :param json_format: if True, emit one JSON object per record
+    :param level: minimum level of modules without an entry in level_overrides
+    """
+    global _listener
     l = logging.getLogger("default")
-    fmt = logging.Formatter(
-        "[%(asctime)s] %(levelname)-8s [%(process)d][%(filename)s:%(lineno)+3s]: %(message)s", "%Y-%m-%d %H:%M:%S"
-    )
+    if json_format:
+        fmt = _JsonFormatter()
+    else:
+        fmt = logging.Formatter(
+            "[%(asctime)s] %(levelname)-8s [%(process)d][%(filename)s:%(lineno)+3s]: %(message)s", "%Y-%m-%d %H:%M:%S"
+        )
     handler = logging.StreamHandler()
     handler.setFormatter(fmt)
-    l.setLevel(logging.DEBUG)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if async_mode:
+        log_queue = queue.Queue(maxsize=queue_size)
+        _listener = logging.handlers.QueueListener(log_queue, handler)
+        _listener.start()
+        handler = _BoundedQueueHandler(log_queue, overflow)
+    if level_overrides:
+        handler.addFilter(_ModuleLevelFilter(level_overrides, level))
+    l.setLevel(min(_to_level(lvl) for lvl in [level, *(level_overrides or {}).values()]))
     if l.hasHandlers():
         l.handlers.clear()
     l.addHandler(handler)
@@ -25,4 +145,16 @@ def get_logger() -> logging.Logger:
     return l
 
 
+def get_dropped_count() -> int:
+    """Number of records the "default" logger dropped in async mode because the queue was full"""
+    handlers = logging.getLogger("default").handlers
+    return sum(handler.dropped for handler in handlers if isinstance(handler, _BoundedQueueHandler))
+
+
+@atexit.register
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
 logger = get_logger()
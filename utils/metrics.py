@@ -19,3 +19,212 @@ def accuracy_calibration_error(accuracy, calibration, accuracy_calibration_weigh
     accuracy_calibration_weight around 20 seems to provide good balance between them.
     """
     return (1.0 - accuracy) + accuracy_calibration_weight * calibration
+
+
+class CalibrationAccumulator:
+    """
+    Incrementally computes calibration_score, and the accuracy for accuracy_calibration_error, from batches of
+    predictions, optionally for many segments at once, without holding all predictions in memory.
+    Predictions are counted in a histogram of `resolution` fine bins per segment, from which the
+    {n_bins} probability bins are derived at the end. With strategy="uniform" the result is exact.
+    With strategy="quantile" (as in calibration_score) it is exact too: the quantile bin edges are order statistics
+    of the predictions, known from the histogram when their fine bin holds a single distinct value, e.g. for
+    rounded or discrete predictions. Otherwise the same batches are passed once more through `refine`, which keeps
+    only the predictions in the few fine bins holding an edge.
+
+    Usage example:
+        acc = CalibrationAccumulator(n_bins=10)
+        for X_batch, y_batch, segment_batch in batches:
+            acc.update(y_batch, model.predict_proba(X_batch)[:, 1], groups=segment_batch)
+        if acc.needs_refinement():
+            for X_batch, y_batch, segment_batch in batches:
+                acc.refine(y_batch, model.predict_proba(X_batch)[:, 1], groups=segment_batch)
+        acc.scores()
+        >> {'segment_a': 0.0021, 'segment_b': 0.0035}
+    """
+
+    def __init__(self, n_bins=10, strategy="quantile", resolution=10_000):
+        if strategy not in ("quantile", "uniform"):
+            raise ValueError("'strategy' should be one of: 'quantile', 'uniform'")
+        self.n_bins = n_bins
+        self.strategy = strategy
+        self.fine_edges = np.linspace(0.0, 1.0, (resolution if strategy == "quantile" else n_bins) + 1)
+        self.groups = {}
+        self._allocate(0)
+        self._refinement = []
+        self._pending = None
+
+    def update(self, y_true, y_prob, groups=None):
+        """
+        Add a batch of labels and predicted probabilities of the positive class.
+        :param groups: optional array of segment labels, one per prediction; all predictions form one segment if None
+        """
+        y_true, y_prob, group_idx, flat_idx = self._locate(y_true, y_prob, groups, add_groups=True)
+        bins, inverse = np.unique(flat_idx, return_inverse=True)
+        self._total.reshape(-1)[bins] += np.bincount(inverse)
+        self._sum_prob.reshape(-1)[bins] += np.bincount(inverse, weights=y_prob)
+        self._sum_true.reshape(-1)[bins] += np.bincount(inverse, weights=y_true)
+        if self.strategy == "quantile":
+            batch_min, batch_max = np.full(len(bins), np.inf), np.full(len(bins), -np.inf)
+            np.minimum.at(batch_min, inverse, y_prob)
+            np.maximum.at(batch_max, inverse, y_prob)
+            min_prob, max_prob = self._min_prob.reshape(-1), self._max_prob.reshape(-1)
+            min_prob[bins] = np.minimum(min_prob[bins], batch_min)
+            max_prob[bins] = np.maximum(max_prob[bins], batch_max)
+        self._correct += np.bincount(group_idx, weights=(y_prob > 0.5) == y_true, minlength=len(self._correct))
+        # Edges move with new predictions, so an earlier refinement no longer applies
+        self._refinement, self._pending = [], None
+
+    def needs_refinement(self):
+        """
+        Whether some quantile bin edge falls in a fine bin of distinct predictions, so that the batches passed to
+        `update` have to be passed to `refine` as well before computing scores.
+        """
+        return self.strategy == "quantile" and len(self._pending_bins()) > 0 and not self._refinement
+
+    def refine(self, y_true, y_prob, groups=None):
+        """
+        Second pass over the batches passed to `update`, keeping the predictions in the fine bins that hold
+        a quantile bin edge, to locate the edges exactly.
+        """
+        pending = self._pending_bins()
+        y_true, y_prob, _, flat_idx = self._locate(y_true, y_prob, groups, add_groups=False)
+        keep = np.isin(flat_idx, pending)
+        self._refinement.append((flat_idx[keep], y_prob[keep], y_true[keep]))
+
+    def calibration_curve(self, group=None):
+        """
+        :return: tuple of arrays (prob_true, prob_pred) of the non-empty bins, as in sklearn's calibration_curve
+        """
+        i = self.groups[group]
+        total, sum_prob, sum_true = self._total[i], self._sum_prob[i], self._sum_true[i]
+        if self.strategy == "quantile":
+            edges = self._quantile_edges(i)[1:-1]
+            # Fine bins holding an edge are split by the refined predictions, the others go whole into one bin
+            split = self._split_bins(i)
+            whole = np.ones(len(total), dtype=bool)
+            whole[split] = False
+            coarse_idx = np.searchsorted(edges, self._min_prob[i][whole])
+            bin_total = np.bincount(coarse_idx, weights=total[whole], minlength=self.n_bins)
+            bin_sum_prob = np.bincount(coarse_idx, weights=sum_prob[whole], minlength=self.n_bins)
+            bin_sum_true = np.bincount(coarse_idx, weights=sum_true[whole], minlength=self.n_bins)
+            for b in split:
+                probs, trues = self._refined_predictions(i, b)
+                coarse_idx = np.searchsorted(edges, probs)
+                bin_total += np.bincount(coarse_idx, minlength=self.n_bins)
+                bin_sum_prob += np.bincount(coarse_idx, weights=probs, minlength=self.n_bins)
+                bin_sum_true += np.bincount(coarse_idx, weights=trues, minlength=self.n_bins)
+            total, sum_prob, sum_true = bin_total, bin_sum_prob, bin_sum_true
+        nonzero = total != 0
+        return sum_true[nonzero] / total[nonzero], sum_prob[nonzero] / total[nonzero]
+
+    def score(self, group=None):
+        """Calibration score of a segment, as computed by calibration_score."""
+        prob_true, prob_pred = self.calibration_curve(group)
+        return np.sum((prob_true - prob_pred) ** 2)
+
+    def scores(self):
+        """Calibration scores of all segments, in one dict."""
+        return {group: self.score(group) for group in self.groups}
+
+    def accuracy(self, group=None):
+        """Share of predictions on the correct side of 0.5."""
+        i = self.groups[group]
+        return self._correct[i] / self._total[i].sum()
+
+    def accuracy_calibration_error(self, accuracy_calibration_weight, group=None):
+        return accuracy_calibration_error(self.accuracy(group), self.score(group), accuracy_calibration_weight)
+
+    def _allocate(self, num_groups):
+        """Grow the per-group arrays to hold num_groups rows, keeping their contents."""
+        num_fine_bins = len(self.fine_edges) - 1
+        old = getattr(self, "_correct", np.zeros(0))
+        arrays = {"_total": 0.0, "_sum_prob": 0.0, "_sum_true": 0.0}
+        if self.strategy == "quantile":
+            arrays.update({"_min_prob": np.inf, "_max_prob": -np.inf})
+        for name, fill_value in arrays.items():
+            array = np.full((num_groups, num_fine_bins), fill_value)
+            array[: len(old)] = getattr(self, name, array[:0])
+            setattr(self, name, array)
+        self._correct = np.zeros(num_groups)
+        self._correct[: len(old)] = old
+
+    def _locate(self, y_true, y_prob, groups, add_groups):
+        """
+        :return: y_true and y_prob as float arrays, the group index of each prediction and its flat fine bin index
+        """
+        y_true = np.asarray(y_true, dtype=float)
+        y_prob = np.asarray(y_prob, dtype=float)
+        if groups is None:
+            labels, inverse = [None], np.zeros(len(y_prob), dtype=int)
+        else:
+            labels, inverse = np.unique(np.asarray(groups), return_inverse=True)
+            labels, inverse = labels.tolist(), inverse.ravel()
+        for label in labels:
+            if label not in self.groups:
+                if not add_groups:
+                    raise ValueError(f"Group {label!r} was not passed to update")
+                self.groups[label] = len(self.groups)
+        if len(self.groups) > len(self._correct):
+            # Grow geometrically, so that adding groups one batch at a time stays linear overall
+            self._allocate(max(len(self.groups), 2 * len(self._correct)))
+        group_idx = np.array([self.groups[label] for label in labels], dtype=int)[inverse]
+        flat_idx = group_idx * (len(self.fine_edges) - 1) + np.searchsorted(self.fine_edges[1:-1], y_prob)
+        return y_true, y_prob, group_idx, flat_idx
+
+    def _quantile_ranks(self, i):
+        """
+        Ranks of the sorted predictions that np.percentile interpolates between at the n_bins quantiles,
+        the interpolation weights, and the fine bins holding those ranks.
+        """
+        n = int(self._total[i].sum())
+        virtual = (n - 1) * (np.linspace(0, 1, self.n_bins + 1) * 100 / 100)
+        lower = np.minimum(np.floor(virtual), n - 1).astype(int)
+        upper = np.minimum(lower + 1, n - 1)
+        cumulative = np.cumsum(self._total[i])
+        lower_bins = np.searchsorted(cumulative, lower, side="right")
+        upper_bins = np.searchsorted(cumulative, upper, side="right")
+        return lower, upper, virtual - lower, lower_bins, upper_bins, cumulative
+
+    def _split_bins(self, i):
+        """Fine bins of a group that hold an edge's rank but also distinct predictions."""
+        _, _, _, lower_bins, upper_bins, _ = self._quantile_ranks(i)
+        bins = np.unique(np.concatenate([lower_bins, upper_bins]))
+        return bins[self._min_prob[i][bins] < self._max_prob[i][bins]]
+
+    def _pending_bins(self):
+        """Flat indices of the fine bins of all groups whose predictions are needed by `refine`."""
+        if self._pending is None:
+            num_fine_bins = len(self.fine_edges) - 1
+            bins = [i * num_fine_bins + self._split_bins(i) for i in self.groups.values()]
+            self._pending = np.concatenate(bins) if bins else np.zeros(0, dtype=int)
+        return self._pending
+
+    def _refined_predictions(self, i, b):
+        """:return: sorted predictions of fine bin b of group i kept by `refine`, and their labels"""
+        if not self._refinement:
+            raise ValueError("Quantile bin edges fall in fine bins of distinct predictions, call refine() first")
+        if not isinstance(self._refinement, tuple):
+            flat_idx, probs, trues = (np.concatenate(arrays) for arrays in zip(*self._refinement))
+            order = np.lexsort((probs, flat_idx))
+            self._refinement = (flat_idx[order], probs[order], trues[order])
+        flat_idx, probs, trues = self._refinement
+        flat = i * (len(self.fine_edges) - 1) + b
+        start, stop = np.searchsorted(flat_idx, [flat, flat + 1])
+        if stop - start != self._total[i, b]:
+            raise ValueError("refine() was passed different predictions than update()")
+        return probs[start:stop], trues[start:stop]
+
+    def _quantile_edges(self, i):
+        """np.percentile of the predictions of group i at the n_bins quantiles, from its order statistics."""
+        lower, upper, weight, lower_bins, upper_bins, cumulative = self._quantile_ranks(i)
+        values = []
+        for ranks, bins in [(lower, lower_bins), (upper, upper_bins)]:
+            rank_values = self._min_prob[i][bins].copy()
+            for j in np.flatnonzero(self._min_prob[i][bins] < self._max_prob[i][bins]):
+                probs, _ = self._refined_predictions(i, bins[j])
+                rank_values[j] = probs[ranks[j] - (cumulative[bins[j]] - self._total[i, bins[j]]).astype(int)]
+            values.append(rank_values)
+        # The same linear interpolation as np.percentile, so that predictions equal to an edge land in the same bin
+        diff = values[1] - values[0]
+        return np.where(weight >= 0.5, values[1] - diff * (1 - weight), values[0] + diff * weight)
@@ -1,48 +1,408 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextlib
+import gzip
+from itertools import islice
+import os
+import re
+
 import numpy as np
 import pandas as pd
 
+DF_FORMAT_BY_EXTENSION = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "feather",
+    ".xlsx": "excel",
+    ".xls": "excel",
+    ".csv": "csv",
+    ".gz": "csv.gz",
+}
+
 
-def optimize_df_memory_usage(df, perc_unique_categories=0.5):
+def optimize_df_memory_usage(df, perc_unique_categories=0.5, sample_size=10_000, max_workers=None, return_report=False):
     """
     Reduce the memory usage of a pandas Data.Frame by downcasting and converting dtypes.
     Based on this blog post: https://www.dataquest.io/blog/pandas-big-data/.
+    Columns are taken out of the frame up front and converted in parallel threads, and each one is put back
+    by this thread as soon as it is converted, so that the original column can be freed right away.
+    Worker threads never touch the frame itself, which pandas does not allow while it is being assigned to.
+    The share of unique values of string columns is first checked on a sample of sample_size rows, and only
+    estimated on the full column, with a bounded-memory sketch, if the sample is inconclusive.
     :param df: A pandas Data.Frame.
     :param perc_unique_categories: A float in <0., 1.> denoting the threshold for the percentage
     of category values that are unique; variables with this percentage higher than threshold
     will not be converted to categorical type.
-    :return: A pandas Data.Frame with reduced memory usage.
+    :param sample_size: Number of rows sampled to check the percentage of unique values.
+    :param max_workers: Number of columns converted in parallel threads; None converts them one by one.
+    :param return_report: If True, also return a Data.Frame with dtypes and memory usage before and after.
+    :return: A pandas Data.Frame with reduced memory usage, and optionally the report.
     """
-    converted_int = df.select_dtypes(include=["int"]).apply(pd.to_numeric, downcast="integer")
-    converted_float = df.select_dtypes(include=["float"]).apply(pd.to_numeric, downcast="float")
+    bytes_before = df.memory_usage(deep=True, index=False) if return_report else None
+    dtypes_before = df.dtypes
+
+    max_workers = max_workers or 1
+    col_names = iter(df.columns)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def submit(col_name):
+            return executor.submit(_optimize_column, df[col_name], perc_unique_categories, sample_size)
 
-    df_obj = df.select_dtypes(include=["object"]).copy()
-    converted_obj = pd.DataFrame()
-    for col in df_obj.columns:
-        num_unique_values = len(df_obj[col].unique())
-        num_total_values = len(df_obj[col])
-        if num_unique_values / num_total_values < perc_unique_categories:
-            converted_obj.loc[:, col] = df_obj[col].astype("category")
-        else:
-            converted_obj.loc[:, col] = df_obj[col]
+        # Only max_workers columns are converted at a time, so converted copies do not pile up before assignment
+        pending = {submit(col_name): col_name for col_name in islice(col_names, max_workers)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                converted_col = future.result()
+                if converted_col is not None:
+                    df[pending[future]] = converted_col
+                del pending[future]
+                pending.update({submit(col_name): col_name for col_name in islice(col_names, 1)})
 
-    df[converted_int.columns] = converted_int
-    df[converted_float.columns] = converted_float
-    df[converted_obj.columns] = converted_obj
+    if not return_report:
+        return df
+    report = pd.DataFrame(
+        {
+            "dtype_before": dtypes_before,
+            "dtype_after": df.dtypes,
+            "bytes_before": bytes_before,
+            "bytes_after": df.memory_usage(deep=True, index=False),
+        }
+    )
+    return df, report
 
-    return df
 
+def estimate_nunique(series, k=4096, chunk_size=1_000_000):
+    """
+    Estimate the number of unique values in a pd.Series with a K-minimum-values sketch,
+    hashing it chunk by chunk so that memory stays bounded. Exact if the series has fewer than k unique values.
+    The relative error is about 1 / sqrt(k).
+    :param series: A pd.Series.
+    :param k: Number of smallest hash values kept.
+    :param chunk_size: Number of rows hashed at a time.
+    :return: An int; estimated number of unique values.
+    """
+    smallest = np.empty(0, dtype=np.uint64)
+    for start in range(0, len(series), chunk_size):
+        hashes = pd.util.hash_pandas_object(series.iloc[start : start + chunk_size], index=False).to_numpy()
+        if len(smallest) == k:
+            hashes = hashes[hashes < smallest[-1]]
+        smallest = np.unique(np.concatenate([smallest, hashes]))[:k]
+    if len(smallest) < k:
+        return len(smallest)
+    return int((k - 1) / (smallest[-1] / 2.0**64))
 
-def concat_with_categoricals(df_list):
+
+def _optimize_column(col, perc_unique_categories, sample_size):
+    """
+    Return the downcast or categorical version of a column, or None if it is left as is.
+    """
+    if col.dtype.kind in "iu":
+        return pd.to_numeric(col, downcast="integer")
+    if col.dtype.kind == "f":
+        return pd.to_numeric(col, downcast="float")
+    if col.dtype != object and not isinstance(col.dtype, pd.StringDtype):
+        return None
+    if len(col) == 0:
+        return None
+    if len(col) <= sample_size:
+        perc_unique = col.nunique(dropna=False) / len(col)
+    else:
+        # The share of unique values in a sample is an upper bound estimate of the share in the whole column
+        perc_unique = col.sample(sample_size, random_state=0).nunique(dropna=False) / sample_size
+        if perc_unique >= perc_unique_categories:
+            perc_unique = estimate_nunique(col) / len(col)
+    if perc_unique < perc_unique_categories:
+        return col.astype("category")
+    return None
+
+
+def concat_with_categoricals(dfs):
     """
     Concatenate data frames while preserving categorical variables' type.
+    Categories of the columns that are categorical in all data frames are unioned as the frames come in,
+    and each frame's integer codes are remapped to the union, without converting values to objects.
+    The input data frames are not modified.
     Based on this StackOvereflow thread:
     https://stackoverflow.com/questions/45639350/retaining-categorical-dtype-upon-dataframe-concatenation
-    :param df_list: A list of pandas Data.Frames
+    :param dfs: A list, or any iterable such as a generator of partitions, of pandas Data.Frames
     :return: A concatenated pandas Data.Frame with categorical variables.
     """
-    for col in set.intersection(*[set(df.select_dtypes(include="category").columns) for df in df_list]):
-        uc = pd.api.types.union_categoricals([df[col] for df in df_list])
-        for df in df_list:
-            df[col] = pd.Categorical(np.asarray(df[col]), categories=uc.categories)
+    parts = []
+    columns = {}
+    categories = {}
+    codes = {}
+    for i, df in enumerate(dfs):
+        columns.update(dict.fromkeys(df.columns))
+        categorical_cols = set(df.select_dtypes(include="category").columns)
+        if i == 0:
+            categories = {col: df[col].cat.categories for col in categorical_cols}
+            codes = {col: [] for col in categorical_cols}
+        for col in [col for col in codes if col not in categorical_cols]:
+            # Not categorical in all data frames after all; put its values back into the previous parts
+            col_categories = categories.pop(col)
+            for part, part_codes in zip(parts, codes.pop(col)):
+                part[col] = pd.Categorical.from_codes(part_codes, categories=col_categories)
+        for col, col_codes in codes.items():
+            frame_categories = df[col].cat.categories
+            categories[col] = categories[col].append(frame_categories[~frame_categories.isin(categories[col])])
+            mapping = categories[col].get_indexer(frame_categories)
+            frame_codes = df[col].cat.codes.to_numpy()
+            # Codes must stay signed for missing values (-1), also while there are no categories yet
+            code_dtype = np.min_scalar_type(-max(len(categories[col]), 1))
+            if len(mapping):
+                frame_codes = np.where(frame_codes >= 0, mapping.take(frame_codes, mode="clip"), -1)
+            col_codes.append(frame_codes.astype(code_dtype))
+        parts.append(df.drop(columns=list(codes)))
+
+    df = pd.concat(parts, sort=False, ignore_index=True)
+    for col, col_codes in codes.items():
+        df[col] = pd.Categorical.from_codes(np.concatenate(col_codes), categories=categories[col])
+    return df[list(columns)]
+
+
+def get_dtype_schema(df):
+    """
+    Get a JSON-serialisable schema of a data frame's dtypes, e.g. after optimize_df_memory_usage,
+    so that later loads of the data with get_read_csv_kwargs are built with compact dtypes right away.
+    Kept are categorical, string and datetime columns, which are parsed as dates, and compact numeric dtypes:
+    float32 for float columns whose values all survive a cast to float32, as CSV text of float32 values parses
+    back exactly, and integer widths below 64 bits as pandas nullable dtypes, e.g. 'Int16', so that missing values
+    in the file still load. Wider numeric dtypes are left to be inferred.
+    Categorical columns are stored without their categories, so that values unseen so far are still parsed.
+    :param df: A pandas Data.Frame.
+    :return: A dict of column name to dtype name.
+    """
+    schema = {}
+    for col, dtype in df.dtypes.items():
+        if _is_schema_dtype(str(dtype)):
+            schema[col] = str(dtype)
+        elif dtype.kind == "f" and (dtype.itemsize == 4 or _fits_float32(df[col])):
+            schema[col] = "float32"
+        elif dtype.kind in "iu" and dtype.itemsize < 8:
+            schema[col] = _get_nullable_int_dtype(dtype)
+    return schema
+
+
+def get_read_csv_kwargs(dtype_schema, columns=None):
+    """
+    Turn a schema from get_dtype_schema into keyword arguments of pd.read_csv: datetime columns go to
+    `parse_dates`, as read_csv does not parse them through `dtype`, and the rest to `dtype`.
+    Integer dtypes from schemas saved before they were made nullable are read as their nullable counterparts,
+    and entries with other dtypes are ignored.
+    :param dtype_schema: A dict of column name to dtype name, or None.
+    :param columns: Optional list of the columns that are read.
+    :return: A dict with 'dtype' and 'parse_dates'.
+    """
+    dtype, parse_dates = {}, []
+    for col, dtype_name in (dtype_schema or {}).items():
+        if columns is not None and col not in columns:
+            continue
+        if dtype_name.startswith("datetime64"):
+            parse_dates.append(col)
+        elif _is_schema_dtype(dtype_name) or dtype_name == "float32":
+            dtype[col] = dtype_name
+        elif re.fullmatch(r"u?int(8|16|32)", dtype_name, flags=re.IGNORECASE):
+            dtype[col] = _get_nullable_int_dtype(pd.api.types.pandas_dtype(dtype_name.lower()))
+    return {"dtype": dtype or None, "parse_dates": parse_dates or None}
+
+
+def _is_schema_dtype(dtype_name):
+    return dtype_name in ("category", "string", "str") or dtype_name.startswith(("string[", "datetime64"))
+
+
+def _fits_float32(col):
+    values = col.to_numpy(dtype="float64", na_value=np.nan)
+    with np.errstate(over="ignore"):
+        return bool(np.array_equal(values.astype("float32"), values, equal_nan=True))
+
+
+def _get_nullable_int_dtype(dtype):
+    return f"{'U' if dtype.kind == 'u' else ''}Int{dtype.itemsize * 8}"
+
+
+def get_dtype_schema_filepath(filepath):
+    """
+    Path of the dtype schema sidecar file stored next to a data file.
+    output = get_dtype_schema_filepath("data/df.csv.gz")
+    >> 'data/df.csv.gz.dtypes.json'
+    """
+    return f"{filepath}.dtypes.json"
+
+
+def infer_df_format(filepath, file_format=None, default="excel"):
+    """
+    Pick the file format to (de)serialise a data frame with.
+    :param filepath: str; its extension decides the format unless file_format is given, e.g. 'data/df.parquet'
+    :param file_format: one of 'parquet', 'feather', 'excel', 'csv', 'csv.gz' or None
+    :param default: format to use when the extension is not recognised
+    :return: A string with the file format.
+    """
+    if file_format is None:
+        file_format = DF_FORMAT_BY_EXTENSION.get(os.path.splitext(filepath)[1].lower(), default)
+    if file_format not in set(DF_FORMAT_BY_EXTENSION.values()):
+        raise ValueError(
+            f"Unsupported file_format: {file_format}. Available: {sorted(set(DF_FORMAT_BY_EXTENSION.values()))}"
+        )
+    return file_format
+
+
+def write_df_to_buffer(df, fp, file_format, compression=None):
+    """
+    Serialise a data frame to a binary file object.
+    :param df: A pandas Data.Frame.
+    :param fp: A writable binary file object.
+    :param file_format: one of 'parquet', 'feather', 'excel', 'csv', 'csv.gz'
+    :param compression: Codec for columnar formats, e.g. 'snappy' or 'zstd'; defaults to 'snappy' for parquet
+    and 'zstd' for feather.
+    """
+    if file_format == "parquet":
+        df.to_parquet(fp, index=False, compression=compression or "snappy")
+    elif file_format == "feather":
+        df.reset_index(drop=True).to_feather(fp, compression=compression or "zstd")
+    elif file_format == "excel":
+        df.to_excel(fp, index=False)
+    else:
+        df.to_csv(fp, index=False, compression="gzip" if file_format == "csv.gz" else compression)
+
+
+def read_df_from_buffer(fp, file_format, columns=None, filters=None):
+    """
+    Deserialise a data frame from a binary file object.
+    For parquet, only the footer and the column chunks of matching row groups are read from a seekable fp.
+    :param fp: A readable binary file object.
+    :param file_format: one of 'parquet', 'feather', 'excel', 'csv', 'csv.gz'
+    :param columns: Optional list of columns to read.
+    :param filters: Optional parquet row group filters, e.g. [('date', '>=', '2022-01-01')]; parquet only.
+    :return: A pandas Data.Frame.
+    """
+    if filters is not None and file_format != "parquet":
+        raise ValueError(f"filters are only supported for parquet, not {file_format}")
+    if file_format == "parquet":
+        return pd.read_parquet(fp, columns=columns, filters=filters)
+    elif file_format == "feather":
+        return pd.read_feather(fp, columns=columns)
+    elif file_format == "excel":
+        return pd.read_excel(fp, usecols=columns)
+    else:
+        return pd.read_csv(fp, usecols=columns, compression="gzip" if file_format == "csv.gz" else None)
+
+
+def iter_df_chunks_from_buffer(
+    fp, file_format, chunksize=None, chunk_bytes=None, columns=None, probe_rows=10_000, dtype_schema=None
+):
+    """
+    Read a data frame from a binary file object chunk by chunk, without loading it whole.
+    Chunks are either a fixed number of rows, or sized so that each takes about chunk_bytes of memory;
+    the number of rows per chunk is then estimated from the memory usage of the first probe_rows rows.
+    :param fp: A readable binary file object; seekable for parquet and feather.
+    :param file_format: one of 'parquet', 'feather', 'csv', 'csv.gz'
+    :param chunksize: Number of rows per chunk.
+    :param chunk_bytes: Approximate in-memory size of a chunk in bytes, used if chunksize is not given.
+    :param columns: Optional list of columns to read.
+    :param dtype_schema: Optional dict of column name to dtype for CSV, from get_dtype_schema.
+    :return: A generator of pandas Data.Frames.
+    """
+    if chunksize is None and chunk_bytes is None:
+        raise ValueError("Either chunksize or chunk_bytes has to be given")
+    if file_format in ("csv", "csv.gz"):
+        reader = pd.read_csv(
+            fp,
+            usecols=columns,
+            compression="gzip" if file_format == "csv.gz" else None,
+            iterator=True,
+            **get_read_csv_kwargs(dtype_schema, columns),
+        )
+        with reader:
+            if chunksize is None:
+                first_chunk = reader.get_chunk(probe_rows)
+                chunksize = _rows_per_chunk(first_chunk, chunk_bytes)
+                yield first_chunk
+            while True:
+                try:
+                    yield reader.get_chunk(chunksize)
+                except StopIteration:
+                    return
+    elif file_format == "parquet":
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(fp)
+        if chunksize is None:
+            probe = next(parquet_file.iter_batches(batch_size=probe_rows, columns=columns), None)
+            chunksize = _rows_per_chunk(probe.to_pandas(), chunk_bytes) if probe is not None else 1
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    elif file_format == "feather":
+        import pyarrow.ipc
+
+        reader = pyarrow.ipc.open_file(fp)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if columns is not None:
+                batch = batch.select(columns)
+            if chunksize is None:
+                chunksize = _rows_per_chunk(batch.slice(0, probe_rows).to_pandas(), chunk_bytes)
+            for offset in range(0, batch.num_rows, chunksize):
+                yield batch.slice(offset, chunksize).to_pandas()
+    else:
+        raise ValueError(f"Chunked reading is not supported for {file_format}")
+
+
+def write_df_chunks_to_buffer(chunks, fp, file_format, compression=None):
+    """
+    Append an iterable of data frames with the same columns into a single file object.
+    Parquet chunks become row groups and feather chunks record batches; CSV gets a single header.
+    :param chunks: An iterable of pandas Data.Frames.
+    :param fp: A writable binary file object; need not be seekable.
+    :param file_format: one of 'parquet', 'feather', 'csv', 'csv.gz'
+    :param compression: Codec for columnar formats, e.g. 'snappy' or 'zstd'.
+    :return: Total number of rows written.
+    """
+    num_rows = 0
+    if file_format in ("csv", "csv.gz"):
+        with gzip.GzipFile(fileobj=fp, mode="wb") if file_format == "csv.gz" else contextlib.nullcontext(fp) as out:
+            for chunk in chunks:
+                chunk.to_csv(out, header=num_rows == 0, index=False, mode="wb")
+                num_rows += len(chunk)
+    elif file_format in ("parquet", "feather"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is not None:
+                    # keep the first chunk's schema, e.g. when a later chunk has an all-null column
+                    table = table.cast(schema)
+                schema = table.schema
+                if writer is None and file_format == "parquet":
+                    writer = pq.ParquetWriter(fp, table.schema, compression=compression or "snappy")
+                elif writer is None:
+                    options = pa.ipc.IpcWriteOptions(compression=compression or "zstd")
+                    writer = pa.ipc.new_file(fp, table.schema, options=options)
+                writer.write_table(table)
+                num_rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        raise ValueError(f"Chunked writing is not supported for {file_format}")
+    return num_rows
+
+
+def get_part_filepath(filepath, part_number, file_format):
+    """
+    Path of the part_number-th part file of a data frame written as a set of part files under filepath.
+    output = get_part_filepath("data/df.parquet", 3, "parquet")
+    >> 'data/df.parquet/part-00003.parquet'
+    """
+    extension = {"parquet": ".parquet", "feather": ".feather", "excel": ".xlsx", "csv": ".csv", "csv.gz": ".csv.gz"}
+    return f"{filepath.rstrip('/')}/part-{part_number:05d}{extension[file_format]}"
+
 
-    return pd.concat(df_list, sort=False).reset_index(drop=True)
+def _rows_per_chunk(df_sample, chunk_bytes):
+    sample_bytes = df_sample.memory_usage(deep=True).sum()
+    if len(df_sample) == 0 or sample_bytes == 0:
+        return 1
+    return max(1, int(chunk_bytes * len(df_sample) / sample_bytes))
@@ -0,0 +1,188 @@
+"""
+Fast serialization of large, NumPy-heavy Python objects, e.g. models and feature matrices.
+Objects are pickled with protocol 5, so contiguous arrays are kept out-of-band instead of being copied into
+the pickle stream. Out-of-band buffers are split into blocks compressed in parallel with lz4 or zstd,
+or stored as they are, aligned, so that a memory-mapped load hands them to NumPy without copying.
+Example usage:
+from utils.serialization import dump_object, load_object
+with open("model.pkl", "wb") as f:
+    stats = dump_object(model, f, codec="zstd", level=3)
+stats
+>> {'codec': 'zstd', 'level': 3, 'num_buffers': 12, 'raw_bytes': 812345678, 'stored_bytes': 301234567,
+>>  'compression_ratio': 2.7, 'pickle_seconds': 0.02, 'compress_seconds': 0.61, 'write_seconds': 0.35}
+with open("model.pkl", "rb") as f:
+    model = load_object(f, use_mmap=True)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import mmap
+import pickle
+import struct
+
+from .datetime import Timer
+
+MAGIC = b"MOPYPKL\x01"
+ALIGNMENT = 64
+BLOCK_SIZE = 4 * 1024**2
+CODECS = (None, "lz4", "zstd")
+
+
+def is_serialized_object(fp):
+    """
+    Whether the seekable binary file object holds an object written by `dump_object`; the position is kept.
+    """
+    position = fp.tell()
+    try:
+        return fp.read(len(MAGIC)) == MAGIC
+    finally:
+        fp.seek(position)
+
+
+def dump_object(obj, fp, codec=None, level=None, block_size=BLOCK_SIZE, max_workers=None):
+    """
+    Serialize obj into a binary file object.
+    :param codec: None to store buffers uncompressed (fastest, and zero-copy on memory-mapped loads), 'lz4' or 'zstd'
+    :param level: compression level; defaults to the codec's own default
+    :param block_size: bytes per independently compressed block
+    :param max_workers: threads compressing blocks; both codecs release the GIL
+    :return: dict with sizes in bytes and the time spent on each stage, in seconds
+    """
+    compress, _ = _get_codec(codec, level)
+    timer = Timer()
+    buffers = []
+    pickled = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    segments = [memoryview(pickled)] + [buffer.raw() for buffer in buffers]
+    pickle_seconds = timer.get_duration_ns() / 1e9
+
+    timer = Timer()
+    if compress is None:
+        frames = [[segment] for segment in segments]
+    else:
+        blocks = [segment[i : i + block_size] for segment in segments for i in range(0, segment.nbytes, block_size)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            compressed = iter(list(executor.map(compress, blocks)))
+        frames = [[next(compressed) for _ in range(0, segment.nbytes, block_size)] for segment in segments]
+    compress_seconds = timer.get_duration_ns() / 1e9
+
+    timer = Timer()
+    offset, header_segments = 0, []
+    for segment, segment_frames in zip(segments, frames):
+        header_frames = []
+        for i, frame in enumerate(segment_frames):
+            raw_nbytes = min(block_size, segment.nbytes - i * block_size) if compress else segment.nbytes
+            header_frames.append([offset, len(frame) if compress else frame.nbytes, raw_nbytes])
+            offset = _align(offset + header_frames[-1][1])
+        header_segments.append(header_frames)
+    header = json.dumps({"codec": codec, "segments": header_segments}).encode("utf-8")
+    prefix = MAGIC + struct.pack("<Q", len(header)) + header
+    fp.write(prefix + b"\0" * (_align(len(prefix)) - len(prefix)))
+    written = 0
+    for segment_frames, header_frames in zip(frames, header_segments):
+        for frame, (frame_offset, stored_nbytes, _) in zip(segment_frames, header_frames):
+            fp.write(b"\0" * (frame_offset - written))
+            fp.write(frame)
+            written = frame_offset + stored_nbytes
+    write_seconds = timer.get_duration_ns() / 1e9
+
+    raw_bytes = sum(segment.nbytes for segment in segments)
+    stored_bytes = _align(len(prefix)) + written
+    return {
+        "codec": codec,
+        "level": level,
+        "num_buffers": len(buffers),
+        "raw_bytes": raw_bytes,
+        "stored_bytes": stored_bytes,
+        "compression_ratio": raw_bytes / stored_bytes,
+        "pickle_seconds": pickle_seconds,
+        "compress_seconds": compress_seconds,
+        "write_seconds": write_seconds,
+    }
+
+
+def load_object(fp, use_mmap=False, max_workers=None):
+    """
+    Deserialize an object written by `dump_object` from a binary file object, starting at its current position.
+    With use_mmap=True, fp must be a local file: it is memory-mapped copy-on-write, so uncompressed arrays
+    are backed by the page cache instead of being read into memory, yet stay writable without touching the file.
+    :param max_workers: threads decompressing blocks
+    """
+    if use_mmap:
+        data = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY))[fp.tell() :]
+    else:
+        data = memoryview(_read_remaining(fp))
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not an object serialized with utils.serialization.dump_object")
+    (header_nbytes,) = struct.unpack("<Q", data[len(MAGIC) : len(MAGIC) + 8])
+    header = json.loads(bytes(data[len(MAGIC) + 8 : len(MAGIC) + 8 + header_nbytes]))
+    data = data[_align(len(MAGIC) + 8 + header_nbytes) :]
+    _, decompress = _get_codec(header["codec"], None)
+
+    if decompress is None:
+        segments = [data[offset : offset + nbytes] for [[offset, nbytes, _]] in header["segments"]]
+    else:
+        segments = [bytearray(sum(raw_nbytes for *_, raw_nbytes in frames)) for frames in header["segments"]]
+
+        def decompress_frame(segment, start, offset, stored_nbytes, raw_nbytes):
+            segment[start : start + raw_nbytes] = decompress(data[offset : offset + stored_nbytes])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for segment, frames in zip(segments, header["segments"]):
+                start = 0
+                for offset, stored_nbytes, raw_nbytes in frames:
+                    futures.append(executor.submit(decompress_frame, segment, start, offset, stored_nbytes, raw_nbytes))
+                    start += raw_nbytes
+            for future in futures:
+                future.result()
+    return pickle.loads(segments[0], buffers=segments[1:])
+
+
+def _get_codec(codec, level):
+    """
+    :return: (compress, decompress) functions of bytes-like objects, or (None, None) for no compression
+    """
+    if codec is None:
+        return None, None
+    if codec == "lz4":
+        import lz4.frame
+
+        def compress(data):
+            return lz4.frame.compress(data, compression_level=level or 0)
+
+        return compress, lz4.frame.decompress
+    if codec == "zstd":
+        import zstandard
+
+        # Compressor objects are not thread-safe, so each block gets its own
+        def compress(data):
+            return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+
+        def decompress(data):
+            return zstandard.ZstdDecompressor().decompress(data)
+
+        return compress, decompress
+    raise ValueError(f"Unknown codec '{codec}', available codecs are: {CODECS}")
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _read_remaining(fp):
+    """
+    Read the rest of the file into one bytearray, so that arrays loaded from it are writable without a copy.
+    """
+    position = fp.tell()
+    size = fp.seek(0, io.SEEK_END) - position
+    fp.seek(position)
+    data = bytearray(size)
+    view = memoryview(data)
+    read = 0
+    while read < size:
+        n = fp.readinto(view[read:])
+        if not n:
+            raise EOFError(f"Expected {size} bytes, got {read}")
+        read += n
+    return data
@@ -0,0 +1,162 @@
+"""
+Per-operation latency histograms, cheap enough to keep on in production.
+Import it as mopy.utils.timing everywhere, as the clients do: under another module path, e.g. utils.timing,
+it is loaded again with a registry of its own, whose export misses the clients' timings.
+Example usage:
+from mopy.utils.timing import registry, timed
+
+@timed("model.predict")
+def predict(x):
+    ...
+
+with timed("db.query"):
+    ...
+
+registry.export_prometheus()  # text for a /metrics endpoint
+registry.start_periodic_log(interval_s=60)  # or a summary log line every minute
+"""
+
+import bisect
+import functools
+import inspect
+import logging
+import threading
+
+from .datetime import Timer
+
+DEFAULT_BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    """Thread-safe histogram of durations with fixed bucket upper bounds, in seconds"""
+
+    def __init__(self, buckets_s=DEFAULT_BUCKETS_S):
+        self.bucket_bounds_ns = [int(b * 1e9) for b in buckets_s]
+        self.bucket_counts = [0] * (len(buckets_s) + 1)
+        self.count = 0
+        self.sum_ns = 0
+        self._lock = threading.Lock()
+
+    def observe(self, duration_ns):
+        i = bisect.bisect_left(self.bucket_bounds_ns, duration_ns)
+        with self._lock:
+            self.bucket_counts[i] += 1
+            self.count += 1
+            self.sum_ns += duration_ns
+
+    def quantile_upper_bound_s(self, q):
+        """Upper bound of the bucket holding the q-th quantile, in seconds; inf if it is in the last bucket."""
+        with self._lock:
+            target = q * self.count
+            cumulative = 0
+            for bound_ns, bucket_count in zip(self.bucket_bounds_ns, self.bucket_counts):
+                cumulative += bucket_count
+                if cumulative >= target:
+                    return bound_ns / 1e9
+        return float("inf")
+
+
+class TimingRegistry:
+    """Collection of histograms, one per named operation"""
+
+    def __init__(self, buckets_s=DEFAULT_BUCKETS_S):
+        self.buckets_s = buckets_s
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, duration_ns):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram(self.buckets_s))
+        histogram.observe(duration_ns)
+
+    def export_prometheus(self, metric_name="operation_duration_seconds"):
+        """Render all histograms in the Prometheus text exposition format."""
+        lines = [
+            f"# HELP {metric_name} Duration of instrumented operations.",
+            f"# TYPE {metric_name} histogram",
+        ]
+        for name, histogram in sorted(self.histograms.items()):
+            with histogram._lock:
+                bucket_counts, count, sum_ns = list(histogram.bucket_counts), histogram.count, histogram.sum_ns
+            cumulative = 0
+            for bound_s, bucket_count in zip(list(self.buckets_s) + ["+Inf"], bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{metric_name}_bucket{{operation="{name}",le="{bound_s}"}} {cumulative}')
+            lines.append(f'{metric_name}_sum{{operation="{name}"}} {sum_ns / 1e9}')
+            lines.append(f'{metric_name}_count{{operation="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def summary_line(self):
+        """One line with count, mean and approximate p50/p99 of each operation."""
+        parts = []
+        for name, histogram in sorted(self.histograms.items()):
+            if histogram.count:
+                mean_ms = histogram.sum_ns / histogram.count / 1e6
+                p50_ms = histogram.quantile_upper_bound_s(0.5) * 1e3
+                p99_ms = histogram.quantile_upper_bound_s(0.99) * 1e3
+                parts.append(f"{name}: n={histogram.count} mean={mean_ms:.2f}ms p50<={p50_ms:g}ms p99<={p99_ms:g}ms")
+        return "; ".join(parts)
+
+    def start_periodic_log(self, interval_s=60, logger=None):
+        """Log summary_line every interval_s seconds from a daemon thread."""
+        logger = logger or logging.getLogger("default")
+        stopped = threading.Event()
+
+        def log_periodically():
+            while not stopped.wait(interval_s):
+                line = self.summary_line()
+                if line:
+                    logger.info(f"Timings: {line}")
+
+        threading.Thread(target=log_periodically, name="timing-log", daemon=True).start()
+        return stopped
+
+
+registry = TimingRegistry()
+
+
+class _Timed:
+    def __init__(self, name, timing_registry):
+        self.name = name
+        self.registry = timing_registry
+
+    def __enter__(self):
+        self._timer = Timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, self._timer.get_duration_ns())
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Timed(self.name, self.registry):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+
+def timed(name, timing_registry=None):
+    """
+    Record the duration of a block or of each call of a function in the histogram of operation name.
+    Use as a context manager, `with timed("db.query"):`, or as a decorator, `@timed("db.query")`.
+    """
+    return _Timed(name, timing_registry or registry)
+
+
+def timed_methods(prefix, timing_registry=None):
+    """
+    Class decorator timing every public method, as operation '{prefix}.{method name}'.
+    Generator methods are left as they are, since their duration depends on the consumer.
+    """
+
+    def decorate(cls):
+        for attr_name, attr in list(vars(cls).items()):
+            if attr_name.startswith("_") or not inspect.isfunction(attr) or inspect.isgeneratorfunction(attr):
+                continue
+            setattr(cls, attr_name, timed(f"{prefix}.{attr_name}", timing_registry)(attr))
+        return cls
+
+    return decorate